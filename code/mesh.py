@@ -9,6 +9,7 @@ the ES models, and reporting/visualization of the results.
 
 import sys
 import time
+import multiprocessing
 import math
 import os
 import logging
@@ -592,28 +593,13 @@ class MeshApplication(MeshAbstractObject, QMainWindow):
 
     def set_visible_matrix_by_name(self, name):
         self.uri_of_target = self.map_widget.elements[name].source_uri
-        ds = gdal.Open(self.uri_of_target)
-        band = ds.GetRasterBand(1)
-        cols = ds.RasterXSize
-        rows = ds.RasterYSize
-        size = cols * rows
-
         max_size = 5000000
-        if size > max_size:
-            # Use gdal ReadAsArray to only resample to a small enough raster.
-            scale_factor = float(max_size) / float(size)
-            render_cols = int(cols * scale_factor)
-            render_rows = int(rows * scale_factor)
-
-            LOGGER.critical(
-                'Attempting to load very large array. May not display correctly or fail. Array set to the top left 2048 by 2048 cells.')
-            # self.visible_matrix = band.ReadAsArray(0, 0, max_side_length, max_side_length)
-            self.visible_matrix = band.ReadAsArray(0, 0, cols, rows, render_cols, render_rows)
-        else:
-            self.visible_matrix = band.ReadAsArray()
+        with utilities.RasterArray(self.uri_of_target) as raster:
+            if raster.shape[0] * raster.shape[1] > max_size:
+                LOGGER.info('Large raster, displaying it subsampled to about %i cells.', max_size)
+            # Only the subsampled array is loaded, never the full raster.
+            self.visible_matrix = raster.read_decimated(max_size)
         self.visible_map = self.map_widget.elements[name]
-        del band
-        del ds
 
         self.map_canvas_holder_widget.map_viewer_canvas.draw_visible_array()
 
@@ -5214,6 +5200,9 @@ class DefineDecisionContextDialog(MeshAbstractObject, QDialog):
 
 
 if __name__ == '__main__':
+    # Models can run process pools; in the frozen Windows exe each worker starts the exe again, and this makes those
+    # workers run their task instead of another copy of the application.
+    multiprocessing.freeze_support()
     LOGGER.setLevel(logging.DEBUG)
     app = QApplication(sys.argv)
     mesh_app = MeshApplication()
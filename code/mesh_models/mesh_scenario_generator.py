@@ -2,17 +2,27 @@
 
 import os
 import math
+import glob
+import shutil
 import struct
+import hashlib
 import logging
+import tempfile
 from decimal import Decimal
 
 import numpy as np
 import scipy as sp
+import scipy.ndimage
+import scipy.sparse
+import scipy.sparse.csgraph
 from osgeo import gdal, ogr
 
 # NOTE That this is a reference to the python 2.7 verison of pygeoprocessing because that's still what mesh runs in.
 import pygeoprocessing.geoprocessing as geoprocess
 from mesh_utilities import invest_utils as invest_utils
+from mesh_utilities import utilities
+from mesh_utilities.gtiff_profiles import (
+    gtiff_creation_options, compress_gtiff_uri)
 
 logging.basicConfig(format='%(asctime)s %(name)-20s %(levelname)-8s \
 %(message)s', level=logging.DEBUG, datefmt='%m/%d/%Y %H:%M:%S ')
@@ -42,11 +52,468 @@ _INTERMEDIATE = {
     'filter_name': 'filter_%i.tif',
     'factors_name': 'suitability_%s.tif',
     'cover_name': 'cover_%i.tif',
-    'proximity_name': 'proximity_%s.tif',
     'normalized_proximity_name': 'proximity_norm_%s.tif',
     'adjusted_suitability_name': 'adjusted_suitability_%s.tif'
 }
 
+# Approximate number of pixels held in memory per strip of rows when
+# filtering fragments
+_FRAGMENT_STRIP_SIZE = 2**22
+
+# Rasters with more pixels than this are refused by `_vectorize_datasets`
+# when asked to apply a scalar (numpy.vectorize) op
+_MAX_SCALAR_OP_PIXELS = 2**16
+
+# Most distinct codes `_transition_matrix_from_uri` tabulates; its dense
+# matrix takes 8 * n_codes**2 bytes per pair of rasters, 128MB at this limit
+_MAX_TRANSITION_CODES = 2**12
+
+
+def _vectorize_datasets(dataset_uri_list, dataset_pixel_op, *args, **kwargs):
+    """Call `geoprocess.vectorize_datasets` with an array op by default.
+
+    Same arguments as `geoprocess.vectorize_datasets` except that
+    `vectorize_op` defaults to False, so `dataset_pixel_op` must operate on
+    whole numpy arrays, and `dataset_options` defaults to the
+    'intermediate' GeoTIFF creation profile.  `geoprocess` ignores
+    `process_pool` and always computes the output statistics, so if a pool
+    is given or `calculate_stats` is False the call goes to
+    `mesh_utilities.utilities.vectorize_datasets` instead.
+
+    Raises:
+        ValueError: if `vectorize_op` is True and any of the rasters in
+            `dataset_uri_list` has more than `_MAX_SCALAR_OP_PIXELS` pixels,
+            since calling a Python function per pixel is too slow.
+    """
+    if kwargs.setdefault('vectorize_op', False):
+        for dataset_uri in dataset_uri_list:
+            n_rows, n_cols = geoprocess.get_row_col_from_uri(dataset_uri)
+            if n_rows * n_cols > _MAX_SCALAR_OP_PIXELS:
+                raise ValueError(
+                    "Refusing to apply scalar op %s to %s with %i pixels, "
+                    "use an array op instead." % (
+                        dataset_pixel_op.__name__, dataset_uri,
+                        n_rows * n_cols))
+    if kwargs.get('dataset_options') is None:
+        datatype_out = args[1] if len(args) > 1 else kwargs['datatype_out']
+        kwargs['dataset_options'] = gtiff_creation_options(
+            'intermediate', datatype_out)
+    if (kwargs.get('process_pool') is not None or
+            not kwargs.get('calculate_stats', True)):
+        # the scenario rasters share the landcover grid, so without an AOI
+        # they can be aligned with VRTs instead of resampled copies
+        kwargs.setdefault('lazy_alignment', kwargs.get('aoi_uri') is None)
+        utilities.vectorize_datasets(
+            dataset_uri_list, dataset_pixel_op, *args, **kwargs)
+    else:
+        geoprocess.vectorize_datasets(
+            dataset_uri_list, dataset_pixel_op, *args, **kwargs)
+
+
+# numpy types matching the gdal types suitability recipes are cast to
+_GDAL_TO_NUMPY_TYPE = {
+    gdal.GDT_Byte: np.uint8,
+    gdal.GDT_Int16: np.int16,
+    gdal.GDT_UInt16: np.uint16,
+    gdal.GDT_Int32: np.int32,
+    gdal.GDT_UInt32: np.uint32,
+    gdal.GDT_Float32: np.float32,
+    gdal.GDT_Float64: np.float64,
+}
+
+
+# gdal integer types from narrowest to widest
+_GDAL_INTEGER_TYPES = [
+    gdal.GDT_Byte, gdal.GDT_UInt16, gdal.GDT_Int16, gdal.GDT_UInt32,
+    gdal.GDT_Int32]
+
+# gdal type of floating point intermediates for each precision policy
+_INTERMEDIATE_FLOAT_TYPES = {
+    'compact': gdal.GDT_Float32,
+    'full': gdal.GDT_Float64,
+}
+
+
+def _narrowest_gdal_type(min_value, max_value, integral, precision):
+    """Select the narrowest gdal type for an intermediate raster.
+
+    Args:
+        min_value (float): smallest value the raster holds, including nodata
+        max_value (float): largest value the raster holds, including nodata
+        integral (bool): whether every value is an integer
+        precision (str): precision policy for non integral values, one of
+            the keys of `_INTERMEDIATE_FLOAT_TYPES`
+
+    Returns:
+        gdal type
+    """
+    if integral:
+        for gdal_type in _GDAL_INTEGER_TYPES:
+            type_info = np.iinfo(_GDAL_TO_NUMPY_TYPE[gdal_type])
+            if type_info.min <= min_value and max_value <= type_info.max:
+                return gdal_type
+    return _INTERMEDIATE_FLOAT_TYPES[precision]
+
+
+def _field_value_range(vector_uri, field_name):
+    """Find the range of the values of a field in a vector.
+
+    Args:
+        vector_uri (str): path to the vector
+        field_name (str): name of a numeric field in the vector
+
+    Returns:
+        min_value (float): smallest value of the field, None if no features
+        max_value (float): largest value of the field, None if no features
+        integral (bool): whether the field is an integer field
+    """
+    datasource = ogr.Open(vector_uri)
+    layer = datasource.GetLayer()
+    layer_defn = layer.GetLayerDefn()
+    field_defn = layer_defn.GetFieldDefn(layer_defn.GetFieldIndex(field_name))
+    integral = field_defn.GetType() == ogr.OFTInteger
+    value_list = [feature.GetField(field_name) for feature in layer]
+    value_list = [value for value in value_list if value is not None]
+    layer = None
+    datasource = None
+    if not value_list:
+        return None, None, integral
+    return min(value_list), max(value_list), integral
+
+
+def _rasterized_field_type(
+        vector_uri, field_name, fill_value, nodata, precision):
+    """Select the gdal type to rasterize a vector field into.
+
+    Args:
+        vector_uri (str): path to the vector
+        field_name (str): name of the numeric field burned into the raster
+        fill_value (float): value of the raster where nothing is burned
+        nodata (float): nodata value of the raster
+        precision (str): precision policy, see `_narrowest_gdal_type`
+
+    Returns:
+        gdal type
+    """
+    if precision == 'full':
+        return gdal.GDT_Float64
+    min_value, max_value, integral = _field_value_range(
+        vector_uri, field_name)
+    value_list = [fill_value, nodata] + [
+        value for value in [min_value, max_value] if value is not None]
+    return _narrowest_gdal_type(
+        min(value_list), max(value_list), integral, precision)
+
+
+def _cast_to_gdal_type(array, gdal_type):
+    """Convert an array as if it was written to and read from a raster.
+
+    Args:
+        array (np.array): values to convert
+        gdal_type (int): gdal type of the raster, integer types round to
+            the nearest value and saturate like gdal does.
+
+    Returns:
+        np.array of the numpy type matching `gdal_type`
+    """
+    numpy_type = _GDAL_TO_NUMPY_TYPE[gdal_type]
+    if np.issubdtype(numpy_type, np.integer):
+        type_info = np.iinfo(numpy_type)
+        array = np.clip(
+            _round_half_away_from_zero(array), type_info.min, type_info.max)
+    return array.astype(numpy_type)
+
+
+def _weighted_sum_op(weights_list):
+    """Create an op that sums its arrays multiplied by `weights_list`."""
+    def weighted_op(*values):
+        result = (values[0] * weights_list[0]).astype(float)
+        for v, w in zip(values[1:], weights_list[1:]):
+            result += v * w
+        return result
+    return weighted_op
+
+
+def _landcover_mask_op(landcover_nodata):
+    """Create an op that is 0 on valid landcover and -1 on its nodata."""
+    def mask_op(landcover):
+        return np.where(landcover != landcover_nodata, 0, -1)
+    return mask_op
+
+
+def _suitability_op(physical_suitability_weight):
+    """Create an op that weighs transition against factor suitability.
+
+    Pixels that cannot transition (0) stay 0, the rest are rounded like
+    the Python 2 builtin `round`.
+    """
+    def suitability_op(trans, suit):
+        return np.where(
+            trans == 0, 0, _round_half_away_from_zero(
+                ((1 - physical_suitability_weight) * trans) +
+                (physical_suitability_weight * suit)))
+    return suitability_op
+
+
+def _constraint_op(suit, cons):
+    """Scale suitability by the constraints."""
+    return suit * cons
+
+
+def _proximity_op(proximity_weight):
+    """Create an op that adds weighted proximity to suitability, up to 100."""
+    def proximity_op(suit, prox):
+        return np.minimum(suit + (prox * proximity_weight), 100)
+    return proximity_op
+
+
+def _constraint_proximity_op(proximity_weight):
+    """Create an op that adds weighted proximity to constrained suitability.
+
+    The result is capped at 100.
+    """
+    def constraint_proximity_op(suit, cons, prox):
+        return np.minimum((cons * suit) + (prox * proximity_weight), 100)
+    return constraint_proximity_op
+
+
+def _distance_score(
+        meters_block, valid_mask, minimum, maximum, distance_scale,
+        suitability_nodata):
+    """Score distances so `minimum` scores `distance_scale` and `maximum` 1.
+
+    Args:
+        meters_block (np.array): distances in meters
+        valid_mask (np.array): boolean array, True where the distance is
+            defined and within the maximum distance
+        minimum (float): smallest valid distance
+        maximum (float): largest valid distance
+        distance_scale (int): score of the cells at `minimum`
+        suitability_nodata (int): value where `valid_mask` is False
+
+    Returns:
+        np.array of the distance scores
+    """
+    if valid_mask.any():
+        score_block = ((distance_scale - 1) - (
+            ((meters_block - minimum) / float(maximum - minimum)) *
+            (distance_scale - 1))) + 1
+    else:
+        score_block = meters_block
+    return np.where(valid_mask, score_block, suitability_nodata)
+
+
+def _recipe_uri_list(recipe, uri_list=None):
+    """List the rasters a suitability recipe reads, without duplicates.
+
+    A recipe is either the path to a raster or a tuple of
+    (out_uri, op, gdal_type, child_recipe_list) meaning `op` applied to the
+    values of the child recipes and cast to `gdal_type`.  `out_uri` is where
+    the recipe is written if it has to be materialized.
+
+    Args:
+        recipe (str or tuple): the suitability recipe
+        uri_list (list): (optional) list to extend
+
+    Returns:
+        uri_list (list): paths to the rasters in the order first used
+    """
+    if uri_list is None:
+        uri_list = []
+    if isinstance(recipe, basestring):
+        if recipe not in uri_list:
+            uri_list.append(recipe)
+    else:
+        for child_recipe in recipe[3]:
+            _recipe_uri_list(child_recipe, uri_list)
+    return uri_list
+
+
+def _evaluate_recipe(recipe, value_dict):
+    """Evaluate a suitability recipe on blocks of its rasters in memory.
+
+    Args:
+        recipe (str or tuple): the suitability recipe, see
+            `_recipe_uri_list`
+        value_dict (dict): maps the raster paths in `recipe` to arrays
+
+    Returns:
+        np.array of the value of `recipe`
+    """
+    if isinstance(recipe, basestring):
+        return value_dict[recipe]
+    _, op, gdal_type, child_recipe_list = recipe
+    return _cast_to_gdal_type(
+        op(*[_evaluate_recipe(child_recipe, value_dict)
+             for child_recipe in child_recipe_list]),
+        gdal_type)
+
+
+def _materialize_recipe(
+        recipe, nodata, cell_size, creation_profile='intermediate',
+        process_pool=None):
+    """Write a suitability recipe to its raster in one blockwise pass.
+
+    Every op in `recipe` is evaluated per block in memory so only the
+    recipe's own output raster is written.
+
+    Args:
+        recipe (str or tuple): the suitability recipe, see
+            `_recipe_uri_list`
+        nodata (int): nodata value of the output raster
+        cell_size (float): cell size of the output raster
+        creation_profile (str): GeoTIFF creation profile of the output
+            raster, "scratch" if it will be updated in place, in which case
+            its statistics aren't computed either
+        process_pool: (optional) number of threads to compute the blocks
+            on, see `_vectorize_datasets`
+
+    Returns:
+        path to the raster holding the values of `recipe`
+    """
+    if isinstance(recipe, basestring):
+        return recipe
+    out_uri, _, gdal_type, _ = recipe
+    uri_list = _recipe_uri_list(recipe)
+    LOGGER.info("Evaluating %s from: %s", out_uri, ", ".join(uri_list))
+
+    def recipe_op(*values):
+        return _evaluate_recipe(recipe, dict(zip(uri_list, values)))
+
+    _vectorize_datasets(
+        uri_list,
+        recipe_op,
+        out_uri,
+        gdal_type,
+        nodata,
+        cell_size,
+        "union",
+        vectorize_op=False,
+        dataset_options=gtiff_creation_options(
+            creation_profile, gdal_type),
+        process_pool=process_pool,
+        calculate_stats=creation_profile != 'scratch')
+    return out_uri
+
+
+# Factor rasters cached across runs are evicted, least recently used first,
+# once the cache holds more than this many bytes
+_FACTOR_CACHE_MAX_BYTES = 2**32
+
+# Changing how factor rasters are calculated must change this so stale
+# cached rasters are never used
+_FACTOR_CACHE_VERSION = 1
+
+
+def _hash_file_list(file_uri_list, hash_object):
+    """Update a hash with the contents of a list of files.
+
+    Args:
+        file_uri_list (list): paths to the files, hashed in order along with
+            their base names
+        hash_object (hashlib hash): updated in place
+    """
+    for file_uri in file_uri_list:
+        hash_object.update(os.path.basename(file_uri).encode('utf-8'))
+        with open(file_uri, 'rb') as file_object:
+            for chunk in iter(lambda: file_object.read(2**20), b''):
+                hash_object.update(chunk)
+
+
+def _factor_cache_key(factor_uri, landcover_uri, parameter_list):
+    """Create a key identifying a factor raster calculated from inputs.
+
+    Args:
+        factor_uri (str): path to the factor vector, every file sharing its
+            stem (.shp, .shx, .dbf, .prj, ...) is hashed
+        landcover_uri (str): path to the landcover raster the factor is
+            aligned to, its geotransform, shape and projection are used
+        parameter_list (list): any other values the factor raster depends
+            on, converted with `repr`
+
+    Returns:
+        hex digest string
+    """
+    hash_object = hashlib.sha1()
+    hash_object.update(repr(_FACTOR_CACHE_VERSION).encode('utf-8'))
+    _hash_file_list(
+        sorted(glob.glob(os.path.splitext(factor_uri)[0] + '.*')),
+        hash_object)
+    landcover_ds = gdal.Open(landcover_uri)
+    hash_object.update(repr((
+        landcover_ds.GetGeoTransform(), landcover_ds.RasterYSize,
+        landcover_ds.RasterXSize, landcover_ds.GetProjection())).encode(
+            'utf-8'))
+    landcover_ds = None
+    hash_object.update(repr(parameter_list).encode('utf-8'))
+    return hash_object.hexdigest()
+
+
+def _factor_cache_fetch(cache_dir, cache_key, out_uri):
+    """Copy a cached factor raster to `out_uri` if it exists.
+
+    Args:
+        cache_dir (str): path to the cache directory
+        cache_key (str): key from `_factor_cache_key`
+        out_uri (str): path to copy the cached raster to
+
+    Returns:
+        True if the raster was cached and copied, False otherwise.
+    """
+    cache_uri = os.path.join(cache_dir, cache_key + '.tif')
+    if not os.path.exists(cache_uri):
+        return False
+    shutil.copyfile(cache_uri, out_uri)
+    # the modified time orders the cache for eviction
+    os.utime(cache_uri, None)
+    return True
+
+
+def _factor_cache_store(cache_dir, cache_key, factor_raster_uri, max_bytes):
+    """Add a factor raster to the cache and evict the oldest entries.
+
+    Args:
+        cache_dir (str): path to the cache directory, created if needed
+        cache_key (str): key from `_factor_cache_key`
+        factor_raster_uri (str): path to the raster to cache
+        max_bytes (int): the least recently used rasters are removed until
+            the cache is no larger than this
+    """
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    cache_uri = os.path.join(cache_dir, cache_key + '.tif')
+    # copy then rename so a failed copy never leaves a partial entry
+    shutil.copyfile(factor_raster_uri, cache_uri + '.tmp')
+    if os.path.exists(cache_uri):
+        os.remove(cache_uri)
+    os.rename(cache_uri + '.tmp', cache_uri)
+
+    cache_entries = [
+        (os.path.getmtime(entry_uri), os.path.getsize(entry_uri), entry_uri)
+        for entry_uri in glob.glob(os.path.join(cache_dir, '*.tif'))]
+    cache_entries.sort()
+    cache_bytes = sum(entry[1] for entry in cache_entries)
+    for _, entry_bytes, entry_uri in cache_entries:
+        if cache_bytes <= max_bytes:
+            break
+        LOGGER.debug("Evicting %s from the factor cache.", entry_uri)
+        os.remove(entry_uri)
+        cache_bytes -= entry_bytes
+
+
+def _round_half_away_from_zero(array):
+    """Round an array the same way as the Python 2 builtin `round`.
+
+    Args:
+        array (np.array): values to round
+
+    Returns:
+        float np.array of `array` rounded to the nearest integer with halves
+        rounded away from zero.
+    """
+    return np.where(
+        array >= 0, np.floor(array + 0.5), np.ceil(array - 0.5))
+
 
 def calculate_weights(array, rounding=4):
     """Create list of priority weights by land-cover class.
@@ -110,53 +577,96 @@ def calculate_priority(priority_table_uri):
     return dict(zip(cover_id_list, calculate_weights(matrix, 4)))
 
 
-def calculate_distance_raster_uri(dataset_in_uri, dataset_out_uri):
-    """Calculate distance to non-zero cell for all input zero-value cells.
+def calculate_distance_suitability_uri(
+        dataset_in_uri, distance, distance_scale, distance_nodata,
+        suitability_nodata, suitability_out_uri, suitability_dtype,
+        distance_out_uri=None):
+    """Calculate a suitability score from the distance to non-zero cells.
+
+    Fuses the steps after the distance transform: the pixel distances are
+    scaled to meters, distances beyond `distance` are set to nodata and the
+    remaining distances are normalized so the nearest cells score
+    `distance_scale` and the farthest score 1.  The distance raster is
+    reduced once for its min and max and then the outputs are written in a
+    single blockwise pass, with no other intermediate rasters.
 
     Args:
         dataset_in_uri (str): the input mask raster. Distances calculated from
             the non-zero cells in raster.
-        dataset_out_uri (str): the output raster where all zero values are
-            equal to the euclidean distance of the closest non-zero pixel.
-    """
-    LOGGER.info("Creating euclidean distance raster...")
+        distance (float): maximum distance in meters to score
+        distance_scale (int): score of the cells nearest to the non-zero
+            cells
+        distance_nodata (float): nodata value of the outputs
+        suitability_nodata (int): value of `suitability_out_uri` farther than
+            `distance` or where the distance is undefined
+        suitability_out_uri (str): output suitability raster with nodata
+            `distance_nodata`
+        suitability_dtype (int): gdal type of `suitability_out_uri`
+        distance_out_uri (str): (optional) output Float32 raster of the
+            distance in meters up to `distance`, nodata elsewhere.  Not
+            written if None.
 
-    # Compute pixel distance
-    geoprocess.distance_transform_edt(dataset_in_uri, dataset_out_uri)
-
-    # Convert to meters
-    def pixel_to_meters_op(x):
-        x[x != nodata] *= cell_size
-        return x
+    Returns:
+        minimum (float): smallest distance within `distance`
+        maximum (float): largest distance within `distance`
+    """
+    LOGGER.info("Creating euclidean distance suitability raster...")
 
+    edt_uri = geoprocess.temporary_filename()
+    geoprocess.distance_transform_edt(dataset_in_uri, edt_uri)
+    edt_nodata = geoprocess.get_nodata_from_uri(edt_uri)
     cell_size = geoprocess.get_cell_size_from_uri(dataset_in_uri)
-    nodata = geoprocess.get_nodata_from_uri(dataset_out_uri)
-    tmp = geoprocess.temporary_filename()
-    geoprocess.vectorize_datasets(
-        [dataset_out_uri],
-        pixel_to_meters_op,
-        tmp,
-        gdal.GDT_Float64,
-        nodata,
-        cell_size,
-        'union',
-        vectorize_op=False)
-
-    def identity_op(x):
-        return x
 
-    geoprocess.vectorize_datasets(
-        [tmp],
-        identity_op,
-        dataset_out_uri,
-        gdal.GDT_Float64,
-        nodata,
-        cell_size,
-        'union',
-        vectorize_op=False)
-
-    # Compute raster stats so the raster is viewable in QGIS and Arc
-    geoprocess.calculate_raster_stats_uri(dataset_out_uri)
+    def _valid_distance(edt_block):
+        """Distance in meters and mask of the cells within `distance`."""
+        meters_block = edt_block.astype(np.float64) * cell_size
+        valid_mask = (edt_block != edt_nodata) & (meters_block <= distance)
+        return meters_block, valid_mask
+
+    minimum = None
+    maximum = None
+    for _, edt_block in geoprocess.iterblocks(edt_uri):
+        meters_block, valid_mask = _valid_distance(edt_block)
+        if valid_mask.any():
+            block_min = meters_block[valid_mask].min()
+            block_max = meters_block[valid_mask].max()
+            minimum = block_min if minimum is None else min(minimum, block_min)
+            maximum = block_max if maximum is None else max(maximum, block_max)
+
+    if distance_out_uri is not None:
+        geoprocess.new_raster_from_base_uri(
+            edt_uri, distance_out_uri, "GTiff", distance_nodata,
+            gdal.GDT_Float32, dataset_options=gtiff_creation_options(
+                'intermediate', gdal.GDT_Float32))
+        distance_ds = gdal.Open(distance_out_uri, gdal.GA_Update)
+        distance_band = distance_ds.GetRasterBand(1)
+    geoprocess.new_raster_from_base_uri(
+        edt_uri, suitability_out_uri, "GTiff", distance_nodata,
+        suitability_dtype, dataset_options=gtiff_creation_options(
+            'intermediate', suitability_dtype))
+    suitability_ds = gdal.Open(suitability_out_uri, gdal.GA_Update)
+    suitability_band = suitability_ds.GetRasterBand(1)
+    for block_info, edt_block in geoprocess.iterblocks(edt_uri):
+        meters_block, valid_mask = _valid_distance(edt_block)
+        if distance_out_uri is not None:
+            distance_band.WriteArray(
+                np.where(valid_mask, meters_block, distance_nodata),
+                xoff=block_info['xoff'], yoff=block_info['yoff'])
+        suitability_band.WriteArray(
+            _distance_score(
+                meters_block, valid_mask, minimum, maximum, distance_scale,
+                suitability_nodata),
+            xoff=block_info['xoff'], yoff=block_info['yoff'])
+
+    if distance_out_uri is not None:
+        distance_band.FlushCache()
+        distance_band = None
+        distance_ds = None
+    suitability_band.FlushCache()
+    suitability_band = None
+    suitability_ds = None
+    os.remove(edt_uri)
+    return minimum, maximum
 
 
 def get_geometry_type_from_uri(datasource_uri):
@@ -175,11 +685,118 @@ def get_geometry_type_from_uri(datasource_uri):
     return shape_type
 
 
+def _transition_matrix_from_uri(dataset_uri_list):
+    """Cross tabulate aligned lulc rasters in a single blockwise pass.
+
+    Each block is read once from every raster.  Pixel values are encoded as
+    indexes into a sorted table of the codes seen so far, consecutive pairs
+    are encoded as `orig_index * n_codes + dest_index` and everything is
+    counted with `np.bincount`.  The table only grows when a block contains
+    a new code, in which case the counts are remapped onto the larger table.
+
+    Args:
+        dataset_uri_list (list): list of paths to rasters of the same size.
+            Nodata pixels in every raster are counted as the nodata value of
+            the first raster.
+
+    Returns:
+        codes (np.array): sorted 1D array of every code found, including the
+            nodata value of the first raster if any pixel is nodata.
+        histograms (np.array): int64 array of shape (n_rasters, n_codes),
+            the count of each code in each raster excluding its nodata
+            pixels.
+        transition_matrix (np.array): int64 array of shape
+            (n_rasters - 1, n_codes, n_codes) where
+            `transition_matrix[i, a, b]` is the number of pixels that are
+            `codes[a]` in raster i and `codes[b]` in raster i + 1.
+
+    Raises:
+        ValueError: if the rasters have more than `_MAX_TRANSITION_CODES`
+            distinct codes.
+    """
+    n_rasters = len(dataset_uri_list)
+    lulc_nodata = geoprocess.get_nodata_from_uri(dataset_uri_list[0])
+    n_rows, n_cols = geoprocess.get_row_col_from_uri(dataset_uri_list[0])
+    dataset_list = []
+    band_list = []
+    nodata_list = []
+    for dataset_uri in dataset_uri_list:
+        if geoprocess.get_row_col_from_uri(dataset_uri) != (n_rows, n_cols):
+            raise ValueError(
+                "%s is not the same size as %s." % (
+                    dataset_uri, dataset_uri_list[0]))
+        dataset_list.append(gdal.Open(dataset_uri))
+        band_list.append(dataset_list[-1].GetRasterBand(1))
+        nodata_list.append(band_list[-1].GetNoDataValue())
+
+    codes = np.empty(0, dtype=np.int64)
+    histograms = np.zeros((n_rasters, 0), dtype=np.int64)
+    transition_matrix = np.zeros((n_rasters - 1, 0, 0), dtype=np.int64)
+    for block_info, _ in geoprocess.iterblocks(dataset_uri_list[0]):
+        block_list = []
+        valid_mask_list = []
+        for band, nodata in zip(band_list, nodata_list):
+            block = band.ReadAsArray(
+                xoff=block_info['xoff'], yoff=block_info['yoff'],
+                win_xsize=block_info['win_xsize'],
+                win_ysize=block_info['win_ysize']).astype(np.int64).ravel()
+            if nodata is not None:
+                valid_mask = block != int(nodata)
+                if lulc_nodata is not None:
+                    block[~valid_mask] = int(lulc_nodata)
+            else:
+                valid_mask = np.ones(block.shape, dtype=np.bool)
+            block_list.append(block)
+            valid_mask_list.append(valid_mask)
+
+        new_codes = np.setdiff1d(np.concatenate(block_list), codes)
+        if new_codes.size > 0:
+            # remap the counts so far onto the larger code table
+            all_codes = np.union1d(codes, new_codes)
+            if all_codes.size > _MAX_TRANSITION_CODES:
+                raise ValueError(
+                    "Too many LULC codes: found more than %i distinct values "
+                    "in %s." % (
+                        _MAX_TRANSITION_CODES, ", ".join(dataset_uri_list)))
+            old_index = np.searchsorted(all_codes, codes)
+            new_histograms = np.zeros(
+                (n_rasters, all_codes.size), dtype=np.int64)
+            new_histograms[:, old_index] = histograms
+            new_transition_matrix = np.zeros(
+                (n_rasters - 1, all_codes.size, all_codes.size),
+                dtype=np.int64)
+            new_transition_matrix[
+                :, old_index[:, np.newaxis], old_index] = transition_matrix
+            codes = all_codes
+            histograms = new_histograms
+            transition_matrix = new_transition_matrix
+
+        n_codes = codes.size
+        index_list = [np.searchsorted(codes, block) for block in block_list]
+        for raster_index, (code_index, valid_mask) in enumerate(
+                zip(index_list, valid_mask_list)):
+            histograms[raster_index] += np.bincount(
+                code_index[valid_mask], minlength=n_codes)
+        for pair_index in range(n_rasters - 1):
+            pair_code = (
+                index_list[pair_index] * n_codes +
+                index_list[pair_index + 1])
+            transition_matrix[pair_index] += np.bincount(
+                pair_code, minlength=n_codes * n_codes).reshape(
+                    n_codes, n_codes)
+
+    band_list = None
+    dataset_list = None
+    return codes, histograms, transition_matrix
+
+
 def get_transition_pairs_count_from_uri(dataset_uri_list):
     """Find transition summary statistics between lulc rasters.
 
+    The rasters are read once, see `_transition_matrix_from_uri`.
+
     Args:
-        dataset_uri_list (list): list of paths to rasters
+        dataset_uri_list (list): list of paths to rasters of the same size
 
     Returns:
         unique_raster_values_count (dict): cell type with each raster value
@@ -188,100 +805,28 @@ def get_transition_pairs_count_from_uri(dataset_uri_list):
     LOGGER.info("Finding transition summary statistics between original"
                 " and scenario land-cover rasters...")
 
-    cell_size = geoprocess.get_cell_size_from_uri(dataset_uri_list[0])
-    lulc_nodata = int(geoprocess.get_nodata_from_uri(dataset_uri_list[0]))
-    nodata = 0
+    codes, histograms, transition_matrix = _transition_matrix_from_uri(
+        dataset_uri_list)
+    code_list = [int(code) for code in codes]
 
-    # reclass rasters to compact bit space
-    lulc_codes = set()
     unique_raster_values_count = {}
-
-    for dataset_uri in dataset_uri_list:
-        unique_raster_values_count[dataset_uri] = \
-            geoprocess.unique_raster_values_count(dataset_uri)
-        lulc_codes.update(unique_raster_values_count[dataset_uri].keys())
-
-    lulc_codes = list(lulc_codes)
-    lulc_codes.sort()
-
-    if len(lulc_codes) < 2 ** 8:
-        data_type = gdal.GDT_UInt16
-        shift = 8
-    elif len(lulc_codes) < 2 ** 16:
-        data_type = gdal.GDT_UInt32
-        shift = 16
-    else:
-        raise ValueError("Too many LULC codes.")
-
-    # renumber and reclass rasters
-    reclass_orig_dict = dict(zip(lulc_codes, range(1, len(lulc_codes) + 1)))
-
-    reclass_dest_dict = {}
-    for key in reclass_orig_dict:
-        reclass_dest_dict[key] = reclass_orig_dict[key] << shift
-
-    def add_op(orig, dest):
-        return orig + dest
-
-    counts = {}
-    for i in range(len(dataset_uri_list) - 1):
-        orig_uri = geoprocess.temporary_filename()
-        dest_uri = geoprocess.temporary_filename()
-        multi_uri = geoprocess.temporary_filename()
-
-        # reclass orig values
-        geoprocess.reclassify_dataset_uri(
-            dataset_uri_list[i],
-            reclass_orig_dict,
-            orig_uri,
-            data_type,
-            nodata,
-            exception_flag="values_required")
-
-        # reclass dest values
-        geoprocess.reclassify_dataset_uri(
-            dataset_uri_list[i+1],
-            reclass_dest_dict,
-            dest_uri,
-            data_type,
-            nodata,
-            exception_flag="values_required")
-
-        # multiplex orig with dest
-        geoprocess.vectorize_datasets(
-            [orig_uri, dest_uri],
-            add_op,
-            multi_uri,
-            data_type,
-            nodata,
-            cell_size,
-            "union")
-
-        # get unique counts
-        counts[i] = geoprocess.unique_raster_values_count(multi_uri, False)
-
-    restore_classes = {}
-    for key in reclass_orig_dict:
-        restore_classes[reclass_orig_dict[key]] = key
-    restore_classes[nodata] = lulc_nodata
+    for dataset_uri, histogram in zip(dataset_uri_list, histograms):
+        unique_raster_values_count[dataset_uri] = dict(
+            (code, int(count)) for code, count in zip(code_list, histogram)
+            if count > 0)
 
     LOGGER.debug("Decoding transition table.")
     transitions = {}
-    for key in counts:
+    for key in range(len(dataset_uri_list) - 1):
         transitions[key] = {}
-        for k in counts[key]:
-            try:
-                orig = restore_classes[k % (2 ** shift)]
-            except KeyError:
-                orig = lulc_nodata
-            try:
-                dest = restore_classes[k >> shift]
-            except KeyError:
-                dest = lulc_nodata
-            try:
-                transitions[key][orig][dest] = counts[key][k]
-            except KeyError:
-                transitions[key][orig] = {dest: counts[key][k]}
+        for orig_index, dest_index in zip(
+                *np.nonzero(transition_matrix[key])):
+            orig = code_list[orig_index]
+            dest = code_list[dest_index]
+            if orig not in transitions[key]:
+                transitions[key][orig] = {}
+            transitions[key][orig][dest] = int(
+                transition_matrix[key, orig_index, dest_index])
 
     return unique_raster_values_count, transitions
 
@@ -463,9 +1008,137 @@ def generate_chart_html(cover_dict, cover_names_dict, workspace_dir):
     return html
 
 
+def _label_strip_fragments(strip_array, nodata=None):
+    """Label the 4-connected fragments of equal non-zero value in an array.
+
+    All values are labeled at once by finding the connected components of a
+    graph whose edges join neighboring pixels of the same value.
+
+    Args:
+        strip_array (np.array): 2D array of suitability values, 0 is
+            ignored.
+        nodata (number): nodata value of `strip_array`, also ignored if not
+            None.
+
+    Returns:
+        labels (np.array): int64 array the same shape as `strip_array` of
+            fragment labels from 0 to n_labels - 1, -1 where `strip_array`
+            is 0 or `nodata`.
+        n_labels (int): number of fragments in `strip_array`
+    """
+    valid_mask = strip_array != 0
+    if nodata is not None:
+        valid_mask &= strip_array != nodata
+    n_valid = np.count_nonzero(valid_mask)
+    labels = np.empty(strip_array.shape, dtype=np.int64)
+    labels[:] = -1
+    if n_valid == 0:
+        return labels, 0
+
+    # graph nodes are the valid pixels in row major order
+    node_index = np.cumsum(valid_mask).reshape(strip_array.shape) - 1
+    same_as_right = (
+        valid_mask[:, :-1] & (strip_array[:, :-1] == strip_array[:, 1:]) &
+        valid_mask[:, 1:])
+    same_as_below = (
+        valid_mask[:-1, :] & (strip_array[:-1, :] == strip_array[1:, :]) &
+        valid_mask[1:, :])
+    edge_start = np.concatenate((
+        node_index[:, :-1][same_as_right], node_index[:-1, :][same_as_below]))
+    edge_end = np.concatenate((
+        node_index[:, 1:][same_as_right], node_index[1:, :][same_as_below]))
+    graph = sp.sparse.coo_matrix(
+        (np.ones(edge_start.size, dtype=np.int8), (edge_start, edge_end)),
+        shape=(n_valid, n_valid))
+    n_labels, node_labels = sp.sparse.csgraph.connected_components(
+        graph, directed=False)
+    labels[valid_mask] = node_labels
+    return labels, n_labels
+
+
+def _select_patch_pixels(suitability_array, count, nodata=None):
+    """Select up to `count` pixels to convert in patches of suitability.
+
+    Patches are 4-connected regions of equal non-zero suitability and are
+    converted whole, from the highest suitability to the lowest and in
+    random order within a suitability score, until the next patch would
+    exceed `count`.  That patch is partially converted starting with the
+    pixels closest to its edge.
+
+    All patches are labeled at once and the patches to convert are found
+    with a cumulative sum of the ordered patch sizes.
+
+    Args:
+        suitability_array (np.array): 2D array of suitability scores between
+            0 and 100, 0 is never converted.
+        count (int): number of pixels to convert
+        nodata (number): nodata value of `suitability_array`, never
+            converted if not None.
+
+    Returns:
+        change_mask (np.array): boolean array the same shape as
+            `suitability_array` that is True for the pixels to convert
+        pixels_changed (int): number of True pixels in `change_mask`
+    """
+    change_mask = np.zeros(suitability_array.shape, dtype=np.bool)
+    patch_labels, n_patches = _label_strip_fragments(
+        suitability_array, nodata)
+    if n_patches == 0 or count <= 0:
+        return change_mask, 0
+
+    valid_mask = patch_labels >= 0
+    valid_labels = patch_labels[valid_mask]
+    valid_scores = suitability_array[valid_mask]
+    patch_sizes = np.bincount(valid_labels, minlength=n_patches)
+    patch_scores = np.empty(n_patches, dtype=valid_scores.dtype)
+    patch_scores[valid_labels] = valid_scores
+
+    # highest score first, randomize patch order within a score
+    patch_order = np.lexsort((
+        np.random.permutation(n_patches), -patch_scores.astype(np.float64)))
+    converted_sizes = np.cumsum(patch_sizes[patch_order])
+    n_whole_patches = np.searchsorted(converted_sizes, count, side='right')
+    # Check if suitsbility is between 0 and 100 inclusive for the patches
+    # that are converted, wholly or partially
+    for suitability_score in patch_scores[patch_order[:n_whole_patches+1]]:
+        assert abs(suitability_score - 50) <= 50, \
+            'Invalid suitability score ' + str(suitability_score)
+    convert_patch_mask = np.zeros(n_patches, dtype=np.bool)
+    convert_patch_mask[patch_order[:n_whole_patches]] = True
+    change_mask[valid_mask] = convert_patch_mask[valid_labels]
+    pixels_changed = (
+        int(converted_sizes[n_whole_patches-1]) if n_whole_patches > 0 else 0)
+
+    if pixels_changed < count and n_whole_patches < n_patches:
+        # partially convert the next patch, pixels nearest its edge first
+        patch_rows, patch_cols = np.nonzero(
+            patch_labels == patch_order[n_whole_patches])
+        row_start, col_start = patch_rows.min(), patch_cols.min()
+        patch_mask = np.zeros(
+            (patch_rows.max() - row_start + 1,
+             patch_cols.max() - col_start + 1), dtype=np.int8)
+        patch_mask[patch_rows - row_start, patch_cols - col_start] = 1
+        edge_distance = sp.ndimage.morphology.distance_transform_edt(
+            patch_mask)[patch_rows - row_start, patch_cols - col_start]
+        pixel_order = np.argsort(edge_distance, kind='mergesort')[
+            :int(count - pixels_changed)]
+        change_mask[patch_rows[pixel_order], patch_cols[pixel_order]] = True
+        pixels_changed += pixel_order.size
+
+    return change_mask, pixels_changed
+
+
 def filter_fragments(input_uri, size, output_uri):
     """Filter fragments.
 
+    Removes (sets to 0) every 4-connected fragment of equal non-zero value
+    with at most `size` pixels, nodata pixels are left as they are.  The
+    raster is streamed in strips of rows: the first pass labels each strip,
+    saving the labels to a temporary memory mapped file, and joins fragments
+    that continue across strip edges.  The second pass clears the small
+    fragments with one lookup per strip, so the raster never has to fit in
+    memory.
+
     Args:
         input_uri (str): path to input raster
         size (float): patch (/fragments?) size threshold
@@ -477,58 +1150,92 @@ def filter_fragments(input_uri, size, output_uri):
     # clump and sieve
     src_ds = gdal.Open(input_uri)
     src_band = src_ds.GetRasterBand(1)
-    src_array = src_band.ReadAsArray()
-
-    driver = gdal.GetDriverByName("GTiff")
-    driver.CreateCopy(output_uri, src_ds, 0)
-
-    dst_ds = gdal.Open(output_uri, 1)
-    dst_band = dst_ds.GetRasterBand(1)
-    dst_array = np.copy(src_array)
-
-    suitability_values = np.unique(src_array)
-    if suitability_values[0] == 0:
-        suitability_values = suitability_values[1:]
-
-    # 8 connectedness preferred, 4 connectedness allowed
-    eight_connectedness = np.array([[1, 1, 1], [1, 1, 1], [1, 1, 1]])
-    four_connectedness = np.array([[0, 1, 0], [1, 1, 1], [0, 1, 0]])
-
-    suitability_values_count = suitability_values.size
-    for v in range(1, suitability_values_count):
-        LOGGER.debug('Processing suitability value ' + str(
-            suitability_values.size - v))
-        value = suitability_values[v]
-        # Pixels of interest set to 1, 0 otherwise
-        mask = src_array == value
-        # Number of pixels to process
-        ones_in_mask = np.sum(mask)
-        # Label and count disconnected components (fragments)
-        label_im, nb_labels = sp.ndimage.label(mask, four_connectedness)
-        # Compute fragment sizes
-        fragment_sizes = sp.ndimage.sum(mask, label_im, range(nb_labels + 1))
-        # List fragments
-        fragment_labels = np.array(range(nb_labels + 1))
-        # Discard large fragments
-        small_fragment_mask = np.where(fragment_sizes <= size)
-        # Gather small fragment information
-        small_fragment_sizes = fragment_sizes[small_fragment_mask]
-        small_fragment_labels = fragment_labels[small_fragment_mask]
-        combined_small_fragment_size = np.sum(small_fragment_sizes)
-        # Find each fragment
-        fragments_location = sp.ndimage.find_objects(label_im, nb_labels)
-        removed_pixels = 0
-        small_fragment_labels_count = small_fragment_labels.size
-        for l in range(small_fragment_labels_count-1):
-            label = small_fragment_labels[l+1]
-            last_label = small_fragment_labels[l]
-            size = small_fragment_sizes[l+1]
-            source = label_im[fragments_location[last_label]]
-            target = dst_array[fragments_location[last_label]]
-            pixels_to_remove = np.where(source == label)
-            target[pixels_to_remove] = 0
-
-    dst_band.WriteArray(dst_array)
+    n_rows = src_band.YSize
+    n_cols = src_band.XSize
+    nodata = src_band.GetNoDataValue()
+    strip_rows = max(_FRAGMENT_STRIP_SIZE // n_cols, 1)
+
+    label_file = tempfile.NamedTemporaryFile(delete=False)
+    label_file.close()
+    label_array = np.memmap(
+        label_file.name, dtype=np.int64, mode='w+', shape=(n_rows, n_cols))
+
+    try:
+        fragment_sizes_list = []
+        stitch_start_list = []
+        stitch_end_list = []
+        n_fragments = 0
+        last_row_values = None
+        last_row_labels = None
+        for row_start in range(0, n_rows, strip_rows):
+            win_ysize = min(strip_rows, n_rows - row_start)
+            strip_array = src_band.ReadAsArray(
+                xoff=0, yoff=row_start, win_xsize=n_cols,
+                win_ysize=win_ysize)
+            strip_labels, n_strip_labels = _label_strip_fragments(
+                strip_array, nodata)
+            valid_mask = strip_labels >= 0
+            strip_labels[valid_mask] += n_fragments
+            fragment_sizes_list.append(np.bincount(
+                strip_labels[valid_mask] - n_fragments,
+                minlength=n_strip_labels))
+            n_fragments += n_strip_labels
+
+            # fragments continuing from the strip above are joined later
+            if last_row_values is not None:
+                join_mask = (
+                    (last_row_labels >= 0) &
+                    (last_row_values == strip_array[0]))
+                stitch_start_list.append(last_row_labels[join_mask])
+                stitch_end_list.append(strip_labels[0][join_mask])
+            last_row_values = strip_array[-1].copy()
+            last_row_labels = strip_labels[-1].copy()
+            label_array[row_start:row_start+win_ysize] = strip_labels
+
+        # resolve fragments joined across strips to a single root
+        fragment_sizes = np.concatenate(
+            fragment_sizes_list + [np.empty(0, dtype=np.int64)])
+        if stitch_start_list:
+            stitch_start = np.concatenate(stitch_start_list)
+            stitch_end = np.concatenate(stitch_end_list)
+        else:
+            stitch_start = stitch_end = np.empty(0, dtype=np.int64)
+        stitch_graph = sp.sparse.coo_matrix(
+            (np.ones(stitch_start.size, dtype=np.int8),
+             (stitch_start, stitch_end)), shape=(n_fragments, n_fragments))
+        _, fragment_roots = sp.sparse.csgraph.connected_components(
+            stitch_graph, directed=False)
+        root_sizes = np.bincount(fragment_roots, weights=fragment_sizes)
+        small_fragment_mask = root_sizes[fragment_roots] <= size
+        LOGGER.debug(
+            "Removing %i of %i fragments.",
+            np.count_nonzero(root_sizes <= size), root_sizes.size)
+
+        driver = gdal.GetDriverByName("GTiff")
+        driver.CreateCopy(
+            output_uri, src_ds, 0, gtiff_creation_options(
+                'scratch', n_cols=n_cols, n_rows=n_rows))
+        dst_ds = gdal.Open(output_uri, 1)
+        dst_band = dst_ds.GetRasterBand(1)
+        for row_start in range(0, n_rows, strip_rows):
+            win_ysize = min(strip_rows, n_rows - row_start)
+            strip_array = src_band.ReadAsArray(
+                xoff=0, yoff=row_start, win_xsize=n_cols,
+                win_ysize=win_ysize)
+            # copy so no view of the memory map outlives it
+            strip_labels = np.array(
+                label_array[row_start:row_start+win_ysize])
+            remove_mask = strip_labels >= 0
+            remove_mask[remove_mask] = small_fragment_mask[
+                strip_labels[remove_mask]]
+            strip_array[remove_mask] = 0
+            dst_band.WriteArray(strip_array, xoff=0, yoff=row_start)
+        dst_band.FlushCache()
+        dst_band = None
+        dst_ds = None
+    finally:
+        del label_array
+        os.remove(label_file.name)
 
 
 def execute(args):
@@ -567,6 +1274,18 @@ def execute(args):
         override_field (str): shapefile field containing override value
         override_inclusion (int): the rasterization method
 
+        intermediate_precision (str): (optional) 'compact' (default) stores
+            each intermediate raster in the narrowest type that holds its
+            values and non-integer values as Float32, 'full' keeps
+            non-integer values as Float64.
+        factor_cache_dir (str): (optional) directory where calculated factor
+            rasters are cached between runs, defaults to a factor_cache
+            folder in the workspace.  Set to '' to disable the cache.
+        factor_cache_max_bytes (int): (optional) size limit of the factor
+            cache, defaults to `_FACTOR_CACHE_MAX_BYTES`
+        vectorize_threads (int): (optional) number of threads the final
+            suitability rasters are computed on, serial if not given
+
     Example Args::
 
         args = {
@@ -659,6 +1378,13 @@ def execute(args):
         args['suffix'])
 
     proximity_weight = float(args["proximity_weight"])
+    vectorize_threads = args.get("vectorize_threads")
+
+    precision = args.get("intermediate_precision", "compact")
+    if precision not in _INTERMEDIATE_FLOAT_TYPES:
+        raise ValueError(
+            "Unknown intermediate precision %s, expected one of %s." % (
+                precision, ", ".join(sorted(_INTERMEDIATE_FLOAT_TYPES))))
 
     # it might be better to just check if factors being used
     try:
@@ -684,17 +1410,19 @@ def execute(args):
     filter_name = file_registry['filter_name']
     factors_name = file_registry['factors_name']
     cover_name = file_registry['cover_name']
-    proximity_name = file_registry['proximity_name']
     normalized_proximity_name = file_registry['normalized_proximity_name']
     adjusted_suitability_name = file_registry['adjusted_suitability_name']
 
     # Constants
     raster_format = "GTiff"
-    transition_dtype = gdal.GDT_Int16
     transition_nodata = -1
     change_nodata = -9999
-    suitability_dtype = gdal.GDT_Int16
     suitability_nodata = 0
+    # scores are integers from 0 to 100
+    transition_dtype = _narrowest_gdal_type(
+        transition_nodata, 100, True, precision)
+    suitability_dtype = _narrowest_gdal_type(
+        transition_nodata, 100, True, precision)
 
     # Value to multiply transition matrix entries
     #    (ie covert 10 point scale to 100 point scale)
@@ -704,11 +1432,7 @@ def execute(args):
     ds_type = "GTiff"
     driver = gdal.GetDriverByName(ds_type)
 
-    def suitability_op(trans, suit):
-        if trans == 0:
-            return 0
-        return round(((1 - physical_suitability_weight) * trans) +
-                     (physical_suitability_weight * suit))
+    suitability_op = _suitability_op(physical_suitability_weight)
 
     # Validate data
     if not any([args["calculate_transition"],
@@ -812,6 +1536,11 @@ def execute(args):
             args["suitability_id"])
         factor_uri_dict = {}
         factor_folder = args["suitability_folder"]
+        factor_cache_dir = args.get(
+            "factor_cache_dir", os.path.join(workspace, "factor_cache"))
+        factor_cache_max_bytes = int(args.get(
+            "factor_cache_max_bytes", _FACTOR_CACHE_MAX_BYTES))
+        landcover_hash = None
 
         if not args["factor_inclusion"]:
             option_list = ["ALL_TOUCHED=TRUE"]
@@ -843,7 +1572,46 @@ def execute(args):
                 shape_type = get_geometry_type_from_uri(factor_uri)
                 LOGGER.debug("Processing %s.", shapeTypes[shape_type])
 
-                if shape_type in [5, 15, 25, 31]:  # polygon
+                cache_key = None
+                cache_hit = False
+                if factor_cache_dir:
+                    parameter_list = [
+                        shape_type, suitability_field_name, distance,
+                        option_list, transition_nodata, transition_dtype,
+                        suitability_nodata, distance_scale, precision]
+                    if shape_type not in [5, 15, 25, 31]:
+                        # distances are masked by the landcover nodata
+                        if landcover_hash is None:
+                            hash_object = hashlib.sha1()
+                            _hash_file_list([landcover_uri], hash_object)
+                            landcover_hash = hash_object.hexdigest()
+                        parameter_list.append(landcover_hash)
+                    cache_key = _factor_cache_key(
+                        factor_uri, landcover_uri, parameter_list)
+                    if shape_type in [5, 15, 25, 31]:
+                        cached_uri = os.path.join(
+                            workspace, suitability_name % (
+                                factor_stem, suitability_field_name))
+                    else:
+                        cached_uri = os.path.join(
+                            workspace, normalized_name % (
+                                factor_stem, int(distance)))
+
+                    cache_hit = _factor_cache_fetch(
+                        factor_cache_dir, cache_key, cached_uri)
+
+                if cache_hit:
+                    LOGGER.info(
+                        "Using cached factor (%s, %s, %s).", factor_stem,
+                        suitability_field_name, distance)
+                    factor_uri_dict[(
+                        factor_stem, suitability_field_name, distance)] =\
+                        cached_uri
+                    if shape_type not in [5, 15, 25, 31]:
+                        # same side effect as the point or line branch
+                        option_list = ["ALL_TOUCHED=TRUE"]
+
+                elif shape_type in [5, 15, 25, 31]:  # polygon
                     LOGGER.info("Rasterizing %s using suitability field %s.",
                                 factor_stem, suitability_field_name)
                     ds_uri = os.path.join(workspace, suitability_name % (
@@ -852,14 +1620,18 @@ def execute(args):
                     burn_value = [1]
                     suitability_field = [
                         "ATTRIBUTE=%s" % suitability_field_name]
-                    gdal_format = gdal.GDT_Float64
+                    gdal_format = _rasterized_field_type(
+                        factor_uri, suitability_field_name, 0,
+                        transition_nodata, precision)
                     geoprocess.new_raster_from_base_uri(
                         landcover_uri,
                         ds_uri,
                         raster_format,
                         transition_nodata,
                         gdal_format,
-                        fill_value=0)
+                        fill_value=0,
+                        dataset_options=gtiff_creation_options(
+                            'scratch'))
                     geoprocess.rasterize_layer_uri(
                         ds_uri,
                         factor_uri,
@@ -879,12 +1651,6 @@ def execute(args):
                     ds_uri = os.path.join(
                         workspace, suitability_name %
                         (factor_stem, str(distance) + '_raw_raster'))
-                    distance_uri = os.path.join(
-                        workspace, suitability_name %
-                        (factor_stem, str(distance) + '_raw_distance'))
-                    fdistance_uri = os.path.join(
-                        workspace, suitability_name %
-                        (factor_stem, distance))
                     normalized_uri = os.path.join(
                         workspace, normalized_name %
                         (factor_stem, distance))
@@ -895,107 +1661,80 @@ def execute(args):
                         factor_stem, distance)
                     gdal_format = gdal.GDT_Byte
                     geoprocess.new_raster_from_base_uri(
-                        landcover_uri, ds_uri, raster_format, -1, gdal_format)
+                        landcover_uri, ds_uri, raster_format, -1, gdal_format,
+                        dataset_options=gtiff_creation_options(
+                            'scratch'))
 
                     landcover_nodata = geoprocess.get_nodata_from_uri(
                         landcover_uri)
                     ds_nodata = geoprocess.get_nodata_from_uri(ds_uri)
 
-                    geoprocess.vectorize_datasets(
+                    _vectorize_datasets(
                         [landcover_uri],
-                        lambda x: 0 if x != landcover_nodata else -1,
+                        _landcover_mask_op(landcover_nodata),
                         ds_uri,
                         gdal.GDT_Int16,
                         ds_nodata,
                         geoprocess.get_cell_size_from_uri(
                             ds_uri),
-                        'intersection')
+                        'intersection',
+                        calculate_stats=False)
 
                     geoprocess.rasterize_layer_uri(
                         ds_uri, factor_uri, burn_value, option_list)
 
-                    calculate_distance_raster_uri(ds_uri, distance_uri)
-
-                    def threshold(value):
-                        result = np.where(
-                            value > distance, transition_nodata, value)
-                        return np.where(
-                            value == transition_nodata,
-                            transition_nodata,
-                            result)
-
-                    geoprocess.vectorize_datasets(
-                        [distance_uri],
-                        threshold,
-                        fdistance_uri,
-                        gdal.GDT_Float32,
+                    calculate_distance_suitability_uri(
+                        ds_uri, distance, distance_scale, transition_nodata,
+                        suitability_nodata, normalized_uri, transition_dtype)
+
+                    factor_uri_dict[(
+                        factor_stem, suitability_field_name, distance)] =\
+                        normalized_uri
+                else:
+                    raise ValueError("Invalid geometry type %i." % shape_type)
+
+                if not cache_hit:
+                    # Apply nodata to the factors raster
+                    landcover_nodata = \
+                        geoprocess.get_nodata_from_uri(landcover_uri)
+                    temp_uri = geoprocess.temporary_filename()
+
+                    def apply_nodata_op(landcover, value):
+                        return np.where(landcover == landcover_uri, 0, value)
+
+                    _vectorize_datasets(
+                        [landcover_uri,
+                         factor_uri_dict[(
+                            factor_stem, suitability_field_name, distance)]],
+                        apply_nodata_op,
+                        temp_uri,
+                        transition_dtype,
                         transition_nodata,
                         cell_size,
                         "union",
-                        vectorize_op=False)
-
-                    geoprocess.calculate_raster_stats_uri(fdistance_uri)
-                    minimum, maximum, _, _ =\
-                        geoprocess.get_statistics_from_uri(fdistance_uri)
+                        vectorize_op=False,
+                        calculate_stats=False)
 
-                    def normalize_op(value):
-                        diff = float(maximum - minimum)
+                    def identity_op(x):
+                        return x
 
-                        return np.where(
-                            value == transition_nodata,
-                            suitability_nodata,
-                            ((distance_scale - 1) - (((value - minimum) /
-                             diff) * (distance_scale - 1))) + 1)
-
-                    geoprocess.vectorize_datasets(
-                        [fdistance_uri],
-                        normalize_op,
-                        normalized_uri,
+                    _vectorize_datasets(
+                        [temp_uri],
+                        identity_op,
+                        factor_uri_dict[(
+                            factor_stem, suitability_field_name, distance)],
                         transition_dtype,
                         transition_nodata,
                         cell_size,
                         "union",
                         vectorize_op=False)
 
-                    factor_uri_dict[(
-                        factor_stem, suitability_field_name, distance)] =\
-                        normalized_uri
-                else:
-                    raise ValueError("Invalid geometry type %i." % shape_type)
-
-                # Apply nodata to the factors raster
-                landcover_nodata = \
-                    geoprocess.get_nodata_from_uri(landcover_uri)
-                temp_uri = geoprocess.temporary_filename()
-
-                def apply_nodata_op(landcover, value):
-                    return np.where(landcover == landcover_uri, 0, value)
-
-                geoprocess.vectorize_datasets(
-                    [landcover_uri,
-                     factor_uri_dict[(
-                        factor_stem, suitability_field_name, distance)]],
-                    apply_nodata_op,
-                    temp_uri,
-                    transition_dtype,
-                    transition_nodata,
-                    cell_size,
-                    "union",
-                    vectorize_op=False)
-
-                def identity_op(x):
-                    return x
-
-                geoprocess.vectorize_datasets(
-                    [temp_uri],
-                    identity_op,
-                    factor_uri_dict[(
-                        factor_stem, suitability_field_name, distance)],
-                    transition_dtype,
-                    transition_nodata,
-                    cell_size,
-                    "union",
-                    vectorize_op=False)
+                    if cache_key is not None:
+                        _factor_cache_store(
+                            factor_cache_dir, cache_key, factor_uri_dict[(
+                                factor_stem, suitability_field_name,
+                                distance)],
+                            factor_cache_max_bytes)
 
             else:
                 LOGGER.debug("Skipping already processed suitability layer.")
@@ -1026,23 +1765,10 @@ def execute(args):
                 total = float(sum(weights_list))
                 weights_list = [weight / total for weight in weights_list]
 
-                def weighted_op(*values):
-                    result = (values[0] * weights_list[0]).astype(float)
-                    for v, w in zip(values[1:], weights_list[1:]):
-                        result += v * w
-                    return result
-
-                geoprocess.vectorize_datasets(
-                    list(uri_list),
-                    weighted_op,
-                    ds_uri,
-                    suitability_dtype,
-                    transition_nodata,
-                    cell_size,
-                    "union",
-                    vectorize_op=False)
-
-                suitability_factors_dict[cover_id] = ds_uri
+                # evaluated later in a single pass with the other steps
+                suitability_factors_dict[cover_id] = (
+                    ds_uri, _weighted_sum_op(weights_list),
+                    suitability_dtype, list(uri_list))
 
             else:
                 suitability_factors_dict[cover_id] = suitability_factors_dict[
@@ -1058,16 +1784,10 @@ def execute(args):
                         "Combining suitability for cover %i.", cover_id)
                     ds_uri = os.path.join(workspace, factors_name % cover_id)
 
-                    geoprocess.vectorize_datasets(
+                    suitability_dict[cover_id] = (
+                        ds_uri, suitability_op, transition_dtype,
                         [suitability_transition_dict[cover_id],
-                            suitability_factors_dict[cover_id]],
-                        suitability_op,
-                        ds_uri,
-                        transition_dtype,
-                        transition_nodata,
-                        cell_size,
-                        "union")
-                    suitability_dict[cover_id] = ds_uri
+                         suitability_factors_dict[cover_id]])
                 else:
                     suitability_dict[cover_id] = suitability_factors_dict[
                         cover_id]
@@ -1084,7 +1804,13 @@ def execute(args):
                                (cell_size ** 2)))
 
             output_uri = os.path.join(workspace, filter_name % cover_id)
-            filter_fragments(suitability_dict[cover_id], size, output_uri)
+            # the filter needs whole patches so the suitability so far has
+            # to be written out first
+            filter_fragments(
+                _materialize_recipe(
+                    suitability_dict[cover_id], transition_nodata, cell_size,
+                    process_pool=vectorize_threads),
+                size, output_uri)
             suitability_dict[cover_id] = output_uri
 
     # SHOULD BE OWN FUNCTION
@@ -1098,14 +1824,17 @@ def execute(args):
         option_list = ["ALL_TOUCHED=FALSE"]
         burn_value = [0]
         constraints_field = ["ATTRIBUTE=%s" % constraints_field_name]
-        gdal_format = gdal.GDT_Float64
+        gdal_format = _rasterized_field_type(
+            constraints_uri, constraints_field_name, 1, transition_nodata,
+            precision)
         geoprocess.new_raster_from_base_uri(
             landcover_uri,
             constraints_ds_uri,
             raster_format,
             transition_nodata,
             gdal_format,
-            fill_value=1)
+            fill_value=1,
+            dataset_options=gtiff_creation_options('scratch'))
         geoprocess.rasterize_layer_uri(
             constraints_ds_uri,
             constraints_uri,
@@ -1144,9 +1873,6 @@ def execute(args):
 
                 ds_uri = os.path.join(
                     workspace, cover_name % cover_id)
-                distance_uri = geoprocess.temporary_filename()
-                fdistance_uri = os.path.join(
-                    workspace, proximity_name % cover_id)
                 normalized_uri = os.path.join(
                     workspace, normalized_proximity_name % cover_id)
 
@@ -1158,69 +1884,23 @@ def execute(args):
                     transition_nodata,
                     exception_flag="values_required")
 
-                calculate_distance_raster_uri(ds_uri, distance_uri)
-
-                def threshold(value):
-                    if value > distance:
-                        return transition_nodata
-                    return value
-
-                geoprocess.vectorize_datasets(
-                    [distance_uri],
-                    threshold,
-                    fdistance_uri,
-                    gdal.GDT_Float32,
-                    transition_nodata,
-                    cell_size,
-                    "union")
-
-                minimum, maximum, _, _ = geoprocess.get_statistics_from_uri(
-                    fdistance_uri)
+                minimum, maximum = calculate_distance_suitability_uri(
+                    ds_uri, distance, distance_scale, transition_nodata,
+                    suitability_nodata, normalized_uri, transition_dtype)
 
                 assert minimum < maximum, "Wrong distance (min, max) = (" + \
-                    str(minimum) + ", " + str(maximum) + ") in " + \
-                    fdistance_uri
-
-                def normalize_op(value):
-                    if value == transition_nodata:
-                        return suitability_nodata
-                    else:
-                        return ((distance_scale - 1) -
-                                (((value - minimum) /
-                                 float(maximum - minimum)) *
-                                (distance_scale - 1))) + 1
-
-                geoprocess.vectorize_datasets(
-                    [fdistance_uri],
-                    normalize_op,
-                    normalized_uri,
-                    transition_dtype,
-                    transition_nodata,
-                    cell_size,
-                    "union")
+                    str(minimum) + ", " + str(maximum) + ") from " + \
+                    ds_uri
 
                 proximity_dict[cover_id] = normalized_uri
 
     def es_change_op(final_es, initial_es):
         return final_es - initial_es
 
-    def constraint_op(suit, cons):
-        return suit * cons
-
-    def proximity_op(suit, prox):
-        v = suit + (prox * proximity_weight)
-        if v > 100:
-            return 100
-        else:
-            return v
-
-    def constraint_proximity_op(suit, cons, prox):
-        v = (cons * suit) + (prox * proximity_weight)
-        if v > 100:
-            return 100
-        else:
-            return v
+    proximity_op = _proximity_op(proximity_weight)
+    constraint_proximity_op = _constraint_proximity_op(proximity_weight)
 
+    materialized_uris = []
     for cover_id in suitability_dict:
         suitability_uri = os.path.join(
             workspace, adjusted_suitability_name % cover_id)
@@ -1228,53 +1908,34 @@ def execute(args):
             if cover_id in proximity_dict:
                 LOGGER.info("Combining suitability, proximity, and constraints"
                             " for %i.", cover_id)
-
-                uri_list = [suitability_dict[cover_id],
-                            constraints_ds_uri,
-                            proximity_dict[cover_id]]
-                LOGGER.info("Vectorizing: %s", ", ".join(uri_list))
-                geoprocess.vectorize_datasets(
-                    uri_list,
-                    constraint_proximity_op,
-                    suitability_uri,
+                suitability_dict[cover_id] = (
+                    suitability_uri, constraint_proximity_op,
                     transition_dtype,
-                    transition_nodata,
-                    cell_size,
-                    "union")
-                suitability_dict[cover_id] = suitability_uri
+                    [suitability_dict[cover_id], constraints_ds_uri,
+                     proximity_dict[cover_id]])
 
             else:
                 LOGGER.info(
                     "Combining suitability and constraints for %i.", cover_id)
-
-                uri_list = [suitability_dict[cover_id],
-                            constraints_ds_uri]
-                LOGGER.info("Vectorizing: %s", ", ".join(uri_list))
-                geoprocess.vectorize_datasets(
-                    uri_list,
-                    constraint_op,
-                    suitability_uri,
-                    transition_dtype,
-                    transition_nodata,
-                    cell_size,
-                    "union")
-                suitability_dict[cover_id] = suitability_uri
+                suitability_dict[cover_id] = (
+                    suitability_uri, _constraint_op, transition_dtype,
+                    [suitability_dict[cover_id], constraints_ds_uri])
 
         elif cover_id in proximity_dict:
             LOGGER.info(
                 "Combining suitability and proximity for %i.", cover_id)
-            uri_list = [suitability_dict[cover_id],
-                        proximity_dict[cover_id]]
-            LOGGER.info("Vectorizing: %s", ", ".join(uri_list))
-            geoprocess.vectorize_datasets(
-                uri_list,
-                proximity_op,
-                suitability_uri,
-                transition_dtype,
-                transition_nodata,
-                cell_size,
-                "union")
-            suitability_dict[cover_id] = suitability_uri
+            suitability_dict[cover_id] = (
+                suitability_uri, proximity_op, transition_dtype,
+                [suitability_dict[cover_id], proximity_dict[cover_id]])
+
+        # write each cover's final suitability in one pass over its inputs;
+        # these are updated in place while pixels change so they stay
+        # uncompressed until then
+        if not isinstance(suitability_dict[cover_id], basestring):
+            suitability_dict[cover_id] = _materialize_recipe(
+                suitability_dict[cover_id], transition_nodata, cell_size,
+                creation_profile='scratch', process_pool=vectorize_threads)
+            materialized_uris.append(suitability_dict[cover_id])
 
     # normalize probabilities to be on a 10 point scale
     # probability raster (reclass using probability matrix)
@@ -1299,7 +1960,11 @@ def execute(args):
     n_cols = src_ds.RasterXSize
     n_rows = src_ds.RasterYSize
 
-    dst_ds = driver.CreateCopy(scenario_uri, src_ds, 0)
+    # scenario.tif is changed in place below, so it is only compressed once it
+    # is final
+    dst_ds = driver.CreateCopy(
+        scenario_uri, src_ds, 0, gtiff_creation_options(
+            'scratch', n_cols=n_cols, n_rows=n_rows))
     dst_ds = None
     src_ds = None
 
@@ -1374,109 +2039,13 @@ def execute(args):
         src_band = src_ds.GetRasterBand(1)
         src_array = src_band.ReadAsArray()
 
-        pixels_changed = 0
-        suitability_values = list(np.unique(src_array))
-        suitability_values.sort(reverse=True)
-        if suitability_values[-1] == 0:
-            suitability_values.pop(-1)
-        for suitability_score in suitability_values:
-            # Check if suitsbility is between 0 and 100 inclusive
-            if abs(suitability_score - 50) > 50:
-                print('suitability_values:', suitability_dict[cover_id])
-                for v in suitability_values:
-                    print(v, ' ')
-
-            assert abs(suitability_score - 50) <= 50, \
-                'Invalid suitability score ' + str(suitability_score)
-            if pixels_changed == count:
-                LOGGER.debug("All necessay pixels converted.")
-                break
-
-            LOGGER.debug(
-                "Checking pixels with suitability score of %i.",
-                suitability_score)
-
-            # mask out everything except the current suitability score
-            mask = src_array == suitability_score
-
-            # label patches
-            label_im, nb_labels = sp.ndimage.label(mask)
-
-            # get patch sizes
-            patch_sizes = sp.ndimage.sum(
-                mask, label_im, range(1, nb_labels + 1))
-            patch_labels = np.array(range(1, nb_labels + 1))
-            patch_locations = sp.ndimage.find_objects(label_im, nb_labels)
-
-            # randomize patch order
-            np.random.shuffle(patch_labels)
-
-            # check patches for conversion
-            patch_label_count = patch_labels.size
-            for l in range(patch_label_count):
-                label = patch_labels[l]
-                source = label_im[patch_locations[label-1]]
-                target = scenario_array[patch_locations[label-1]]
-                pixels_to_change = np.where(source == label)
-                assert pixels_to_change[0].size == patch_sizes[label-1]
-
-                if patch_sizes[label-1] + pixels_changed > count:
-                    # mask out everything except the current patch
-                    # patch = np.where(label_im == label)
-                    # patch_mask = np.zeros_like(scenario_array)
-                    patch_mask = np.zeros_like(target)
-                    # patch_mask[patch] = 1
-                    patch_mask[pixels_to_change] = 1
-
-                    # calculate the distance to exit the patch
-                    # tmp_array = sp.ndimage.morphology.distance_transform_edt(
-                    # patch_mask)
-                    tmp_array = sp.ndimage.morphology.distance_transform_edt(
-                        patch_mask)
-                    # tmp_array = tmp_array[patch]
-                    tmp_array = tmp_array[pixels_to_change]
-
-                    # select the number of pixels that need to be converted
-
-                    tmp_index = np.argsort(tmp_array)
-
-                    # NOTE Had to fix this so that slices such as below are cast as an int
-                    tmp_index = tmp_index[:int(count - pixels_changed)]
-
-                    # convert the selected pixels into coordinates
-                    # pixels_to_change = np.array(zip(patch[0], patch[1]))
-                    pixels_to_change = np.array(zip(
-                        pixels_to_change[0], pixels_to_change[1]))
-                    pixels_to_change = pixels_to_change[tmp_index]
-                    pixels_to_change = apply(zip, pixels_to_change)
-
-                    # change the pixels in the scenario
-                    # scenario_array[pixels_to_change] = cover_id
-                    target[pixels_to_change] = cover_id
-
-                    pixels_changed = count
-
-                    # alter other suitability rasters to prevent double
-                    # conversion
-                    for _, update_id, _ in change_list[index+1:]:
-                        # update_arrays[update_id][pixels_to_change] = 0
-                        target = update_arrays[
-                            update_id][patch_locations[label-1]]
-                        target[pixels_to_change] = 0
-
-                    break
+        change_mask, pixels_changed = _select_patch_pixels(
+            src_array, count, src_band.GetNoDataValue())
+        scenario_array[change_mask] = cover_id
 
-                else:
-                    # convert patch, increase count of changes
-                    target[pixels_to_change] = cover_id
-                    pixels_changed += patch_sizes[label-1]
-
-                    # alter other suitability rasters to prevent double
-                    # conversion
-                    for _, update_id, _ in change_list[index+1:]:
-                        target = update_arrays[
-                            update_id][patch_locations[label-1]]
-                        target[pixels_to_change] = 0
+        # alter other suitability rasters to prevent double conversion
+        for _, update_id, _ in change_list[index+1:]:
+            update_arrays[update_id][change_mask] = 0
 
         # report and record unchanged pixels
         if pixels_changed < count:
@@ -1494,6 +2063,8 @@ def execute(args):
     scenario_array = None
     scenario_band = None
     scenario_ds = None
+    for suitability_uri in materialized_uris:
+        compress_gtiff_uri(suitability_uri, 'intermediate')
 
     # THIS SHOULD BE OWN FUNCTION
     # apply override
@@ -1528,6 +2099,8 @@ def execute(args):
         datasource = None
         dataset = None
 
+    compress_gtiff_uri(scenario_uri, 'deliverable')
+
     # THIS SHOULD BE OWN FUNCTION
     LOGGER.info("Generating results...")
     # Tabulate coverages
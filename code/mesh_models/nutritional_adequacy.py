@@ -1,4 +1,4 @@
-import sys, os, logging, json, threading, time, platform, traceback, tempfile, locale, imp, errno, shutil, codecs, datetime, subprocess, math, random
+import sys, os, logging, json, threading, time, platform, traceback, tempfile, locale, imp, errno, shutil, codecs, datetime, subprocess, math, random, multiprocessing
 from collections import OrderedDict, deque
 from types import StringType
 
@@ -36,6 +36,34 @@ LOGGER = config.LOGGER
 LOGGER.setLevel(logging.INFO)
 ENCODING = sys.getfilesystemencoding()
 
+# Column of the nutritional content table used for each nutrient's production, in output order. Mg, Zn, K, Na and Cu
+# keep the columns the model has always read for them. Fat is not calculated.
+NUTRIENT_CONTENT_COLUMNS = OrderedDict([
+    ('Energy', 'Energy'),
+    ('Protein', 'Protein'),
+    ('VitA', 'VitA'),
+    ('VitC', 'VitC'),
+    ('VitE', 'VitE'),
+    ('Thiamin', 'Thiamin'),
+    ('Riboflavin', 'Riboflavin'),
+    ('Niacin', 'Niacin'),
+    ('VitB6', 'VitB6'),
+    ('Folate', 'Folate'),
+    ('VitB12', 'VitB12'),
+    ('Ca', 'Ca'),
+    ('Ph', 'Ph'),
+    ('Mg', 'Energy'),
+    ('K', 'Mg'),
+    ('Na', 'K'),
+    ('Fe', 'Fe'),
+    ('Zn', 'Energy'),
+    ('Cu', 'Zn'),
+])
+
+# Number of float64 values held in memory per window by _accumulate_nutrient_production, shared between the stacked
+# crop yields and the nutrient cube.
+NUTRIENT_WINDOW_VALUES = 2 ** 24
+
 def create_default_kw(calling_ui=None):
     if calling_ui:
         kw = generate_default_kw_from_ui(calling_ui)
@@ -81,25 +109,25 @@ def calc_caloric_production_from_lulc_uri(input_lulc_uri, ui=None, **kw):
     clipped_calories_per_5m_cell_uri = os.path.join(output_dir, 'clipped_calories_per_5m_cell.tif')
     calories_resampled_uri = os.path.join(output_dir, 'calories_per_ha_2000.tif')
 
-    # Get global 5m calories map from base data and project the full global map to projection of lulc, but keeping the global resolution
-    global_calories_per_cell_projected_uri  = os.path.join(output_dir, 'global_calories_per_cell_projected.tif')
+    # Get global 5m calories map from base data and project the part of it around the aoi to projection of lulc, but keeping
+    # the global resolution. The projected window is cached by source, projection, aoi bounds and cell size, so repeat runs
+    # and other scenarios over the same aoi reuse it.
+    derived_data_cache_dir = kw.get('derived_data_cache_dir', os.path.join(kw['model_base_data_dir'], 'derived_data_cache'))
     output_wkt = hb.get_dataset_projection_wkt_uri(input_lulc_uri)
 
     # Set cell size based on size at equator. Need to fully think this through.
     # cell_size = 111319.49079327358 * hb.get_cell_size_from_uri(global_calories_per_cell_uri)
     cell_size = hb.get_cell_size_from_uri(global_calories_per_cell_uri)
 
-    # Reproject the global calorie data into lulc projection
-    hb.reproject_dataset_uri(global_calories_per_cell_uri,
-                             cell_size,
-                             output_wkt,
-                             'bilinear',
-                             global_calories_per_cell_projected_uri)
+    # Reproject the global calorie data around the aoi into lulc projection
+    global_calories_per_cell_projected_uri = utilities.cached_reproject_window_uri(
+        global_calories_per_cell_uri, cell_size, output_wkt, 'bilinear', aoi_uri, derived_data_cache_dir)
 
-    # Clip the global data to the project aoi, but keep at 5 min for math summation reasons later
-    hb.clip_dataset_uri(
+    # Clip the global data to the project aoi, but keep at 5 min for math summation reasons later. Setting vectorize_threads
+    # reads and masks the blocks on that many threads.
+    utilities.clip_dataset_uri(
         global_calories_per_cell_projected_uri, aoi_uri, clipped_calories_per_5m_cell_uri,
-        assert_projections=True, process_pool=None)
+        assert_projections=True, process_pool=kw.get('vectorize_threads'))
 
     # Now that it's clipped, it's small enough to resample to lulc resolution
     hb.resize_and_resample_dataset_uri(clipped_calories_per_5m_cell_uri, hb.get_bounding_box(input_lulc_uri), hb.get_cell_size_from_uri(input_lulc_uri), calories_resampled_uri,
@@ -117,16 +145,10 @@ def calc_caloric_production_from_lulc_uri(input_lulc_uri, ui=None, **kw):
     # correct relative to each other.
     # This simplification means we are doing the equivilent to the invest crop model beacause
     # the cells to allocate are lower res than the target.
-    baseline_resampled_array = utilities.as_array(baseline_resampled_uri)
-    calories_resampled_array = utilities.as_array(calories_resampled_uri)
-    unscaled_calories_baseline = np.where(baseline_resampled_array == 12, calories_resampled_array, 0)
-    unscaled_calories_baseline = np.where(baseline_resampled_array== 14, 0.5 * calories_resampled_array, unscaled_calories_baseline)
-
-    # Do the same replacement for the scenario lulc
-    input_lulc_array = utilities.as_array(input_lulc_uri)
-    unscaled_calories_input_lulc = np.where(input_lulc_array == 12, calories_resampled_array, 0)
-    unscaled_calories_input_lulc = np.where(input_lulc_array == 14, 0.5 * calories_resampled_array, unscaled_calories_input_lulc)
-
+    # The share of each lulc class, and the country and scenario specific changes to them for the scenario lulc, come from
+    # the lulc calorie shares table. In the shipped table the countries give mosaic 0.35 and agroforestry 0.6, following
+    # Johan's suggested %, and ilm scenarios give oil palm 0.1 (rather than the oil palm cal per kg / avg crop cal per kg
+    # * ilm ratio improvement over trend, (8516/1295) * (3000/1800)).
     note = """In ilm 
         for both ghana and honduras,
         
@@ -140,47 +162,214 @@ def calc_caloric_production_from_lulc_uri(input_lulc_uri, ui=None, **kw):
         
         IDEA Use monfreda, subset out perrenial trees, to get yield of agroforestry
         """
+    lulc_calorie_shares_table_uri = kw.get('lulc_calorie_shares_table_uri', os.path.join(ui.root_app.default_setup_files_folder, 'lulc_calorie_shares.csv'))
+    baseline_shares, input_lulc_shares = load_lulc_calorie_shares(lulc_calorie_shares_table_uri, ui.root_app.project_folder, scenario_dir)
+    baseline_share_lookup = _compile_calorie_share_lookup(baseline_shares)
+    input_lulc_share_lookup = _compile_calorie_share_lookup(input_lulc_shares)
 
+    # The rasters are all on the lulc grid; work through them a window at a time rather than loading them whole.
+    baseline_resampled_raster = utilities.RasterArray(baseline_resampled_uri)
+    calories_resampled_raster = utilities.RasterArray(calories_resampled_uri)
+    input_lulc_raster = utilities.RasterArray(input_lulc_uri)
 
+    # Multiply the unscaled calories by this adjustment factor, which is the ratio between the actual calories present
+    # calculated from the 5 min resolution data, and the unscaled.
+    with utilities.RasterArray(clipped_calories_per_5m_cell_uri) as clipped_calories_per_5m_cell_raster:
+        n_calories_present = clipped_calories_per_5m_cell_raster.nansum()
+    n_unscaled_calories_in_baseline = 0.0
+    for window, calories_resampled_block in calories_resampled_raster.iterblocks():
+        n_unscaled_calories_in_baseline += np.nansum(_unscaled_calories(
+            baseline_resampled_raster.read(**window), calories_resampled_block, baseline_share_lookup))
+    adjustment_factor = n_calories_present / n_unscaled_calories_in_baseline
 
-    if 'Honduras' in ui.root_app.project_folder or 'Ghana' in ui.root_app.project_folder:
+    # Scale the scenario calories by the baseline adjustment factor
+    output_calories_uri = os.path.join(output_dir, 'caloric_production.tif')
+    ui.update_run_log('Creating caloric_production.tif')
+    # Float64 with save_array_as_geotiff's nodata for a data_type_override without a no_data_value_override.
+    output_calories_nodata = 9223372036854775807
+    output_calories_raster = utilities.RasterArray.create_like(
+        input_lulc_uri, output_calories_uri, gdal.GDT_Float64, output_calories_nodata)
+    total_calories = 0.0
+    for window, calories_resampled_block in calories_resampled_raster.iterblocks():
+        output_calories = _unscaled_calories(
+            input_lulc_raster.read(**window), calories_resampled_block, input_lulc_share_lookup) * adjustment_factor
+        total_calories += np.nansum(output_calories)
+        output_calories[np.isinf(output_calories)] = output_calories_nodata
+        output_calories_raster.write(output_calories, window['xoff'], window['yoff'])
+    for raster in [output_calories_raster, baseline_resampled_raster, calories_resampled_raster, input_lulc_raster]:
+        raster.close()
+
+    ui.update_run_log('Total calories: ' + str(total_calories))
+
+def _outputs_are_current(output_uri_list, input_uri_list):
+    """True if every output exists and none is older than any of the inputs."""
+    if not all(os.path.exists(uri) for uri in output_uri_list):
+        return False
+    return min(os.path.getmtime(uri) for uri in output_uri_list) >= max(os.path.getmtime(uri) for uri in input_uri_list)
+
+def _prepare_crop_yields(crop_preparation_args, n_workers=1):
+    """Run _prepare_crop_yield for each crop, yielding each crop's folder name as it finishes.
+
+    With n_workers greater than 1 the crops are prepared in a process pool of that many workers, never more than there
+    are crops. By default, or with a single worker, they are prepared in this process.
+    """
+    n_workers = max(min(int(n_workers), len(crop_preparation_args)), 1)
+    if n_workers == 1:
+        for args in crop_preparation_args:
+            yield _prepare_crop_yield(args)
+        return
+
+    pool = multiprocessing.Pool(n_workers)
+    try:
+        for folder_name in pool.imap_unordered(_prepare_crop_yield, crop_preparation_args):
+            yield folder_name
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def _prepare_crop_yield(args):
+    """Clip one crop's harvested area fraction and yield per ha to the aoi and compute its yield (tons) per cell.
+
+    Module-level so it can run in a process pool. Each worker process clips in its own scratch directory under
+    scratch_root, so the shapefile and raster intermediates of concurrent clips don't collide. The yield per cell is
+    written under a temporary name and renamed, so an interrupted run never leaves a partial output that looks current.
+    """
+    (folder_name, input_harvested_area_fraction_uri, clipped_harvested_area_fraction_uri, input_yield_tons_per_ha_uri,
+     clipped_yield_tons_per_ha_uri, yield_tons_per_cell_uri, aoi_uri, match_uri, lulc_uri, ha_per_cell, scratch_root,
+     vectorize_threads) = args
+    scratch_dir = os.path.join(scratch_root, str(os.getpid()))
+    if os.path.exists(yield_tons_per_cell_uri):
+        os.remove(yield_tons_per_cell_uri)
 
-        unscaled_calories_input_lulc = np.where(input_lulc_array == 12, calories_resampled_array, 0)
-        unscaled_calories_input_lulc = np.where(input_lulc_array == 14, 0.35 * calories_resampled_array, unscaled_calories_input_lulc)
+    # hb.clip_dataset_uri(input_harvested_area_fraction_uri, kw['aoi_uri'], clipped_harvested_area_fraction_uri)
+    utilities.clip_by_shape_with_buffered_intermediate_uri(input_harvested_area_fraction_uri, aoi_uri, clipped_harvested_area_fraction_uri, match_uri, resampling_method='bilinear', scratch_dir=scratch_dir, process_pool=vectorize_threads)
 
-        # CUSTOM calc in agroforestry  value following Johan's suggested %
-        unscaled_calories_input_lulc = np.where(input_lulc_array == 17, 0.6 * calories_resampled_array, unscaled_calories_input_lulc)
-        if 'ilm' in scenario_dir.lower():
-            avg_palm_cal_per_reg_cal = (8516/1295) * (3000/1800) # oil palm cal per kg/ avg crop calkg * (ilm ratio improvement over trend, which is assumed to be same as in earthstat.
-            avg_palm_cal_per_reg_cal = 0.1
-            unscaled_calories_input_lulc = np.where(input_lulc_array == 18, avg_palm_cal_per_reg_cal * calories_resampled_array, unscaled_calories_input_lulc)
+    # hb.clip_dataset_uri(input_yield_tons_per_ha_uri, kw['aoi_uri'], clipped_yield_tons_per_ha_uri)
+    utilities.clip_by_shape_with_buffered_intermediate_uri(input_yield_tons_per_ha_uri, aoi_uri, clipped_yield_tons_per_ha_uri, match_uri, resampling_method='bilinear', scratch_dir=scratch_dir, process_pool=vectorize_threads)
 
-    if 'Tanzania' in ui.root_app.project_folder or 'Ghana' in ui.root_app.project_folder:
+    nan1 = utilities.get_nodata_from_uri(input_harvested_area_fraction_uri)
+    nan2 = utilities.get_nodata_from_uri(input_yield_tons_per_ha_uri)
 
-        unscaled_calories_input_lulc = np.where(input_lulc_array == 12, calories_resampled_array, 0)
-        unscaled_calories_input_lulc = np.where(input_lulc_array == 14, 0.35 * calories_resampled_array, unscaled_calories_input_lulc)
+    # NOTE forcing ndv to zero for calcualtions
+    temporary_yield_tons_per_cell_uri = os.path.join(scratch_dir, os.path.basename(yield_tons_per_cell_uri))
+    with utilities.RasterArray(clipped_harvested_area_fraction_uri) as harvested_area_fraction_raster, \
+            utilities.RasterArray(clipped_yield_tons_per_ha_uri) as yield_tons_per_ha_raster, \
+            utilities.RasterArray.create_like(lulc_uri, temporary_yield_tons_per_cell_uri, gdal.GDT_Float64, 0) as yield_tons_per_cell_raster:
+        for window, yield_tons_per_ha_array in yield_tons_per_ha_raster.iterblocks():
+            harvested_area_fraction_array = harvested_area_fraction_raster.read(**window)
 
-        # CUSTOM calc in agroforestry  value following Johan's suggested %
-        unscaled_calories_input_lulc = np.where(input_lulc_array == 17, 0.6 * calories_resampled_array, unscaled_calories_input_lulc)
-        if 'ilm' in scenario_dir.lower():
-            avg_palm_cal_per_reg_cal = (8516/1295) * (3000/1800) # oil palm cal per kg/ avg crop calkg * (ilm ratio improvement over trend, which is assumed to be same as in earthstat.
-            avg_palm_cal_per_reg_cal = 0.1
-            unscaled_calories_input_lulc = np.where(input_lulc_array == 18, avg_palm_cal_per_reg_cal * calories_resampled_array, unscaled_calories_input_lulc)
+            nan_mask = np.where((yield_tons_per_ha_array == nan1) & (harvested_area_fraction_array == nan2))
 
-    # Multiply the unscaled calories by this adjustment factor, which is the ratio between the actual calories present
-    # calculated from the 5 min resolution data, and the unscaled.
-    clipped_calories_per_5m_cell_array = utilities.as_array(clipped_calories_per_5m_cell_uri)
-    n_calories_present = np.nansum(clipped_calories_per_5m_cell_array)
-    n_unscaled_calories_in_baseline = np.nansum(unscaled_calories_baseline)
-    adjustment_factor = n_calories_present / n_unscaled_calories_in_baseline
+            yield_tons_per_cell_array = yield_tons_per_ha_array * harvested_area_fraction_array * ha_per_cell
 
-    # Scale the scenario calories by the baseline adjustment factor
-    output_calories = unscaled_calories_input_lulc * adjustment_factor
-    output_calories_uri = os.path.join(output_dir, 'caloric_production.tif')
+            yield_tons_per_cell_array[nan_mask] == nan1
 
-    ui.update_run_log('Total calories: ' + str(np.nansum(output_calories)))
-    ui.update_run_log('Creating caloric_production.tif')
-    utilities.save_array_as_geotiff(output_calories, output_calories_uri, input_lulc_uri, data_type_override=7)
+            yield_tons_per_cell_raster.write(yield_tons_per_cell_array, window['xoff'], window['yoff'])
+    shutil.move(temporary_yield_tons_per_cell_uri, yield_tons_per_cell_uri)
+    return folder_name
+
+def _accumulate_nutrient_production(yield_tons_per_cell_uri_list, nutritional_content_matrix, output_raster_list, nan_mask_uri, nan_value):
+    """Sum the nutrients produced by every crop into one raster per nutrient.
+
+    Each crop's yield raster is read once, a window at a time. The windows of all the crops are stacked and multiplied
+    through the whole crops x nutrients matrix in a single tensordot, and the resulting nutrients x rows x cols cube is
+    written out one nutrient per raster.
+
+    Args:
+        yield_tons_per_cell_uri_list (list): yield rasters, one per row of nutritional_content_matrix, all on one grid.
+        nutritional_content_matrix (numpy.ndarray): crops x nutrients, nutrient produced per ton of yield.
+        output_raster_list (list): utilities.RasterArray opened for update on the same grid, one per matrix column.
+        nan_mask_uri (str): raster on the same grid; pixels equal to nan_value are set to 0 in every output.
+        nan_value: nodata value of nan_mask_uri.
+    """
+    n_crops, n_nutrients = nutritional_content_matrix.shape
+    window_pixels = max(NUTRIENT_WINDOW_VALUES // (n_crops + n_nutrients), 1)
+    yield_rasters = [utilities.RasterArray(uri) for uri in yield_tons_per_cell_uri_list]
+    try:
+        with utilities.RasterArray(nan_mask_uri) as nan_mask_raster:
+            for window, nan_mask_array in nan_mask_raster.iterblocks(window_pixels):
+                yield_cube = np.empty((n_crops, window['win_ysize'], window['win_xsize']), dtype=np.float64)
+                for i, yield_raster in enumerate(yield_rasters):
+                    yield_cube[i] = yield_raster.read(**window)
+                nutrient_cube = np.tensordot(nutritional_content_matrix, yield_cube, axes=(0, 0))
+                nutrient_cube[:, nan_mask_array == nan_value] = 0
+                for output_raster, nutrient_array in zip(output_raster_list, nutrient_cube):
+                    output_raster.write(nutrient_array, window['xoff'], window['yoff'])
+    finally:
+        for yield_raster in yield_rasters:
+            yield_raster.close()
+
+def _write_crop_proportion(lulc_uri, output_uri, match_uri):
+    """Write the proportion of each grid-cell that is in cultivation as a function of the LULC.
+
+    For MODIS, this means 12 and 14 are 1.0 and 0.5 respectively. The output is Float32 with nodata -9999 on the grid
+    of match_uri, which must be the same as that of lulc_uri.
+    """
+    with utilities.RasterArray(lulc_uri) as lulc_raster, \
+            utilities.RasterArray.create_like(match_uri, output_uri, gdal.GDT_Float32, -9999) as output_raster:
+        for window, lulc_array in lulc_raster.iterblocks():
+            crop_proportion = np.where(lulc_array == 12, 1.0, 0.0)
+            crop_proportion = np.where(lulc_array == 14, .5, crop_proportion)
+            output_raster.write(crop_proportion, window['xoff'], window['yoff'])
+
+def load_lulc_calorie_shares(table_uri, project_folder, scenario_dir):
+    """Read the share of a cell's calories each lulc class produces, for the baseline and for a scenario.
+
+    The table has region, scenario, lulc_code and calorie_share columns. Rows with region "default" and no scenario give
+    the baseline shares. The scenario shares start from those and are changed by the rows whose region is default or
+    appears in project_folder and whose scenario is blank or appears in scenario_dir (case insensitive), more specific
+    rows winning. Adding a country or scenario rule is a new row in the table.
+
+    Returns:
+        (baseline_shares, input_lulc_shares), dicts of lulc code to calorie share.
+    """
+    rows = []
+    for row in utilities.file_to_python_object(table_uri, declare_type='2d_list')[1:]:
+        row = [value.strip() for value in row]
+        if len(row) < 4 or not row[0]:
+            continue
+        region, scenario, lulc_code, calorie_share = row[:4]
+        specificity = (region != 'default', scenario != '')
+        rows.append((specificity, region, scenario, int(lulc_code), float(calorie_share)))
+
+    baseline_shares = {}
+    input_lulc_shares = {}
+    for specificity, region, scenario, lulc_code, calorie_share in sorted(rows, key=lambda row: row[0]):
+        if specificity == (False, False):
+            baseline_shares[lulc_code] = calorie_share
+        if (region == 'default' or region in project_folder) and (not scenario or scenario.lower() in scenario_dir.lower()):
+            input_lulc_shares[lulc_code] = calorie_share
+    return baseline_shares, input_lulc_shares
+
+def _compile_calorie_share_lookup(lulc_shares):
+    """Dense array indexed by lulc code giving that class's calorie share, 0 for classes without one."""
+    calorie_share_lookup = np.zeros(max(lulc_shares.keys() + [0]) + 1, dtype=np.float64)
+    for lulc_code, share in lulc_shares.items():
+        calorie_share_lookup[lulc_code] = share
+    return calorie_share_lookup
+
+def _unscaled_calories(lulc_array, calories_array, calorie_share_lookup):
+    """Allocate the resampled 5 min calories to the agricultural lulc classes.
+
+    Args:
+        lulc_array (numpy.ndarray): lulc codes.
+        calories_array (numpy.ndarray): calories per cell resampled to the lulc grid.
+        calorie_share_lookup (numpy.ndarray): from _compile_calorie_share_lookup, the share of the cell's calories each
+            lulc code produces. Codes outside it, like nodata, produce none.
+
+    Returns:
+        numpy.ndarray of unscaled calories, right relative to each other but not in total.
+    """
+    in_lookup = (lulc_array >= 0) & (lulc_array < calorie_share_lookup.size)
+    share = np.zeros(lulc_array.shape, dtype=np.float64)
+    share[in_lookup] = calorie_share_lookup[lulc_array[in_lookup].astype(np.int64)]
+
+    # Only multiply where there is a share, so nodata calories outside the agricultural classes stay 0.
+    unscaled_calories = np.zeros(calories_array.shape, dtype=np.float64)
+    producing = share != 0
+    unscaled_calories[producing] = share[producing] * calories_array[producing]
+    return unscaled_calories
 
 def create_data():
     """
@@ -247,20 +436,8 @@ def execute(kw, ui):
 
         match_uri = kw['lulc_uri']
 
-        # Load the LULC array as the baseline
-        lulc_baseline = hb.as_array(baseline_lulc_uri)
-        no_data_value = hb.get_nodata_from_uri(baseline_lulc_uri)
-
-
-        # Extract the nan_mask for later
-        lulc_nan_mask = np.where(lulc_baseline == no_data_value, 1, 0).astype(np.int8)
-
-        # Calculate the proportion of the grid-cell that is in cultivation as a function of the LULC.
-        # For MODIS, this means 12 and 14 are 1.0 and 0.5 respectively.
-        crop_proportion_baseline = np.where(lulc_baseline == 12, 1.0, 0.0)
+        # Calculate the proportion of the grid-cell that is in cultivation as a function of the LULC, see _write_crop_proportion.
         # TODO START HERE, i missed a nan mask and now the results have near infinite value. create a robust solution
-        # crop_proportion_baseline[lulc_nan_mask] = np.nan
-        crop_proportion_baseline = np.where(lulc_baseline == 14, .5, crop_proportion_baseline)
 
 
         # BUG If the files are not in the normal folder and onl linked to, it fails to find them.
@@ -280,7 +457,7 @@ def execute(kw, ui):
             'Dir already exists.'
 
         crop_proportion_baseline_500m_uri = os.path.join(kw['output_folder'], 'YieldTonsPerCell', 'crop_proportion_baseline_500m.tif')
-        utilities.save_array_as_geotiff(crop_proportion_baseline, crop_proportion_baseline_500m_uri, kw['lulc_uri'])
+        _write_crop_proportion(baseline_lulc_uri, crop_proportion_baseline_500m_uri, kw['lulc_uri'])
         crop_proportion_baseline_1km_uri = os.path.join(kw['output_folder'], 'YieldTonsPerCell', 'crop_proportion_baseline_1km.tif')
 
         population_bounding_box = utilities.get_bounding_box(kw['population_uri'])
@@ -288,22 +465,22 @@ def execute(kw, ui):
         hb.resize_and_resample_dataset_uri(crop_proportion_baseline_500m_uri, population_bounding_box, cell_size, crop_proportion_baseline_1km_uri, 'bilinear')
 
         if kw['lulc_uri'] != baseline_lulc_uri:
-            lulc_scenario = utilities.as_array(kw['lulc_uri'])
-
-            crop_proportion = np.where(lulc_scenario == 12, 1.0, 0.0)
-            crop_proportion = np.where(lulc_scenario == 14, .5, crop_proportion)
             crop_proportion_500m_uri = os.path.join(kw['output_folder'], 'YieldTonsPerCell', 'crop_proportion_500m.tif')
-            utilities.save_array_as_geotiff(crop_proportion, crop_proportion_500m_uri, kw['lulc_uri'])
+            _write_crop_proportion(kw['lulc_uri'], crop_proportion_500m_uri, kw['lulc_uri'])
             crop_proportion_1km_uri = os.path.join(kw['output_folder'], 'YieldTonsPerCell', 'crop_proportion_1km.tif')
             # original_dataset_uri, bounding_box, out_pixel_size, output_uri, resample_method
             hb.resize_and_resample_dataset_uri(crop_proportion_500m_uri, population_bounding_box, cell_size, crop_proportion_1km_uri, 'bilinear')
 
-            crop_proportion_baseline_1km = utilities.as_array(crop_proportion_baseline_1km_uri)
-            crop_proportion_1km = utilities.as_array(crop_proportion_1km_uri)
+            change_ratio_sum = 0.0
+            change_ratio_count = 0
+            with utilities.RasterArray(crop_proportion_baseline_1km_uri) as crop_proportion_baseline_1km_raster, utilities.RasterArray(crop_proportion_1km_uri) as crop_proportion_1km_raster:
+                for window, crop_proportion_baseline_1km in crop_proportion_baseline_1km_raster.iterblocks():
+                    crop_proportion_1km = crop_proportion_1km_raster.read(**window)
+                    change_ratio = np.where(crop_proportion_baseline_1km > 0, crop_proportion_1km / crop_proportion_baseline_1km, 1.0)
+                    change_ratio_sum += np.sum(change_ratio, dtype=np.float64)
+                    change_ratio_count += change_ratio.size
 
-            change_ratio = np.where(crop_proportion_baseline_1km > 0, crop_proportion_1km / crop_proportion_baseline_1km, 1.0)
-
-            change_ratio_mean = np.mean(change_ratio)
+            change_ratio_mean = change_ratio_sum / change_ratio_count
         else:
             change_ratio_mean = 1.0
 
@@ -314,12 +491,10 @@ def execute(kw, ui):
         nutritional_content_odict = utilities.file_to_python_object(kw['nutritional_content_table_uri'], declare_type='2d_odict')  # outputs as OrderedDict([('almond', OrderedDict([('fraction_refuse', '0.6'), ('Protein', '212.2'), ('Lipid', '494.2'), etc
         nutritional_requirements_odict = utilities.file_to_python_object(kw['nutritional_requirements_table_uri'], declare_type='2d_indexed_odict')
 
-        population = utilities.as_array(kw['population_uri'])
         demographic_groups_list = kw['demographic_groups_list']
         demographics_folder = kw['demographics_folder']
 
         ui.update_run_log('Calculating crop-specific production')
-        lulc_array = utilities.as_array(kw['lulc_uri'])
         lulc_wkt = hb.get_dataset_projection_wkt_uri(kw['lulc_uri'])
         harvested_area_ha_filenames = []
         harvested_area_fraction_filenames = []
@@ -330,11 +505,14 @@ def execute(kw, ui):
 
         # Calculate ha per cell
         cell_size = hb.get_cell_size_from_uri(kw['lulc_uri'])
-        ha_per_cell = np.ones(lulc_array.shape) * (cell_size ** 2 / 10000)
+        ha_per_cell = cell_size ** 2 / 10000
         ha_per_cell_uri = os.path.join(kw['output_folder'], 'ha_per_cell.tif')
-        utilities.save_array_as_geotiff(ha_per_cell, ha_per_cell_uri, kw['lulc_uri'])
+        with utilities.RasterArray.create_like(kw['lulc_uri'], ha_per_cell_uri, gdal.GDT_Float32, -9999) as ha_per_cell_raster:
+            for window in ha_per_cell_raster.iterwindows():
+                ha_per_cell_raster.write(np.ones((window['win_ysize'], window['win_xsize'])) * ha_per_cell, window['xoff'], window['yoff'])
 
         force_recalculation = False
+        crop_preparation_args = []
         for folder_name in os.listdir(crop_maps_folder):
             current_folder = os.path.join(crop_maps_folder, folder_name)
             if os.path.isdir(current_folder):
@@ -346,202 +524,67 @@ def execute(kw, ui):
                 clipped_yield_tons_per_ha_uri = os.path.join(clipped_dir, current_crop_name + '_YieldPerHectare.tif')
                 yield_tons_per_cell_uri = os.path.join(clipped_dir, current_crop_name + '_YieldTonsPerCell.tif')
 
-
-                if not os.path.exists(clipped_harvested_area_fraction_uri) or not os.path.exists(clipped_yield_tons_per_ha_uri) or not os.path.exists(yield_tons_per_cell_uri) or force_recalculation:
-                    # hb.clip_dataset_uri(input_harvested_area_fraction_uri, kw['aoi_uri'], clipped_harvested_area_fraction_uri)
-                    utilities.clip_by_shape_with_buffered_intermediate_uri(input_harvested_area_fraction_uri, kw['aoi_uri'], clipped_harvested_area_fraction_uri, match_uri, resampling_method='bilinear')
-                    harvested_area_fraction_array = utilities.as_array(clipped_harvested_area_fraction_uri)
-
-                    # hb.clip_dataset_uri(input_yield_tons_per_ha_uri, kw['aoi_uri'], clipped_yield_tons_per_ha_uri)
-                    utilities.clip_by_shape_with_buffered_intermediate_uri(input_yield_tons_per_ha_uri, kw['aoi_uri'], clipped_yield_tons_per_ha_uri, match_uri, resampling_method='bilinear')
-                    yield_tons_per_ha_array = utilities.as_array(clipped_yield_tons_per_ha_uri)
-
-                    nan1 = utilities.get_nodata_from_uri(input_harvested_area_fraction_uri)
-                    nan2 = utilities.get_nodata_from_uri(input_yield_tons_per_ha_uri)
-
-                    nan_mask = np.where((yield_tons_per_ha_array == nan1) & (harvested_area_fraction_array == nan2))
-
-                    yield_tons_per_cell_array = yield_tons_per_ha_array * harvested_area_fraction_array * ha_per_cell
-
-                    yield_tons_per_cell_array[nan_mask] == nan1
-
-                    # NOTE forcing ndv to zero for calcualtions
-                    utilities.save_array_as_geotiff(yield_tons_per_cell_array, yield_tons_per_cell_uri, kw['lulc_uri'], data_type_override=7, no_data_value_override=0)
+                # Skip crops whose clipped outputs are newer than everything they are made from.
+                if force_recalculation or not _outputs_are_current(
+                        [clipped_harvested_area_fraction_uri, clipped_yield_tons_per_ha_uri, yield_tons_per_cell_uri],
+                        [input_harvested_area_fraction_uri, input_yield_tons_per_ha_uri, kw['aoi_uri'], match_uri]):
+                    crop_preparation_args.append((
+                        folder_name, input_harvested_area_fraction_uri, clipped_harvested_area_fraction_uri, input_yield_tons_per_ha_uri,
+                        clipped_yield_tons_per_ha_uri, yield_tons_per_cell_uri, kw['aoi_uri'], match_uri, kw['lulc_uri'], ha_per_cell,
+                        os.path.join(clipped_dir, 'scratch'), kw.get('vectorize_threads')))
 
                 harvested_area_fraction_filenames.append(clipped_harvested_area_fraction_uri)
                 yield_tons_per_ha_filenames.append(clipped_yield_tons_per_ha_uri)
                 yield_tons_per_cell_filenames.append(yield_tons_per_cell_uri)
 
-                ui.update_run_log('Creating yield (tons) map for ' + folder_name)
+        # The crops are independent, so they can be clipped in parallel by setting crop_preparation_workers above 1. Each
+        # clip can also read and mask its blocks on vectorize_threads threads.
+        for folder_name in _prepare_crop_yields(crop_preparation_args, kw.get('crop_preparation_workers', 1)):
+            ui.update_run_log('Creating yield (tons) map for ' + folder_name)
+        shutil.rmtree(os.path.join(clipped_dir, 'scratch'), ignore_errors=True)
 
         match_5min_uri = os.path.join(kw['output_folder'], 'crop_production_and_harvested_area', 'maize_HarvestedAreaFraction.tif')
         # match_5min_uri = os.path.join(ui.root_app.base_data_folder, 'models/crop_production/global_dataset/observed_yield/rice_yield_map.tif')
-        match_array = utilities.as_array(match_5min_uri)
+        match_1km_uri = os.path.join(kw['output_folder'], 'YieldTonsPerCell', 'crop_proportion_baseline_1km.tif')
 
         # TODO Figure out if nans all right
         nan3 = utilities.get_nodata_from_uri(clipped_harvested_area_fraction_uri)
-        array = utilities.as_array(clipped_harvested_area_fraction_uri)
-        nan_mask = np.where(array == nan3, True, False).astype(np.bool)
-
-        # TODO Why default to run always?
-        # Fat = np.zeros(match_array.shape).astype(np.float64)
-        #[Fatnan_mask] = nan3
-        Energy = np.zeros(match_array.shape).astype(np.float64)
-        Energy[nan_mask] = nan3
-        Protein = np.zeros(match_array.shape).astype(np.float64)
-        Protein[nan_mask] = nan3
-        VitA = np.zeros(match_array.shape).astype(np.float64)
-        VitA[nan_mask] = nan3
-        VitC = np.zeros(match_array.shape).astype(np.float64)
-        VitC[nan_mask] = nan3
-        VitE = np.zeros(match_array.shape).astype(np.float64)
-        VitE[nan_mask] = nan3
-        Thiamin = np.zeros(match_array.shape).astype(np.float64)
-        Thiamin[nan_mask] = nan3
-        Riboflavin = np.zeros(match_array.shape).astype(np.float64)
-        Riboflavin[nan_mask] = nan3
-        Niacin = np.zeros(match_array.shape).astype(np.float64)
-        Niacin[nan_mask] = nan3
-        VitB6 = np.zeros(match_array.shape).astype(np.float64)
-        VitB6[nan_mask] = nan3
-        Folate = np.zeros(match_array.shape).astype(np.float64)
-        Folate[nan_mask] = nan3
-        VitB12 = np.zeros(match_array.shape).astype(np.float64)
-        VitB12[nan_mask] = nan3
-        Ca = np.zeros(match_array.shape).astype(np.float64)
-        Ca[nan_mask] = nan3
-        Ph = np.zeros(match_array.shape).astype(np.float64)
-        Ph[nan_mask] = nan3
-        Mg = np.zeros(match_array.shape).astype(np.float64)
-        Mg[nan_mask] = nan3
-        K = np.zeros(match_array.shape).astype(np.float64)
-        K[nan_mask] = nan3
-        Na = np.zeros(match_array.shape).astype(np.float64)
-        Na[nan_mask] = nan3
-        Fe = np.zeros(match_array.shape).astype(np.float64)
-        Fe[nan_mask] = nan3
-        Zn = np.zeros(match_array.shape).astype(np.float64)
-        Zn[nan_mask] = nan3
-        Cu = np.zeros(match_array.shape).astype(np.float64)
-        Cu[nan_mask] = nan3
-
 
+        nutrient_yield_tons_per_cell_filenames = []
+        nutritional_content_rows = []
         for i in range(len(yield_tons_per_cell_filenames)):
             current_crop_name = os.path.splitext(os.path.split(harvested_area_fraction_filenames[i])[1])[0].split('_', 1)[0]
             ui.update_run_log('Calculating nutritional contribution of ' + current_crop_name)
             if current_crop_name in nutritional_content_odict.keys():
                 print('adding Nutritional content of ' + current_crop_name)
-                # Fat += utilities.as_array(yield_tons_per_cell_filenames[i]) * 1000.0 * float(nutritional_content_odict[current_crop_name]['Fat'])
-                Energy += utilities.as_array(yield_tons_per_cell_filenames[i]) * 1000.0 * float(nutritional_content_odict[current_crop_name]['Energy'])
-                Protein += utilities.as_array(yield_tons_per_cell_filenames[i]) * 1000.0 * float(nutritional_content_odict[current_crop_name]['Protein'])
-                VitA += utilities.as_array(yield_tons_per_cell_filenames[i]) * 1000.0 * float(nutritional_content_odict[current_crop_name]['VitA'])
-                VitC += utilities.as_array(yield_tons_per_cell_filenames[i]) * 1000.0 * float(nutritional_content_odict[current_crop_name]['VitC'])
-                VitE += utilities.as_array(yield_tons_per_cell_filenames[i]) * 1000.0 * float(nutritional_content_odict[current_crop_name]['VitE'])
-                Thiamin += utilities.as_array(yield_tons_per_cell_filenames[i]) * 1000.0 * float(nutritional_content_odict[current_crop_name]['Thiamin'])
-                Riboflavin += utilities.as_array(yield_tons_per_cell_filenames[i]) * 1000.0 * float(nutritional_content_odict[current_crop_name]['Riboflavin'])
-                Niacin += utilities.as_array(yield_tons_per_cell_filenames[i]) * 1000.0 * float(nutritional_content_odict[current_crop_name]['Niacin'])
-                VitB6 += utilities.as_array(yield_tons_per_cell_filenames[i]) * 1000.0 * float(nutritional_content_odict[current_crop_name]['VitB6'])
-                Folate += utilities.as_array(yield_tons_per_cell_filenames[i]) * 1000.0 * float(nutritional_content_odict[current_crop_name]['Folate'])
-                VitB12 += utilities.as_array(yield_tons_per_cell_filenames[i]) * 1000.0 * float(nutritional_content_odict[current_crop_name]['VitB12'])
-                Ca += utilities.as_array(yield_tons_per_cell_filenames[i]) * 1000.0 * float(nutritional_content_odict[current_crop_name]['Ca'])
-                Ph += utilities.as_array(yield_tons_per_cell_filenames[i]) * 1000.0 * float(nutritional_content_odict[current_crop_name]['Ph'])
-                Mg += utilities.as_array(yield_tons_per_cell_filenames[i]) * 1000.0 * float(nutritional_content_odict[current_crop_name]['Energy'])
-                K += utilities.as_array(yield_tons_per_cell_filenames[i]) * 1000.0 * float(nutritional_content_odict[current_crop_name]['Mg'])
-                Na += utilities.as_array(yield_tons_per_cell_filenames[i]) * 1000.0 * float(nutritional_content_odict[current_crop_name]['K'])
-                Fe += utilities.as_array(yield_tons_per_cell_filenames[i]) * 1000.0 * float(nutritional_content_odict[current_crop_name]['Fe'])
-                Zn += utilities.as_array(yield_tons_per_cell_filenames[i]) * 1000.0 * float(nutritional_content_odict[current_crop_name]['Energy'])
-                Cu += utilities.as_array(yield_tons_per_cell_filenames[i]) * 1000.0 * float(nutritional_content_odict[current_crop_name]['Zn'])
-
-
+                nutrient_yield_tons_per_cell_filenames.append(yield_tons_per_cell_filenames[i])
+                nutritional_content_rows.append([float(nutritional_content_odict[current_crop_name][column]) for column in NUTRIENT_CONTENT_COLUMNS.values()])
 
+        # Crops x nutrients, per ton of yield.
         # TODO make this happen earlier in calcs
-        # Fat *= change_ratio_mean
-        Energy *= change_ratio_mean
-        Protein *= change_ratio_mean
-        VitA *= change_ratio_mean
-        VitC *= change_ratio_mean
-        VitE *= change_ratio_mean
-        Thiamin *= change_ratio_mean
-        Riboflavin *= change_ratio_mean
-        Niacin *= change_ratio_mean
-        VitB6 *= change_ratio_mean
-        Folate *= change_ratio_mean
-        VitB12 *= change_ratio_mean
-        Ca *= change_ratio_mean
-        Ph *= change_ratio_mean
-        Mg *= change_ratio_mean
-        K *= change_ratio_mean
-        Na *= change_ratio_mean
-        Fe *= change_ratio_mean
-        Zn *= change_ratio_mean
-        Cu *= change_ratio_mean
-
-        # Fat *= change_ratio_mean
-        Energy[nan_mask] = 0
-        Protein[nan_mask] = 0
-        VitA[nan_mask] = 0
-        VitC[nan_mask] = 0
-        VitE[nan_mask] = 0
-        Thiamin[nan_mask] = 0
-        Riboflavin[nan_mask] = 0
-        Niacin[nan_mask] = 0
-        VitB6[nan_mask] = 0
-        Folate[nan_mask] = 0
-        VitB12[nan_mask] = 0
-        Ca[nan_mask] = 0
-        Ph[nan_mask] = 0
-        Mg[nan_mask] = 0
-        K[nan_mask] = 0
-        Na[nan_mask] = 0
-        Fe[nan_mask] = 0
-        Zn[nan_mask] = 0
-        Cu[nan_mask] = 0
+        nutritional_content_matrix = np.array(nutritional_content_rows, dtype=np.float64).reshape(len(nutritional_content_rows), len(NUTRIENT_CONTENT_COLUMNS))
+        nutritional_content_matrix *= 1000.0 * change_ratio_mean
 
+        # Energy and Protein are Float64 with the harvested area nodata, the rest Float32 with nodata -9999, the types
+        # save_array_as_geotiff gave them with and without a no_data_value_override.
+        nutrient_5min_uris = OrderedDict()
+        nutrient_5min_rasters = OrderedDict()
+        for nutrient in NUTRIENT_CONTENT_COLUMNS:
+            nutrient_5min_uris[nutrient] = os.path.join(kw['output_folder'], 'nutrient_production', nutrient + '_per_cell_5min.tif')
+            if nutrient in ['Energy', 'Protein']:
+                datatype, nodata = gdal.GDT_Float64, nan3
+            else:
+                datatype, nodata = gdal.GDT_Float32, -9999
+            nutrient_5min_rasters[nutrient] = utilities.RasterArray.create_like(match_5min_uri, nutrient_5min_uris[nutrient], datatype, nodata)
 
+        _accumulate_nutrient_production(nutrient_yield_tons_per_cell_filenames, nutritional_content_matrix, nutrient_5min_rasters.values(), clipped_harvested_area_fraction_uri, nan3)
 
+        for nutrient in NUTRIENT_CONTENT_COLUMNS:
+            nutrient_5min_rasters[nutrient].close()
 
-        match_1km_uri = os.path.join(kw['output_folder'], 'YieldTonsPerCell', 'crop_proportion_baseline_1km.tif')
-
-        utilities.save_array_as_geotiff(Energy, os.path.join(kw['output_folder'], 'nutrient_production', 'Energy_per_cell_5min.tif'), match_5min_uri, data_type_override=7, no_data_value_override=nan3)
-        utilities.resample_preserve_sum(os.path.join(kw['output_folder'], 'nutrient_production', 'Energy_per_cell_5min.tif'), os.path.join(kw['output_folder'], 'nutrient_production', 'Energy_per_cell_1km.tif'), match_1km_uri)
-        # utilities.save_array_as_geotiff(Fat, os.path.join(kw['output_folder'], 'nutrient_production', 'Fat_per_cell_5min.tif'), match_5min_uri)
-        # utilities.resample_preserve_sum(os.path.join(kw['output_folder'], 'nutrient_production', 'Fat_per_cell_5min.tif'), os.path.join(kw['output_folder'], 'nutrient_production', 'Fat_per_cell_1km.tif'), match_1km_uri)
-        utilities.save_array_as_geotiff(Protein, os.path.join(kw['output_folder'], 'nutrient_production', 'Protein_per_cell_5min.tif'), match_5min_uri, no_data_value_override=nan3)
-        utilities.resample_preserve_sum(os.path.join(kw['output_folder'], 'nutrient_production', 'Protein_per_cell_5min.tif'), os.path.join(kw['output_folder'], 'nutrient_production', 'Protein_per_cell_1km.tif'), match_1km_uri)
-        utilities.save_array_as_geotiff(VitA, os.path.join(kw['output_folder'], 'nutrient_production', 'VitA_per_cell_5min.tif'), match_5min_uri)
-        utilities.resample_preserve_sum(os.path.join(kw['output_folder'], 'nutrient_production', 'VitA_per_cell_5min.tif'), os.path.join(kw['output_folder'], 'nutrient_production', 'VitA_per_cell_1km.tif'), match_1km_uri)
-        utilities.save_array_as_geotiff(VitC, os.path.join(kw['output_folder'], 'nutrient_production', 'VitC_per_cell_5min.tif'), match_5min_uri)
-        utilities.resample_preserve_sum(os.path.join(kw['output_folder'], 'nutrient_production', 'VitC_per_cell_5min.tif'), os.path.join(kw['output_folder'], 'nutrient_production', 'VitC_per_cell_1km.tif'), match_1km_uri)
-        utilities.save_array_as_geotiff(VitE, os.path.join(kw['output_folder'], 'nutrient_production', 'VitE_per_cell_5min.tif'), match_5min_uri)
-        utilities.resample_preserve_sum(os.path.join(kw['output_folder'], 'nutrient_production', 'VitE_per_cell_5min.tif'), os.path.join(kw['output_folder'], 'nutrient_production', 'VitE_per_cell_1km.tif'), match_1km_uri)
-        utilities.save_array_as_geotiff(Thiamin, os.path.join(kw['output_folder'], 'nutrient_production', 'Thiamin_per_cell_5min.tif'), match_5min_uri)
-        utilities.resample_preserve_sum(os.path.join(kw['output_folder'], 'nutrient_production', 'Thiamin_per_cell_5min.tif'), os.path.join(kw['output_folder'], 'nutrient_production', 'Thiamin_per_cell_1km.tif'), match_1km_uri)
-        utilities.save_array_as_geotiff(Riboflavin, os.path.join(kw['output_folder'], 'nutrient_production', 'Riboflavin_per_cell_5min.tif'), match_5min_uri)
-        utilities.resample_preserve_sum(os.path.join(kw['output_folder'], 'nutrient_production', 'Riboflavin_per_cell_5min.tif'), os.path.join(kw['output_folder'], 'nutrient_production', 'Riboflavin_per_cell_1km.tif'), match_1km_uri)
-        utilities.save_array_as_geotiff(Niacin, os.path.join(kw['output_folder'], 'nutrient_production', 'Niacin_per_cell_5min.tif'), match_5min_uri)
-        utilities.resample_preserve_sum(os.path.join(kw['output_folder'], 'nutrient_production', 'Niacin_per_cell_5min.tif'), os.path.join(kw['output_folder'], 'nutrient_production', 'Niacin_per_cell_1km.tif'), match_1km_uri)
-        utilities.save_array_as_geotiff(VitB6, os.path.join(kw['output_folder'], 'nutrient_production', 'VitB6_per_cell_5min.tif'), match_5min_uri)
-        utilities.resample_preserve_sum(os.path.join(kw['output_folder'], 'nutrient_production', 'VitB6_per_cell_5min.tif'), os.path.join(kw['output_folder'], 'nutrient_production', 'VitB6_per_cell_1km.tif'), match_1km_uri)
-        utilities.save_array_as_geotiff(Folate, os.path.join(kw['output_folder'], 'nutrient_production', 'Folate_per_cell_5min.tif'), match_5min_uri)
-        utilities.resample_preserve_sum(os.path.join(kw['output_folder'], 'nutrient_production', 'Folate_per_cell_5min.tif'), os.path.join(kw['output_folder'], 'nutrient_production', 'Folate_per_cell_1km.tif'), match_1km_uri)
-        utilities.save_array_as_geotiff(VitB12, os.path.join(kw['output_folder'], 'nutrient_production', 'VitB12_per_cell_5min.tif'), match_5min_uri)
-        utilities.resample_preserve_sum(os.path.join(kw['output_folder'], 'nutrient_production', 'VitB12_per_cell_5min.tif'), os.path.join(kw['output_folder'], 'nutrient_production', 'VitB12_per_cell_1km.tif'), match_1km_uri)
-        utilities.save_array_as_geotiff(Ca, os.path.join(kw['output_folder'], 'nutrient_production', 'Ca_per_cell_5min.tif'), match_5min_uri)
-        utilities.resample_preserve_sum(os.path.join(kw['output_folder'], 'nutrient_production', 'Ca_per_cell_5min.tif'), os.path.join(kw['output_folder'], 'nutrient_production', 'Ca_per_cell_1km.tif'), match_1km_uri)
-        utilities.save_array_as_geotiff(Ph, os.path.join(kw['output_folder'], 'nutrient_production', 'Ph_per_cell_5min.tif'), match_5min_uri)
-        utilities.resample_preserve_sum(os.path.join(kw['output_folder'], 'nutrient_production', 'Ph_per_cell_5min.tif'), os.path.join(kw['output_folder'], 'nutrient_production', 'Ph_per_cell_1km.tif'), match_1km_uri)
-        utilities.save_array_as_geotiff(Mg, os.path.join(kw['output_folder'], 'nutrient_production', 'Mg_per_cell_5min.tif'), match_5min_uri)
-        utilities.resample_preserve_sum(os.path.join(kw['output_folder'], 'nutrient_production', 'Mg_per_cell_5min.tif'), os.path.join(kw['output_folder'], 'nutrient_production', 'Mg_per_cell_1km.tif'), match_1km_uri)
-        utilities.save_array_as_geotiff(K, os.path.join(kw['output_folder'], 'nutrient_production', 'K_per_cell_5min.tif'), match_5min_uri)
-        utilities.resample_preserve_sum(os.path.join(kw['output_folder'], 'nutrient_production', 'K_per_cell_5min.tif'), os.path.join(kw['output_folder'], 'nutrient_production', 'K_per_cell_1km.tif'), match_1km_uri)
-        utilities.save_array_as_geotiff(Na, os.path.join(kw['output_folder'], 'nutrient_production', 'Na_per_cell_5min.tif'), match_5min_uri)
-        utilities.resample_preserve_sum(os.path.join(kw['output_folder'], 'nutrient_production', 'Na_per_cell_5min.tif'), os.path.join(kw['output_folder'], 'nutrient_production', 'Na_per_cell_1km.tif'), match_1km_uri)
-        utilities.save_array_as_geotiff(Fe, os.path.join(kw['output_folder'], 'nutrient_production', 'Fe_per_cell_5min.tif'), match_5min_uri)
-        utilities.resample_preserve_sum(os.path.join(kw['output_folder'], 'nutrient_production', 'Fe_per_cell_5min.tif'), os.path.join(kw['output_folder'], 'nutrient_production', 'Fe_per_cell_1km.tif'), match_1km_uri)
-        utilities.save_array_as_geotiff(Zn, os.path.join(kw['output_folder'], 'nutrient_production', 'Zn_per_cell_5min.tif'), match_5min_uri)
-        utilities.resample_preserve_sum(os.path.join(kw['output_folder'], 'nutrient_production', 'Zn_per_cell_5min.tif'), os.path.join(kw['output_folder'], 'nutrient_production', 'Zn_per_cell_1km.tif'), match_1km_uri)
-        utilities.save_array_as_geotiff(Cu, os.path.join(kw['output_folder'], 'nutrient_production', 'Cu_per_cell_5min.tif'), match_5min_uri)
-        utilities.resample_preserve_sum(os.path.join(kw['output_folder'], 'nutrient_production', 'Cu_per_cell_5min.tif'), os.path.join(kw['output_folder'], 'nutrient_production', 'Cu_per_cell_1km.tif'), match_1km_uri)
+        # All the nutrients share the 5 min grid, so resample them to 1km together.
+        utilities.resample_preserve_sum_stack(
+            nutrient_5min_uris.values(), [uri.replace('_per_cell_5min.tif', '_per_cell_1km.tif') for uri in nutrient_5min_uris.values()], match_1km_uri)
 
 
         # calculate demand
@@ -551,38 +594,63 @@ def execute(kw, ui):
             ui.update_run_log('Calculating total nutrient demand')
             overall_nutrient_sum = 0
             overall_nutrient_requirement_sum = 0
-            overall_ratio_array = np.zeros(population.shape)
             overall_ratio = 0
-            population_zero_normalized = np.where(population < 0, 0, population)
+
+            # The nutrient rasters are all on the population grid, so step through the population a window at a time and
+            # read the matching window of each nutrient.
+            nutrient_rasters = OrderedDict()
+            nutrient_ratio_rasters = OrderedDict()
+            nutrient_sums = OrderedDict()
+            nutrient_requirement_sums = OrderedDict()
             for nutrient in nutritional_requirements_odict:
                 nutrient_uri = os.path.join(kw['output_folder'], 'nutrient_production', nutrient + '_per_cell_1km.tif')
-                nutrient_array = utilities.as_array(nutrient_uri)
+                nutrient_rasters[nutrient] = utilities.RasterArray(nutrient_uri)
+                nutrient_ratio_rasters[nutrient] = utilities.RasterArray.create_like(
+                    nutrient_uri, nutrient_uri.replace('_per_cell_1km.tif', '_adequacy_ratio.tif'), gdal.GDT_Float32, -9999)
+                nutrient_sums[nutrient] = 0.0
+                nutrient_requirement_sums[nutrient] = 0.0
+            overall_ratio_uri = os.path.join(kw['output_folder'], 'overall_adequacy_ratio.tif')
+            overall_ratio_raster = utilities.RasterArray.create_like(
+                nutrient_uri, overall_ratio_uri, gdal.GDT_Float32, -9999)
+
+            with utilities.RasterArray(kw['population_uri']) as population_raster:
+                for window, population in population_raster.iterblocks():
+                    overall_ratio_array = np.zeros(population.shape)
+                    population_zero_normalized = np.where(population < 0, 0, population)
+                    for nutrient in nutritional_requirements_odict:
+                        nutrient_array = nutrient_rasters[nutrient].read(**window)
+
+                        nutrient_requirement_array = population_zero_normalized * float(nutritional_requirements_odict[nutrient]['recommended_daily_allowance']) * 365.0
+                        # nutrient_requirement_array[nan_mask] = np.nan
+                        # nutrient_requirement_array[nutrient_requirement_array<=0] = np.nan
 
-                nutrient_requirement_array = population_zero_normalized * float(nutritional_requirements_odict[nutrient]['recommended_daily_allowance']) * 365.0
-                # nutrient_requirement_array[nan_mask] = np.nan
-                # nutrient_requirement_array[nutrient_requirement_array<=0] = np.nan
+                        nutrient_provision_ratio = np.where((nutrient_array / nutrient_requirement_array > 0) & (nutrient_array / nutrient_requirement_array < 999999999999999999999999999999),
+                                                            nutrient_array / nutrient_requirement_array,
+                                                            0)
 
-                nutrient_provision_ratio = np.where((nutrient_array / nutrient_requirement_array > 0) & (nutrient_array / nutrient_requirement_array < 999999999999999999999999999999),
-                                                    nutrient_array / nutrient_requirement_array,
-                                                    0)
+                        overall_ratio_array += nutrient_provision_ratio
+                        nutrient_sums[nutrient] += np.nansum(nutrient_array)
+                        nutrient_requirement_sums[nutrient] += np.nansum(nutrient_requirement_array)
+                        nutrient_ratio_rasters[nutrient].write(nutrient_provision_ratio, window['xoff'], window['yoff'])
 
-                overall_ratio_array += nutrient_provision_ratio
-                nutrient_sum = np.nansum(nutrient_array)
+                    overall_ratio_array *= 1.0 / 19.0
+                    overall_ratio_raster.write(overall_ratio_array, window['xoff'], window['yoff'])
+
+            for nutrient in nutritional_requirements_odict:
+                nutrient_rasters[nutrient].close()
+                nutrient_ratio_rasters[nutrient].close()
+                nutrient_sum = nutrient_sums[nutrient]
                 overall_nutrient_sum += nutrient_sum
-                nutrient_requirement_sum = np.nansum(nutrient_requirement_array)
+                nutrient_requirement_sum = nutrient_requirement_sums[nutrient]
                 overall_nutrient_requirement_sum += nutrient_requirement_sum
                 output_string = 'Full landscape produced ' + str(nutrient_sum) + ' of ' + nutrient + ' compared to a national requirement of ' + str(nutrient_requirement_sum) + ', yielding nutritional adequacy ratio of ' + str(nutrient_sum / nutrient_requirement_sum) + '.'
                 ui.update_run_log(output_string)
-                overall_ratio += nutrient_provision_ratio
-                utilities.save_array_as_geotiff(nutrient_provision_ratio, nutrient_uri.replace('_per_cell_1km.tif', '_adequacy_ratio.tif'), nutrient_uri)
+            overall_ratio_raster.close()
 
-            overall_ratio_array *= 1.0 / 19.0
             overall_ratio = (1.0 / 19.0) * (overall_nutrient_sum / overall_nutrient_requirement_sum)
 
             output_string = 'Overall nutrion adequacy ratio: ' + str(overall_ratio) + '.'
             ui.update_run_log(output_string)
-            overall_ratio_uri = os.path.join(kw['output_folder'], 'overall_adequacy_ratio.tif')
-            utilities.save_array_as_geotiff(overall_ratio_array, overall_ratio_uri, nutrient_uri)
 
     run_calories_only_model = True
     if run_calories_only_model:
@@ -5,17 +5,15 @@ import shutil
 import os
 import logging
 import tempfile
-import struct
-import heapq
 import time
 import collections
 import csv
+import multiprocessing
 
 import numpy
-from osgeo import osr
 from osgeo import gdal
 import pygeoprocessing
-import scipy
+import scipy.ndimage
 
 # from . import utils
 import utils
@@ -32,15 +30,42 @@ _TMP_BASE_FILES = {
     'base_lulc_path': 'base_lulc.tif'
 }
 
-# This sets the largest number of elements that will be packed at once and
-# addresses a memory leak issue that happens when many arguments are passed
-# to the function via the * operator
-_LARGEST_STRUCT_PACK = 1024
-
 # Max number of elements to read/cache at once.  Used throughout the code to
 # load arrays to and from disk
 _BLOCK_SIZE = 2**20
 
+# Smallest number of elements read from each sorted run per merge batch so
+# merging many runs doesn't degenerate into tiny reads
+_MIN_MERGE_CHUNK_SIZE = 2**10
+
+# Types used to pack sorted scores and flat indexes to disk.  Flat indexes are
+# 64 bit so rasters with more than 2**31 pixels can be sorted.
+_SORT_SCORE_TYPE = numpy.float32
+_SORT_INDEX_TYPE = numpy.int64
+
+# Largest number of pixels to convert that will be selected in memory with
+# `_select_top_k` rather than fully sorted to disk with `_sort_to_disk`.
+# Bounds the candidate buffer to a few hundred MB.
+_MAX_TOP_K_SELECTION = 2**23
+
+# Width in pixels of the square tiles used to track which parts of the
+# distance rasters need to be recalculated in incremental mode
+_DISTANCE_TILE_SIZE = 256
+
+# Landscapes with at most this many pixels are converted with all of their
+# arrays held in memory rather than through temporary rasters on disk
+_MAX_IN_MEMORY_PIXELS = 2**24
+
+# Gaussian kernels are truncated this many sigmas from the center, which
+# gives over 99% of the area under the curve
+_GAUSSIAN_TRUNCATE = 3.0
+
+# Normalized 1D Gaussian kernels indexed by sigma
+_GAUSSIAN_KERNEL_CACHE = {}
+
+# Nodata value of the smoothed distance rasters, distances are non-negative
+_SMOOTH_DISTANCE_NODATA = -1.0
+
 
 def execute(args):
     """Scenario Generator: Proximity-Based.
@@ -76,6 +101,18 @@ def execute(args):
             conversion simulation starting from the nearest pixel on the
             edge and work inwards.  Workspace will contain output files named
             'toward_base{suffix}.{tif,csv}.
+        args['incremental_distance_transform'] (boolean): (optional) if True
+            the distance transforms after the first fragmentation step are
+            only recalculated around the pixels converted in the previous
+            step rather than over the whole landscape.
+        args['max_in_memory_pixels'] (string or int): (optional) landscapes
+            with at most this many pixels are processed entirely in memory.
+            Defaults to `_MAX_IN_MEMORY_PIXELS`, set to 0 to always process
+            on disk.
+        args['n_workers'] (string or int): (optional) if greater than 1 and
+            both scenarios are enabled they are run concurrently in a pool of
+            this many processes, each with its own temporary directory.
+            Defaults to 1.
 
     Returns:
         None.
@@ -121,9 +158,19 @@ def execute(args):
         (args['convert_farthest_from_edge'], 'farthest_from_edge', -1.0),
         (args['convert_nearest_to_edge'], 'nearest_to_edge', 1.0)]
 
-    for scenario_enabled, basename, score_weight in scenarios:
-        if not scenario_enabled:
-            continue
+    enabled_scenarios = [
+        (basename, score_weight) for scenario_enabled, basename, score_weight
+        in scenarios if scenario_enabled]
+    n_workers = min(int(args.get('n_workers', 1)), len(enabled_scenarios))
+    if n_workers > 1:
+        LOGGER.info('running scenarios in %d processes', n_workers)
+        process_pool = multiprocessing.Pool(n_workers)
+    else:
+        process_pool = None
+
+    result_list = []
+    scenario_tmp_dir_list = []
+    for basename, score_weight in enabled_scenarios:
         LOGGER.info('executing %s scenario', basename)
         output_landscape_raster_uri = os.path.join(
             output_dir, basename+file_suffix+'.tif')
@@ -131,18 +178,71 @@ def execute(args):
             output_dir, basename+file_suffix+'.csv')
         distance_from_edge_uri = os.path.join(
             intermediate_output_dir, basename+'_distance'+file_suffix+'.tif')
-        _convert_landscape(
+        convert_args = (
             f_reg['base_lulc_path'], replacement_lucode, area_to_convert,
             focal_landcover_codes, convertible_type_list, score_weight,
             int(args['n_fragmentation_steps']), distance_from_edge_uri,
             output_landscape_raster_uri, stats_uri)
+        convert_kwargs = {
+            'incremental': bool(
+                args.get('incremental_distance_transform', False)),
+            'max_in_memory_pixels': int(
+                args.get('max_in_memory_pixels', _MAX_IN_MEMORY_PIXELS)),
+        }
+        if process_pool is None:
+            _convert_landscape(*convert_args, **convert_kwargs)
+        else:
+            # each scenario gets its own directory so temporary files from
+            # concurrent scenarios never collide
+            scenario_tmp_dir = os.path.join(tmp_dir, basename+file_suffix)
+            pygeoprocessing.geoprocessing.create_directories(
+                [scenario_tmp_dir])
+            scenario_tmp_dir_list.append(scenario_tmp_dir)
+            result_list.append(process_pool.apply_async(
+                _convert_landscape_in_tmp_dir,
+                (scenario_tmp_dir,) + convert_args, convert_kwargs))
+
+    if process_pool is not None:
+        process_pool.close()
+        succeeded = False
+        try:
+            # get() re-raises any exception from the worker
+            for result in result_list:
+                result.get()
+            succeeded = True
+        finally:
+            # don't leave the other scenarios running on an error
+            if not succeeded:
+                process_pool.terminate()
+            process_pool.join()
+            for scenario_tmp_dir in scenario_tmp_dir_list:
+                shutil.rmtree(scenario_tmp_dir, ignore_errors=True)
+
+
+def _convert_landscape_in_tmp_dir(tmp_dir, *args, **kwargs):
+    """Call `_convert_landscape` with temporary files created in `tmp_dir`.
+
+    Intended as the target of a worker process so concurrent scenarios each
+    have an isolated temporary file registry.
+
+    Parameters:
+        tmp_dir (string): path to an existing directory that all temporary
+            files in this process will be created in.
+        *args, **kwargs: passed through to `_convert_landscape`.
+
+    Returns:
+        None.
+    """
+    tempfile.tempdir = tmp_dir
+    _convert_landscape(*args, **kwargs)
 
 
 def _convert_landscape(
         base_lulc_uri, replacement_lucode, area_to_convert,
         focal_landcover_codes, convertible_type_list, score_weight, n_steps,
         smooth_distance_from_edge_uri, output_landscape_raster_uri,
-        stats_uri):
+        stats_uri, incremental=False,
+        max_in_memory_pixels=_MAX_IN_MEMORY_PIXELS):
     """Expand replacement lucodes in relation to the focal lucodes.
 
     If the sign on `score_weight` is positive, expansion occurs marches
@@ -175,6 +275,13 @@ def _convert_landscape(
             contain the final fragmented forest layer.
         stats_uri (string): a path to an output csv that records the number
             type, and area of pixels converted in `output_landscape_raster_uri`
+        incremental (boolean): if True, after the first step the distance
+            rasters are only updated in the tiles that can be affected by the
+            pixels converted in the previous step.
+        max_in_memory_pixels (int): if the landscape has at most this many
+            pixels the steps are run in memory by
+            `_convert_landscape_in_memory` and the disk based pass is only
+            used for any steps it could not complete.
 
     Returns:
         None.
@@ -182,7 +289,6 @@ def _convert_landscape(
     tmp_file_registry = {
         'non_base_mask': pygeoprocessing.temporary_filename(),
         'base_mask': pygeoprocessing.temporary_filename(),
-        'gaussian_kernel': pygeoprocessing.temporary_filename(),
         'distance_from_base_mask_edge': pygeoprocessing.temporary_filename(),
         'distance_from_non_base_mask_edge':
             pygeoprocessing.temporary_filename(),
@@ -192,17 +298,21 @@ def _convert_landscape(
     }
     # a sigma of 1.0 gives nice visual results to smooth pixel level artifacts
     # since a pixel is the 1.0 unit
-    _make_gaussian_kernel_uri(1.0, tmp_file_registry['gaussian_kernel'])
+    gaussian_kernel = _gaussian_kernel_1d(1.0)
+    n_rows, n_cols = pygeoprocessing.get_row_col_from_uri(base_lulc_uri)
+    in_memory = n_rows * n_cols <= max_in_memory_pixels
 
     # create the output raster first as a copy of the base landcover so it can
-    # be looped on for each step
+    # be looped on for each step; it is rewritten in place on every step so it
+    # stays uncompressed until the last one
     lulc_nodata = pygeoprocessing.get_nodata_from_uri(base_lulc_uri)
     pixel_size_out = pygeoprocessing.get_cell_size_from_uri(base_lulc_uri)
     mask_nodata = 2
     pygeoprocessing.vectorize_datasets(
         [base_lulc_uri], lambda x: x, output_landscape_raster_uri,
         gdal.GDT_Int32, lulc_nodata, pixel_size_out, "intersection",
-        vectorize_op=False, datasets_are_pre_aligned=True)
+        vectorize_op=False, datasets_are_pre_aligned=True,
+        dataset_options=utils.SCRATCH_GTIFF_OPTIONS)
 
     # convert everything furthest from edge for each of n_steps
     pixel_area_ha = (
@@ -213,95 +323,247 @@ def _convert_landscape(
     pixels_to_convert = max_pixels_to_convert / n_steps
     stats_cache = collections.defaultdict(int)
 
-    # pylint complains when these are defined inside the loop
-    invert_mask = None
-    distance_nodata = None
-
-    for step_index in xrange(n_steps):
-        LOGGER.info('step %d of %d', step_index+1, n_steps)
+    step_pixels_to_convert = []
+    for _ in xrange(n_steps):
         pixels_left_to_convert -= pixels_to_convert
 
         # Often the last segement of the steps will overstep the  number of
         # pixels to convert, this check converts the exact amount
         if pixels_left_to_convert < 0:
             pixels_to_convert += pixels_left_to_convert
+        step_pixels_to_convert.append(pixels_to_convert)
+
+    n_steps_completed = 0
+    if in_memory:
+        LOGGER.info('converting %d pixels in memory', n_rows * n_cols)
+        n_steps_completed = _convert_landscape_in_memory(
+            output_landscape_raster_uri, replacement_lucode,
+            focal_landcover_codes, convertible_type_list, score_weight,
+            step_pixels_to_convert, gaussian_kernel,
+            smooth_distance_from_edge_uri, stats_cache)
 
-        # create distance transforms for inside and outside the base lulc codes
-        LOGGER.info('create distance transform for current landcover')
-        for invert_mask, mask_id, distance_id in [
-            (False, 'non_base_mask', 'distance_from_non_base_mask_edge'),
-            (True, 'base_mask', 'distance_from_base_mask_edge')]:
+    # pylint complains when these are defined inside the loop
+    invert_mask = None
+    distance_nodata = None
+    converted_flat_indexes = None
+    tile_max_distance = None
 
-            def _mask_base_op(lulc_array):
-                """Create a mask of valid non-base pixels only."""
-                base_mask = numpy.in1d(
-                    lulc_array.flatten(), focal_landcover_codes).reshape(
-                    lulc_array.shape)
-                if invert_mask:
-                    base_mask = ~base_mask
+    for step_index in xrange(n_steps_completed, n_steps):
+        LOGGER.info('step %d of %d', step_index+1, n_steps)
+        pixels_to_convert = step_pixels_to_convert[step_index]
+
+        distances_updated = False
+        if incremental and converted_flat_indexes is not None:
+            LOGGER.info('update distance transform around converted pixels')
+            distances_updated = _update_convertible_distances(
+                output_landscape_raster_uri, converted_flat_indexes,
+                tile_max_distance, focal_landcover_codes,
+                convertible_type_list, convertible_type_nodata,
+                gaussian_kernel, tmp_file_registry,
+                smooth_distance_from_edge_uri)
+
+        if not distances_updated:
+            # create distance transforms for inside and outside the base lulc
+            # codes
+            LOGGER.info('create distance transform for current landcover')
+            for invert_mask, mask_id, distance_id in [
+                (False, 'non_base_mask', 'distance_from_non_base_mask_edge'),
+                (True, 'base_mask', 'distance_from_base_mask_edge')]:
+
+                def _mask_base_op(lulc_array):
+                    """Create a mask of valid non-base pixels only."""
+                    base_mask = numpy.in1d(
+                        lulc_array.flatten(), focal_landcover_codes).reshape(
+                        lulc_array.shape)
+                    if invert_mask:
+                        base_mask = ~base_mask
+                    return numpy.where(
+                        lulc_array == lulc_nodata, mask_nodata, base_mask)
+                pygeoprocessing.vectorize_datasets(
+                    [output_landscape_raster_uri], _mask_base_op,
+                    tmp_file_registry[mask_id], gdal.GDT_Byte,
+                    mask_nodata, pixel_size_out, "intersection",
+                    vectorize_op=False, datasets_are_pre_aligned=True,
+                    dataset_options=utils.SCRATCH_GTIFF_OPTIONS)
+
+                # create distance transform for the current mask
+                pygeoprocessing.distance_transform_edt(
+                    tmp_file_registry[mask_id], tmp_file_registry[distance_id])
+
+            # combine inner and outer distance transforms into one
+            distance_nodata = pygeoprocessing.get_nodata_from_uri(
+                tmp_file_registry['distance_from_base_mask_edge'])
+
+            def _combine_masks(base_distance_array, non_base_distance_array):
+                """create a mask of valid non-base pixels only."""
+                result = non_base_distance_array
+                valid_base_mask = base_distance_array > 0.0
+                result[valid_base_mask] = base_distance_array[valid_base_mask]
+                return result
+            pygeoprocessing.vectorize_datasets(
+                [tmp_file_registry['distance_from_base_mask_edge'],
+                 tmp_file_registry['distance_from_non_base_mask_edge']],
+                _combine_masks, tmp_file_registry['distance_from_edge'],
+                gdal.GDT_Float32, distance_nodata, pixel_size_out,
+                "intersection",
+                vectorize_op=False, datasets_are_pre_aligned=True,
+                dataset_options=utils.SCRATCH_GTIFF_OPTIONS)
+
+            # smooth the distance transform to avoid scanline artifacts
+            _smooth_raster_uri(
+                tmp_file_registry['distance_from_edge'], gaussian_kernel,
+                smooth_distance_from_edge_uri)
+
+            # turn inside and outside masks into a single mask
+            def _mask_to_convertible_codes(distance_from_base_edge, lulc):
+                """Mask out the distance transform to a set of lucodes."""
+                convertible_mask = numpy.in1d(
+                    lulc.flatten(), convertible_type_list).reshape(lulc.shape)
                 return numpy.where(
-                    lulc_array == lulc_nodata, mask_nodata, base_mask)
+                    convertible_mask, distance_from_base_edge,
+                    convertible_type_nodata)
             pygeoprocessing.vectorize_datasets(
-                [output_landscape_raster_uri], _mask_base_op,
-                tmp_file_registry[mask_id], gdal.GDT_Byte,
-                mask_nodata, pixel_size_out, "intersection",
-                vectorize_op=False, datasets_are_pre_aligned=True)
-
-            # create distance transform for the current mask
-            pygeoprocessing.distance_transform_edt(
-                tmp_file_registry[mask_id], tmp_file_registry[distance_id])
-
-        # combine inner and outer distance transforms into one
-        distance_nodata = pygeoprocessing.get_nodata_from_uri(
-            tmp_file_registry['distance_from_base_mask_edge'])
-
-        def _combine_masks(base_distance_array, non_base_distance_array):
-            """create a mask of valid non-base pixels only."""
-            result = non_base_distance_array
-            valid_base_mask = base_distance_array > 0.0
-            result[valid_base_mask] = base_distance_array[valid_base_mask]
-            return result
-        pygeoprocessing.vectorize_datasets(
-            [tmp_file_registry['distance_from_base_mask_edge'],
-             tmp_file_registry['distance_from_non_base_mask_edge']],
-            _combine_masks, tmp_file_registry['distance_from_edge'],
-            gdal.GDT_Float32, distance_nodata, pixel_size_out, "intersection",
-            vectorize_op=False, datasets_are_pre_aligned=True)
+                [smooth_distance_from_edge_uri, output_landscape_raster_uri],
+                _mask_to_convertible_codes,
+                tmp_file_registry['convertible_distances'], gdal.GDT_Float32,
+                convertible_type_nodata, pixel_size_out, "intersection",
+                vectorize_op=False, datasets_are_pre_aligned=True,
+                dataset_options=utils.SCRATCH_GTIFF_OPTIONS)
 
-        # smooth the distance transform to avoid scanline artifacts
-        pygeoprocessing.convolve_2d_uri(
-            tmp_file_registry['distance_from_edge'],
-            tmp_file_registry['gaussian_kernel'],
-            smooth_distance_from_edge_uri)
-
-        # turn inside and outside masks into a single mask
-        def _mask_to_convertible_codes(distance_from_base_edge, lulc):
-            """Mask out the distance transform to a set of lucodes."""
-            convertible_mask = numpy.in1d(
-                lulc.flatten(), convertible_type_list).reshape(lulc.shape)
-            return numpy.where(
-                convertible_mask, distance_from_base_edge,
-                convertible_type_nodata)
-        pygeoprocessing.vectorize_datasets(
-            [smooth_distance_from_edge_uri, output_landscape_raster_uri],
-            _mask_to_convertible_codes,
-            tmp_file_registry['convertible_distances'], gdal.GDT_Float32,
-            convertible_type_nodata, pixel_size_out, "intersection",
-            vectorize_op=False, datasets_are_pre_aligned=True)
+            if incremental:
+                tile_max_distance = _calculate_tile_max_distance(
+                    tmp_file_registry['distance_from_edge'])
 
         LOGGER.info(
             'convert %d pixels to lucode %d', pixels_to_convert,
             replacement_lucode)
-        _convert_by_score(
+        converted_flat_indexes = _convert_by_score(
             tmp_file_registry['convertible_distances'], pixels_to_convert,
             output_landscape_raster_uri, replacement_lucode, stats_cache,
             score_weight)
 
     _log_stats(stats_cache, pixel_area_ha, stats_uri)
+    utils.compress_raster(output_landscape_raster_uri)
     for filename in tmp_file_registry.values():
         os.remove(filename)
 
 
+def _convert_landscape_in_memory(
+        landscape_raster_uri, replacement_lucode, focal_landcover_codes,
+        convertible_type_list, score_weight, step_pixels_to_convert,
+        kernel, smooth_distance_from_edge_uri, stats_cache):
+    """Run the conversion steps with the whole landscape held in memory.
+
+    Equivalent to the disk based steps in `_convert_landscape` but the
+    landcover, distance and score arrays are kept as numpy arrays and the
+    distance transform and smoothing are done with `scipy.ndimage`.  Only
+    the final landscape and smoothed distance are written to disk.
+
+    Parameters:
+        landscape_raster_uri (string): path to the landcover raster to
+            convert, modified in place.
+        replacement_lucode (int): landcover code to convert pixels to
+        focal_landcover_codes (list of int): landcover codes that are used to
+            calculate proximity
+        convertible_type_list (list of int): landcover codes that are allowable
+            to be converted
+        score_weight (float): multiplies the smoothed distance from the focal
+            edge to rank the pixels to convert, lowest first.
+        step_pixels_to_convert (list of int): number of pixels to convert on
+            each step
+        kernel (numpy.array): 1D normalized kernel applied along both axes
+            to smooth the distance from edge
+        smooth_distance_from_edge_uri (string): path to an output raster of
+            the smoothed distance from edge of the last completed step
+        stats_cache (collections.defaultdict(int)): updated with the number
+            of pixels converted indexed by original landcover code.
+
+    Returns:
+        number of steps completed.  Less than the length of
+        `step_pixels_to_convert` if the focal edge vanished from the
+        landscape, in which case the remaining steps should be run on disk.
+    """
+    landscape_ds = gdal.Open(landscape_raster_uri, gdal.GA_Update)
+    landscape_band = landscape_ds.GetRasterBand(1)
+    lulc_nodata = landscape_band.GetNoDataValue()
+    lulc_array = landscape_band.ReadAsArray()
+    valid_mask = lulc_array != lulc_nodata
+    smooth_distance_array = None
+
+    n_steps_completed = 0
+    for step_index, pixels_to_convert in enumerate(step_pixels_to_convert):
+        LOGGER.info(
+            'step %d of %d in memory', step_index+1,
+            len(step_pixels_to_convert))
+        focal_mask = numpy.in1d(
+            lulc_array.flatten(), focal_landcover_codes).reshape(
+                lulc_array.shape)
+        focal_mask &= valid_mask
+        non_focal_mask = ~focal_mask & valid_mask
+        if not focal_mask.any() or not non_focal_mask.any():
+            LOGGER.info('focal edge vanished, continuing on disk')
+            break
+
+        # distance to the nearest focal pixel outside of the focal types and
+        # to the nearest non-focal pixel inside of them, nodata as 0
+        non_base_distance = scipy.ndimage.distance_transform_edt(
+            ~focal_mask).astype(numpy.float32)
+        base_distance = scipy.ndimage.distance_transform_edt(
+            ~non_focal_mask).astype(numpy.float32)
+        distance_array = numpy.where(
+            focal_mask, base_distance, non_base_distance)
+        distance_array[~valid_mask] = 0.0
+        non_base_distance = None
+        base_distance = None
+
+        # smooth the distance transform to avoid scanline artifacts
+        smooth_distance_array = _smooth_array(
+            distance_array, kernel).astype(numpy.float32)
+        distance_array = None
+
+        convertible_mask = numpy.in1d(
+            lulc_array.flatten(), convertible_type_list).reshape(
+                lulc_array.shape)
+        flat_indexes = numpy.flatnonzero(convertible_mask).astype(
+            _SORT_INDEX_TYPE)
+        scores = (
+            smooth_distance_array.ravel()[flat_indexes] *
+            score_weight).astype(_SORT_SCORE_TYPE)
+        if pixels_to_convert > 0:
+            _, flat_indexes = _partition_smallest(
+                scores, flat_indexes, pixels_to_convert)
+        else:
+            flat_indexes = flat_indexes[:0]
+
+        LOGGER.info(
+            'convert %d pixels to lucode %d', flat_indexes.size,
+            replacement_lucode)
+        flat_lulc = lulc_array.ravel()
+        unique_ids, id_inverse = numpy.unique(
+            flat_lulc[flat_indexes], return_inverse=True)
+        for unique_id, id_count in zip(
+                unique_ids, numpy.bincount(id_inverse)):
+            stats_cache[unique_id] += id_count
+        flat_lulc[flat_indexes] = replacement_lucode
+        n_steps_completed += 1
+
+    landscape_band.WriteArray(lulc_array)
+    landscape_band.FlushCache()
+    landscape_band = None
+    landscape_ds = None
+
+    if smooth_distance_array is not None:
+        pygeoprocessing.new_raster_from_base_uri(
+            landscape_raster_uri, smooth_distance_from_edge_uri, 'GTiff',
+            _SMOOTH_DISTANCE_NODATA, gdal.GDT_Float32,
+            dataset_options=utils.SCRATCH_GTIFF_OPTIONS)
+        smooth_ds = gdal.Open(smooth_distance_from_edge_uri, gdal.GA_Update)
+        smooth_ds.GetRasterBand(1).WriteArray(smooth_distance_array)
+        smooth_ds.FlushCache()
+        smooth_ds = None
+    return n_steps_completed
+
+
 def _log_stats(stats_cache, pixel_area, stats_uri):
     """Write pixel change statistics to a file in tabular format.
 
@@ -330,69 +592,23 @@ def _log_stats(stats_cache, pixel_area, stats_uri):
 def _sort_to_disk(dataset_uri, score_weight=1.0):
     """Return an iterable of non-nodata pixels in sorted order.
 
+    Each memory block of `dataset_uri` is sorted and written to disk as a
+    pair of flat binary "runs" (scores and flat indexes) which are then
+    memory mapped and merged in vectorized batches rather than one pixel at
+    a time.
+
     Parameters:
         dataset_uri (string): a path to a floating point GDAL dataset
         score_weight (float): a number to multiply all values by, which can be
             used to reverse the order of the iteration if negative.
 
     Returns:
-        an iterable that produces (value * score_weight, flat_index) in
-        decreasing sorted order by value * score_weight
+        an iterable that produces (scores, flat_indexes) pairs of 1D numpy
+        arrays.  The concatenation of the batches is in increasing order of
+        (value * score_weight, flat_index).
     """
-    def _read_score_index_from_disk(
-            score_file_path, index_file_path):
-        """Generator to yield a float/int value from the given filenames.
-
-        Reads a buffer of `buffer_size` big before to avoid keeping the
-        file open between generations.
-
-        score_file_path (string): a path to a file that has 32 bit floats
-            packed consecutively
-        index_file_path (string): a path to a file that has 32 bit ints
-            packed consecutively
-
-        Yields:
-            next (score, index) tuple in the given score and index files.
-        """
-        try:
-            score_buffer = ''
-            index_buffer = ''
-            file_offset = 0
-            buffer_offset = 0  # initialize to 0 to trigger the first load
-
-            # ensure buffer size that is not a perfect multiple of 4
-            read_buffer_size = int(math.sqrt(_BLOCK_SIZE))
-            read_buffer_size = read_buffer_size - read_buffer_size % 4
-
-            while True:
-                if buffer_offset == len(score_buffer):
-                    score_file = open(score_file_path, 'rb')
-                    index_file = open(index_file_path, 'rb')
-                    score_file.seek(file_offset)
-                    index_file.seek(file_offset)
-
-                    score_buffer = score_file.read(read_buffer_size)
-                    index_buffer = index_file.read(read_buffer_size)
-                    score_file.close()
-                    index_file.close()
-
-                    file_offset += read_buffer_size
-                    buffer_offset = 0
-                packed_score = score_buffer[buffer_offset:buffer_offset+4]
-                packed_index = index_buffer[buffer_offset:buffer_offset+4]
-                buffer_offset += 4
-                if not packed_score:
-                    break
-                yield (struct.unpack('f', packed_score)[0],
-                       struct.unpack('i', packed_index)[0])
-        finally:
-            # deletes the files when generator goes out of scope or ends
-            os.remove(score_file_path)
-            os.remove(index_file_path)
-
-    def _sort_cache_to_iterator(
-            index_cache, score_cache):
-        """Flushe the current cache to a heap and return it.
+    def _sort_cache_to_disk(index_cache, score_cache):
+        """Sort the cache and write it to disk as a run.
 
         Parameters:
             index_cache (1d numpy.array): contains flat indexes to the
@@ -400,35 +616,27 @@ def _sort_to_disk(dataset_uri, score_weight=1.0):
             score_cache (1d numpy.array): contains score pixels
 
         Returns:
-            Iterable to visit scores/indexes in increasing score order.
+            (score_file_path, index_file_path) tuple of paths to files that
+            contain the scores and indexes of the cache packed consecutively
+            in increasing (score, index) order.
         """
-        # sort the whole bunch to disk
         score_file = tempfile.NamedTemporaryFile(delete=False)
         index_file = tempfile.NamedTemporaryFile(delete=False)
 
-        sort_index = score_cache.argsort()
-        score_cache = score_cache[sort_index]
-        index_cache = index_cache[sort_index]
-        for index in xrange(0, score_cache.size, _LARGEST_STRUCT_PACK):
-            score_block = score_cache[index:index+_LARGEST_STRUCT_PACK]
-            index_block = index_cache[index:index+_LARGEST_STRUCT_PACK]
-            score_file.write(
-                struct.pack('%sf' % score_block.size, *score_block))
-            index_file.write(
-                struct.pack('%si' % index_block.size, *index_block))
-
-        score_file_path = score_file.name
-        index_file_path = index_file.name
+        # lexsort sorts on the last key first, so ties are broken by index
+        sort_index = numpy.lexsort((index_cache, score_cache))
+        score_cache[sort_index].tofile(score_file)
+        index_cache[sort_index].tofile(index_file)
+
         score_file.close()
         index_file.close()
-
-        return _read_score_index_from_disk(score_file_path, index_file_path)
+        return (score_file.name, index_file.name)
 
     nodata = pygeoprocessing.get_nodata_from_uri(dataset_uri)
     nodata *= score_weight  # scale the nodata so they can be filtered out
 
-    # This will be a list of file iterators we'll pass to heap.merge
-    iters = []
+    # This will be a list of (score path, index path) runs to merge
+    run_list = []
 
     _, n_cols = pygeoprocessing.get_row_col_from_uri(dataset_uri)
 
@@ -438,31 +646,482 @@ def _sort_to_disk(dataset_uri, score_weight=1.0):
         scores_block = scores_block.flatten() * score_weight
 
         col_coords, row_coords = numpy.meshgrid(
-            xrange(scores_data['xoff'], scores_data['xoff'] +
-                   scores_data['win_xsize']),
-            xrange(scores_data['yoff'], scores_data['yoff'] +
-                   scores_data['win_ysize']))
+            numpy.arange(
+                scores_data['xoff'],
+                scores_data['xoff'] + scores_data['win_xsize'],
+                dtype=_SORT_INDEX_TYPE),
+            numpy.arange(
+                scores_data['yoff'],
+                scores_data['yoff'] + scores_data['win_ysize'],
+                dtype=_SORT_INDEX_TYPE))
 
         flat_indexes = (col_coords + row_coords * n_cols).flatten()
 
-        sort_index = scores_block.argsort()
-        sorted_scores = scores_block[sort_index]
-        sorted_indexes = flat_indexes[sort_index]
+        # remove nodata values
+        valid_mask = scores_block != nodata
+        if not valid_mask.any():
+            continue
+
+        run_list.append(_sort_cache_to_disk(
+            flat_indexes[valid_mask],
+            scores_block[valid_mask].astype(_SORT_SCORE_TYPE)))
 
-        # search for nodata values are so we can splice them out
-        left_index = numpy.searchsorted(sorted_scores, nodata, side='left')
-        right_index = numpy.searchsorted(
-            sorted_scores, nodata, side='right')
+    return _merge_sorted_runs(run_list)
 
-        # remove nodata values
-        score_cache = numpy.concatenate(
-            (sorted_scores[0:left_index], sorted_scores[right_index::]))
-        index_cache = numpy.concatenate(
-            (sorted_indexes[0:left_index], sorted_indexes[right_index::]))
 
-        iters.append(_sort_cache_to_iterator(index_cache, score_cache))
+def _merge_sorted_runs(run_list):
+    """Generator to k-way merge sorted runs from disk in vectorized batches.
 
-    return heapq.merge(*iters)
+    Each run is memory mapped and a chunk of every run is visited per batch.
+    Every element that is no greater than the smallest "last element" of the
+    chunks of the runs that are not yet exhausted can be safely emitted since
+    any unread element is at least that large.  At least one full chunk is
+    emitted per batch.
+
+    Parameters:
+        run_list (list): list of (score_file_path, index_file_path) tuples
+            as produced by `_sort_to_disk`.  The files are removed when the
+            generator ends or goes out of scope.
+
+    Yields:
+        (scores, flat_indexes) tuple of 1D numpy arrays for the next batch of
+        the merged runs in increasing (score, index) order.
+    """
+    score_maps = []
+    index_maps = []
+    try:
+        for score_file_path, index_file_path in run_list:
+            score_maps.append(numpy.memmap(
+                score_file_path, dtype=_SORT_SCORE_TYPE, mode='r'))
+            index_maps.append(numpy.memmap(
+                index_file_path, dtype=_SORT_INDEX_TYPE, mode='r'))
+
+        # bound the working memory of a batch to roughly one block
+        chunk_size = max(
+            _BLOCK_SIZE // max(len(run_list), 1), _MIN_MERGE_CHUNK_SIZE)
+        run_offsets = [0] * len(run_list)
+        active_runs = range(len(run_list))
+
+        while active_runs:
+            chunk_list = []
+            cutoff = None
+            for run_index in active_runs:
+                start = run_offsets[run_index]
+                end = min(start + chunk_size, score_maps[run_index].size)
+                score_chunk = numpy.array(score_maps[run_index][start:end])
+                index_chunk = numpy.array(index_maps[run_index][start:end])
+                chunk_list.append((run_index, score_chunk, index_chunk))
+                if end < score_maps[run_index].size:
+                    # unread values in this run are all >= its last value
+                    last = (score_chunk[-1], index_chunk[-1])
+                    if cutoff is None or last < cutoff:
+                        cutoff = last
+
+            batch_scores = []
+            batch_indexes = []
+            for run_index, score_chunk, index_chunk in chunk_list:
+                if cutoff is None:
+                    n_valid = score_chunk.size
+                else:
+                    # count elements <= cutoff in (score, index) order
+                    left = numpy.searchsorted(
+                        score_chunk, cutoff[0], side='left')
+                    right = numpy.searchsorted(
+                        score_chunk, cutoff[0], side='right')
+                    n_valid = left + numpy.searchsorted(
+                        index_chunk[left:right], cutoff[1], side='right')
+                batch_scores.append(score_chunk[:n_valid])
+                batch_indexes.append(index_chunk[:n_valid])
+                run_offsets[run_index] += n_valid
+
+            active_runs = [
+                run_index for run_index in active_runs
+                if run_offsets[run_index] < score_maps[run_index].size]
+
+            batch_scores = numpy.concatenate(batch_scores)
+            batch_indexes = numpy.concatenate(batch_indexes)
+            sort_index = numpy.lexsort((batch_indexes, batch_scores))
+            yield batch_scores[sort_index], batch_indexes[sort_index]
+    finally:
+        # memory maps must be released before the files can be removed
+        del score_maps[:]
+        del index_maps[:]
+        for score_file_path, index_file_path in run_list:
+            os.remove(score_file_path)
+            os.remove(index_file_path)
+
+
+def _select_top_k(dataset_uri, k, score_weight=1.0):
+    """Generator to select the `k` smallest non-nodata pixels in sorted order.
+
+    An alternative to `_sort_to_disk` for when only the best `k` pixels are
+    needed.  Each memory block is filtered against the current k-th best
+    score, merged with the running candidates, and cut back down to `k`
+    elements with `numpy.argpartition`.  Only the final winners are sorted
+    and nothing is written to disk.
+
+    Parameters:
+        dataset_uri (string): a path to a floating point GDAL dataset
+        k (int): the maximum number of pixels to select
+        score_weight (float): a number to multiply all values by, which can be
+            used to reverse the order of the iteration if negative.
+
+    Yields:
+        a single (scores, flat_indexes) pair of 1D numpy arrays of at most
+        `k` elements in increasing order of (value * score_weight,
+        flat_index), the same order and format as `_sort_to_disk`.  Scores
+        are compared as `_SORT_SCORE_TYPE`, the type `_sort_to_disk` sorts,
+        and NaN scores come after every number as they do in its runs, so
+        they are only selected if there are fewer than `k` numbers.
+    """
+    nodata = pygeoprocessing.get_nodata_from_uri(dataset_uri)
+    nodata *= score_weight  # scale the nodata so they can be filtered out
+
+    _, n_cols = pygeoprocessing.get_row_col_from_uri(dataset_uri)
+
+    candidate_scores = numpy.empty((0,), dtype=_SORT_SCORE_TYPE)
+    candidate_indexes = numpy.empty((0,), dtype=_SORT_INDEX_TYPE)
+    # the lowest flat indexes of NaN scores, needed until k numbers are found
+    nan_indexes = numpy.empty((0,), dtype=_SORT_INDEX_TYPE)
+    # the k-th best score seen so far, None until k candidates are found
+    threshold = None
+
+    if k > 0:
+        for scores_data, scores_block in pygeoprocessing.iterblocks(
+                dataset_uri, largest_block=_BLOCK_SIZE):
+            # flatten and scale the results, nodata is removed before the
+            # scores are cast like in `_sort_to_disk`
+            scores_block = scores_block.flatten() * score_weight
+            valid_mask = scores_block != nodata
+            scores_block = scores_block.astype(_SORT_SCORE_TYPE)
+            nan_mask = valid_mask & numpy.isnan(scores_block)
+            valid_mask &= ~nan_mask
+            if threshold is not None:
+                # nothing worse than the current k-th best can be selected
+                valid_mask &= scores_block <= threshold
+                nan_mask[:] = False
+            if not valid_mask.any() and not nan_mask.any():
+                continue
+
+            col_coords, row_coords = numpy.meshgrid(
+                numpy.arange(
+                    scores_data['xoff'],
+                    scores_data['xoff'] + scores_data['win_xsize'],
+                    dtype=_SORT_INDEX_TYPE),
+                numpy.arange(
+                    scores_data['yoff'],
+                    scores_data['yoff'] + scores_data['win_ysize'],
+                    dtype=_SORT_INDEX_TYPE))
+            flat_indexes = (col_coords + row_coords * n_cols).flatten()
+
+            if nan_mask.any():
+                nan_indexes = numpy.concatenate((
+                    nan_indexes, flat_indexes[nan_mask]))
+                if nan_indexes.size > k:
+                    nan_indexes = numpy.partition(nan_indexes, k-1)[:k]
+
+            candidate_scores = numpy.concatenate((
+                candidate_scores, scores_block[valid_mask]))
+            candidate_indexes = numpy.concatenate((
+                candidate_indexes, flat_indexes[valid_mask]))
+
+            if candidate_scores.size >= k:
+                candidate_scores, candidate_indexes = _partition_smallest(
+                    candidate_scores, candidate_indexes, k)
+                threshold = candidate_scores.max()
+
+    sort_index = numpy.lexsort((candidate_indexes, candidate_scores))
+    candidate_scores = candidate_scores[sort_index]
+    candidate_indexes = candidate_indexes[sort_index]
+    if threshold is None and nan_indexes.size > 0:
+        # fewer than k numbers, fill up with NaN scores in index order
+        nan_indexes = numpy.sort(nan_indexes)[:k - candidate_scores.size]
+        candidate_scores = numpy.concatenate((
+            candidate_scores,
+            numpy.full(nan_indexes.size, numpy.nan, dtype=_SORT_SCORE_TYPE)))
+        candidate_indexes = numpy.concatenate((
+            candidate_indexes, nan_indexes))
+    yield candidate_scores, candidate_indexes
+
+
+def _partition_smallest(scores, indexes, k):
+    """Keep the `k` smallest elements in (score, index) order.
+
+    Parameters:
+        scores (1d numpy.array): scores of the elements
+        indexes (1d numpy.array): unique flat indexes parallel to `scores`,
+            used to break ties between equal scores
+        k (int): number of elements to keep, must be at least 1
+
+    Returns:
+        (scores, indexes) tuple of 1D numpy arrays of at most `k` elements in
+        no particular order.
+    """
+    if scores.size <= k:
+        return scores, indexes
+    kth_score = scores[numpy.argpartition(scores, k-1)[k-1]]
+    keep_mask = scores < kth_score
+
+    # fill the remaining places with the lowest indexes tied at kth_score
+    tie_mask = scores == kth_score
+    n_ties_to_keep = k - numpy.count_nonzero(keep_mask)
+    tie_indexes = indexes[tie_mask]
+    largest_tie_index = tie_indexes[numpy.argpartition(
+        tie_indexes, n_ties_to_keep-1)[n_ties_to_keep-1]]
+    keep_mask |= tie_mask & (indexes <= largest_tie_index)
+    return scores[keep_mask], indexes[keep_mask]
+
+
+def _calculate_tile_max_distance(distance_uri):
+    """Calculate the largest valid distance in each tile of a raster.
+
+    Parameters:
+        distance_uri (string): path to a floating point distance raster.
+
+    Returns:
+        2D numpy.array of the largest non-nodata value in each
+        `_DISTANCE_TILE_SIZE` square tile of `distance_uri`.  Tiles with no
+        valid pixels are set to -1.
+    """
+    distance_ds = gdal.Open(distance_uri)
+    distance_band = distance_ds.GetRasterBand(1)
+    distance_nodata = distance_band.GetNoDataValue()
+    n_rows = distance_band.YSize
+    n_cols = distance_band.XSize
+    tile_max_distance = numpy.empty((
+        int(math.ceil(n_rows / float(_DISTANCE_TILE_SIZE))),
+        int(math.ceil(n_cols / float(_DISTANCE_TILE_SIZE)))))
+    for tile_row in xrange(tile_max_distance.shape[0]):
+        for tile_col in xrange(tile_max_distance.shape[1]):
+            row_start, row_end, col_start, col_end = _tile_window(
+                tile_row, tile_col, 0, n_rows, n_cols)
+            distance_array = distance_band.ReadAsArray(
+                xoff=col_start, yoff=row_start,
+                win_xsize=col_end-col_start, win_ysize=row_end-row_start)
+            valid_distances = distance_array[
+                distance_array != distance_nodata]
+            if valid_distances.size > 0:
+                tile_max_distance[tile_row, tile_col] = valid_distances.max()
+            else:
+                tile_max_distance[tile_row, tile_col] = -1
+    distance_band = None
+    distance_ds = None
+    return tile_max_distance
+
+
+def _tile_window(tile_row, tile_col, halo, n_rows, n_cols):
+    """Calculate the pixel window of a tile expanded by a halo.
+
+    Parameters:
+        tile_row (int): row index of the tile in the tile grid
+        tile_col (int): column index of the tile in the tile grid
+        halo (int): number of pixels to expand the tile on each side
+        n_rows (int): number of rows in the raster, the window is clipped
+            to it
+        n_cols (int): number of columns in the raster, the window is clipped
+            to it
+
+    Returns:
+        (row_start, row_end, col_start, col_end) tuple of ints where the ends
+        are non-inclusive.
+    """
+    return (
+        max(tile_row * _DISTANCE_TILE_SIZE - halo, 0),
+        min((tile_row + 1) * _DISTANCE_TILE_SIZE + halo, n_rows),
+        max(tile_col * _DISTANCE_TILE_SIZE - halo, 0),
+        min((tile_col + 1) * _DISTANCE_TILE_SIZE + halo, n_cols))
+
+
+def _update_convertible_distances(
+        lulc_uri, converted_flat_indexes, tile_max_distance,
+        focal_landcover_codes, convertible_type_list,
+        convertible_type_nodata, kernel, tmp_file_registry,
+        smooth_distance_from_edge_uri):
+    """Update the distance rasters around recently converted pixels.
+
+    A pixel's distance to the focal edge can only change if a converted
+    pixel lies within its previous distance, so only tiles whose largest
+    previous distance reaches a converted pixel are recomputed.  Each of
+    those is recomputed with a distance transform over the tile plus a halo
+    that doubles until the result is provably exact.  The smoothed and
+    convertible distance rasters are then updated in the same tiles expanded
+    by the radius of `kernel`.
+
+    Parameters:
+        lulc_uri (string): path to the current landcover raster
+        converted_flat_indexes (numpy.array): flat indexes of the pixels in
+            `lulc_uri` that were converted since the distances were last
+            calculated.
+        tile_max_distance (numpy.array): the result of
+            `_calculate_tile_max_distance` on the current distance from edge
+            raster.  Updated in place.
+        focal_landcover_codes (list of int): landcover codes that are used to
+            calculate proximity
+        convertible_type_list (list of int): landcover codes that are allowable
+            to be converted
+        convertible_type_nodata (float): nodata value of the
+            convertible distances raster
+        kernel (numpy.array): 1D normalized kernel applied along both axes
+            to smooth the distance from edge raster
+        tmp_file_registry (dict): contains the 'distance_from_base_mask_edge',
+            'distance_from_non_base_mask_edge', 'distance_from_edge' and
+            'convertible_distances' rasters from the previous step as
+            created by `_convert_landscape`.  They are modified in place.
+        smooth_distance_from_edge_uri (string): path to the smoothed distance
+            from edge raster from the previous step, modified in place.
+
+    Returns:
+        True if the rasters were updated, False if the affected area is so
+        large that the caller should recalculate the distances over the
+        whole raster instead.
+    """
+    if converted_flat_indexes.size == 0:
+        return True
+
+    lulc_ds = gdal.Open(lulc_uri)
+    lulc_band = lulc_ds.GetRasterBand(1)
+    lulc_nodata = lulc_band.GetNoDataValue()
+    n_rows = lulc_band.YSize
+    n_cols = lulc_band.XSize
+
+    # lower bound of the distance from any pixel in a tile to the nearest
+    # converted pixel based on the chessboard distance between tiles
+    converted_tiles = numpy.ones(tile_max_distance.shape, dtype=numpy.bool)
+    converted_tiles[
+        (converted_flat_indexes // n_cols) // _DISTANCE_TILE_SIZE,
+        (converted_flat_indexes % n_cols) // _DISTANCE_TILE_SIZE] = False
+    tile_gap = scipy.ndimage.distance_transform_cdt(
+        converted_tiles, metric='chessboard')
+    min_converted_distance = numpy.where(
+        tile_gap > 0, (tile_gap - 1) * _DISTANCE_TILE_SIZE + 1, 0)
+    affected_tiles = zip(*numpy.nonzero(
+        (tile_max_distance >= 0) &
+        (tile_max_distance >= min_converted_distance)))
+
+    # a full pass is cheaper if the haloed windows cover the raster
+    affected_area = sum(
+        (_DISTANCE_TILE_SIZE + 2 * tile_max_distance[tile_index]) ** 2
+        for tile_index in affected_tiles)
+    if affected_area > n_rows * n_cols:
+        LOGGER.info(
+            '%d affected tiles cover the landscape, recalculating all '
+            'distances', len(affected_tiles))
+        return False
+    LOGGER.info('updating distances in %d tiles', len(affected_tiles))
+
+    distance_ds_list = [
+        gdal.Open(tmp_file_registry[distance_id], gdal.GA_Update)
+        for distance_id in [
+            'distance_from_non_base_mask_edge',
+            'distance_from_base_mask_edge', 'distance_from_edge']]
+    (non_base_distance_band, base_distance_band,
+     distance_band) = [
+         distance_ds.GetRasterBand(1) for distance_ds in distance_ds_list]
+    distance_nodata = distance_band.GetNoDataValue()
+
+    for tile_row, tile_col in affected_tiles:
+        row_start, row_end, col_start, col_end = _tile_window(
+            tile_row, tile_col, 0, n_rows, n_cols)
+        # distances may grow when focal pixels are removed, the halo is
+        # expanded until it covers every updated distance in the tile
+        halo = int(math.ceil(max(tile_max_distance[tile_row, tile_col], 1)))
+        while True:
+            (halo_row_start, halo_row_end, halo_col_start,
+             halo_col_end) = _tile_window(
+                 tile_row, tile_col, halo, n_rows, n_cols)
+            lulc_array = lulc_band.ReadAsArray(
+                xoff=halo_col_start, yoff=halo_row_start,
+                win_xsize=halo_col_end-halo_col_start,
+                win_ysize=halo_row_end-halo_row_start)
+            valid_mask = lulc_array != lulc_nodata
+            focal_mask = numpy.in1d(
+                lulc_array.flatten(), focal_landcover_codes).reshape(
+                    lulc_array.shape)
+            tile_slice = (
+                slice(row_start-halo_row_start, row_end-halo_row_start),
+                slice(col_start-halo_col_start, col_end-halo_col_start))
+            distance_list = []
+            for feature_mask in [
+                    focal_mask & valid_mask, ~focal_mask & valid_mask]:
+                if feature_mask.any():
+                    # distance to the nearest pixel in `feature_mask`
+                    distance_list.append(
+                        scipy.ndimage.distance_transform_edt(
+                            ~feature_mask)[tile_slice])
+                else:
+                    distance_list.append(numpy.empty(0))
+            tile_valid_mask = valid_mask[tile_slice]
+            window_is_raster = (
+                (halo_row_end - halo_row_start) == n_rows and
+                (halo_col_end - halo_col_start) == n_cols)
+            if window_is_raster or all(
+                    distance.size > 0 and
+                    distance[tile_valid_mask].max() <= halo
+                    for distance in distance_list):
+                break
+            halo *= 2
+
+        if any(distance.size == 0 for distance in distance_list):
+            # one side of the edge doesn't exist in the whole landscape
+            LOGGER.info('focal edge vanished, recalculating all distances')
+            return False
+
+        non_base_distance, base_distance = distance_list
+        non_base_distance[~tile_valid_mask] = distance_nodata
+        base_distance[~tile_valid_mask] = distance_nodata
+        distance = non_base_distance.copy()
+        valid_base_mask = base_distance > 0.0
+        distance[valid_base_mask] = base_distance[valid_base_mask]
+        for band, array in [
+                (non_base_distance_band, non_base_distance),
+                (base_distance_band, base_distance),
+                (distance_band, distance)]:
+            band.WriteArray(array, xoff=col_start, yoff=row_start)
+        if tile_valid_mask.any():
+            tile_max_distance[tile_row, tile_col] = (
+                distance[tile_valid_mask].max())
+
+    for band in [non_base_distance_band, base_distance_band, distance_band]:
+        band.FlushCache()
+
+    # smooth and mask the updated tiles plus the reach of the kernel
+    kernel_radius = kernel.size // 2
+    smooth_ds = gdal.Open(smooth_distance_from_edge_uri, gdal.GA_Update)
+    smooth_band = smooth_ds.GetRasterBand(1)
+    convertible_ds = gdal.Open(
+        tmp_file_registry['convertible_distances'], gdal.GA_Update)
+    convertible_band = convertible_ds.GetRasterBand(1)
+    for tile_row, tile_col in affected_tiles:
+        row_start, row_end, col_start, col_end = _tile_window(
+            tile_row, tile_col, kernel_radius, n_rows, n_cols)
+        (halo_row_start, halo_row_end, halo_col_start,
+         halo_col_end) = _tile_window(
+             tile_row, tile_col, 2 * kernel_radius, n_rows, n_cols)
+        distance_array = distance_band.ReadAsArray(
+            xoff=halo_col_start, yoff=halo_row_start,
+            win_xsize=halo_col_end-halo_col_start,
+            win_ysize=halo_row_end-halo_row_start).astype(numpy.float64)
+        distance_array[distance_array == distance_nodata] = 0.0
+        # outside of the raster is treated as 0, same as a full smoothing
+        smooth_array = _smooth_array(distance_array, kernel)[
+                row_start-halo_row_start:row_end-halo_row_start,
+                col_start-halo_col_start:col_end-halo_col_start]
+        smooth_band.WriteArray(smooth_array, xoff=col_start, yoff=row_start)
+
+        lulc_array = lulc_band.ReadAsArray(
+            xoff=col_start, yoff=row_start, win_xsize=col_end-col_start,
+            win_ysize=row_end-row_start)
+        convertible_mask = numpy.in1d(
+            lulc_array.flatten(), convertible_type_list).reshape(
+                lulc_array.shape)
+        convertible_band.WriteArray(
+            numpy.where(
+                convertible_mask, smooth_array, convertible_type_nodata),
+            xoff=col_start, yoff=row_start)
+
+    smooth_band.FlushCache()
+    convertible_band.FlushCache()
+    return True
 
 
 def _convert_by_score(
@@ -491,172 +1150,229 @@ def _convert_by_score(
             pixels converted indexed by original pixel id.
 
     Returns:
-        None.
+        1D numpy.array of the flat indexes of the converted pixels.
     """
     def _flush_cache_to_band(
-            data_array, row_array, col_array, valid_index, dirty_blocks,
-            out_band, stats_counter):
+            flat_index_array, valid_index, out_band, stats_counter):
         """Flush block cache to the output band.
 
         Provided as an internal function because the exact operation needs
         to be invoked inside the processing loop and again at the end to
         finalize the scan.
 
+        Pending pixels are grouped by the memory block of `out_band` they
+        fall in so that each touched block is read and written exactly once
+        and all of its pixels are converted with one fancy index.
+
         Parameters:
-            data_array (numpy array): 1D array of valid data in buffer
-            row_array (numpy array): 1D array to indicate row indexes for
-                `data_array`
-            col_array (numpy array): 1D array to indicate col indexes for
-                `data_array`
+            flat_index_array (numpy array): 1D array of flat indexes of the
+                pixels to convert in `out_band`
             valid_index (int): value indicates the non-inclusive left valid
-                entry in the parallel input arrays
-            dirty_blocks (set): contains tuples indicating the block row and
-                column indexes that will need to be set in `out_band`.  Allows
-                us to skip the examination of the entire sparse matrix.
+                entry in `flat_index_array`
             out_band (gdal.Band): output band to write to
             stats_counter (collections.defaultdict(int)): is updated so that
-                the key corresponds to ids in out_band that get set by the
-                sparse matrix, and the number of pixels converted is added
-                to the value of that entry.
+                the key corresponds to ids in out_band that get converted,
+                and the number of pixels converted is added to the value of
+                that entry.
 
         Returns:
             None
         """
-        # construct sparse matrix so it can be indexed later
-        sparse_matrix = scipy.sparse.csc_matrix(
-            (data_array[:valid_index],
-             (row_array[:valid_index], col_array[:valid_index])),
-            shape=(n_rows, n_cols))
-
-        # classic memory block iteration
-        for block_row_index, block_col_index in dirty_blocks:
-            row_index = block_row_index * out_block_row_size
-            col_index = block_col_index * out_block_col_size
-            row_index_end = row_index + out_block_row_size
-            col_index_end = col_index + out_block_col_size
-            row_win = out_block_row_size
-            col_win = out_block_col_size
-            if row_index_end > n_rows:
-                row_index_end = n_rows
-                row_win = n_rows - row_index
-            if col_index_end > n_cols:
-                col_index_end = n_cols
-                col_win = n_cols - col_index
-
-            # slice out values, some must be non-zero because of set
-            mask_array = sparse_matrix[
-                         row_index:row_index_end, col_index:col_index_end].toarray()
+        if valid_index == 0:
+            return
+        row_indexes = flat_index_array[:valid_index] // n_cols
+        col_indexes = flat_index_array[:valid_index] % n_cols
+        block_ids = (
+            (row_indexes // out_block_row_size) * n_col_blocks +
+            col_indexes // out_block_col_size)
+
+        # sort pixels by block so each block's pixels are contiguous
+        block_order = numpy.argsort(block_ids, kind='mergesort')
+        block_ids = block_ids[block_order]
+        row_indexes = row_indexes[block_order]
+        col_indexes = col_indexes[block_order]
+        block_starts = numpy.flatnonzero(numpy.diff(block_ids)) + 1
+        block_starts = numpy.concatenate(([0], block_starts))
+        block_ends = numpy.concatenate((block_starts[1:], [valid_index]))
+
+        converted_ids = []
+        for block_start, block_end in zip(block_starts, block_ends):
+            block_id = block_ids[block_start]
+            row_index = (block_id // n_col_blocks) * out_block_row_size
+            col_index = (block_id % n_col_blocks) * out_block_col_size
+            row_win = min(out_block_row_size, n_rows - row_index)
+            col_win = min(out_block_col_size, n_cols - col_index)
 
             # read old array so we can write over the top
             out_array = out_band.ReadAsArray(
-                xoff=col_index, yoff=row_index,
-                win_xsize=col_win, win_ysize=row_win)
-
-            # keep track of the stats of what ids changed
-            for unique_id in numpy.unique(out_array[mask_array]):
-                stats_counter[unique_id] += numpy.count_nonzero(
-                    out_array[mask_array] == unique_id)
-
-            out_array[mask_array] = convert_value
-            out_band.WriteArray(out_array, xoff=col_index, yoff=row_index)
+                xoff=int(col_index), yoff=int(row_index),
+                win_xsize=int(col_win), win_ysize=int(row_win))
+
+            local_rows = row_indexes[block_start:block_end] - row_index
+            local_cols = col_indexes[block_start:block_end] - col_index
+            converted_ids.append(out_array[local_rows, local_cols])
+            out_array[local_rows, local_cols] = convert_value
+            out_band.WriteArray(
+                out_array, xoff=int(col_index), yoff=int(row_index))
+
+        # keep track of the stats of what ids changed
+        unique_ids, id_inverse = numpy.unique(
+            numpy.concatenate(converted_ids), return_inverse=True)
+        for unique_id, id_count in zip(
+                unique_ids, numpy.bincount(id_inverse)):
+            stats_counter[unique_id] += id_count
 
     out_ds = gdal.Open(out_raster_uri, gdal.GA_Update)
     out_band = out_ds.GetRasterBand(1)
     out_block_col_size, out_block_row_size = out_band.GetBlockSize()
     n_rows = out_band.YSize
     n_cols = out_band.XSize
+    n_col_blocks = int(math.ceil(n_cols / float(out_block_col_size)))
     pixels_converted = 0
 
-    row_array = numpy.empty((_BLOCK_SIZE,), dtype=numpy.uint32)
-    col_array = numpy.empty((_BLOCK_SIZE,), dtype=numpy.uint32)
-    data_array = numpy.empty((_BLOCK_SIZE,), dtype=numpy.bool)
+    flat_index_array = numpy.empty((_BLOCK_SIZE,), dtype=_SORT_INDEX_TYPE)
     next_index = 0
-    dirty_blocks = set()
+    converted_index_list = []
 
     last_time = time.time()
-    for _, flatindex in _sort_to_disk(score_uri, score_weight=score_weight):
-        if pixels_converted >= max_pixels_to_convert:
-            break
-        col_index = flatindex % n_cols
-        row_index = flatindex / n_cols
-        row_array[next_index] = row_index
-        col_array[next_index] = col_index
-        # data_array will only ever recieve True elements, necessary for the
-        # sparse matrix to function since it requires a data array as long
-        # as the row and column arrays
-        data_array[next_index] = True
-        next_index += 1
-        dirty_blocks.add(
-            (row_index / out_block_row_size, col_index / out_block_col_size))
-        pixels_converted += 1
-
-        if time.time() - last_time > 5.0:
-            LOGGER.info(
-                "converted %d of %d pixels", pixels_converted,
-                max_pixels_to_convert)
-            last_time = time.time()
-
-        if next_index == _BLOCK_SIZE:
-            # next_index points beyond the end of the cache, flush and reset
-            _flush_cache_to_band(
-                data_array, row_array, col_array, next_index, dirty_blocks,
-                out_band, stats_cache)
-            dirty_blocks = set()
-            next_index = 0
+    if max_pixels_to_convert <= _MAX_TOP_K_SELECTION:
+        # only the best pixels are needed, avoid a full sort of the raster
+        sorted_score_iterator = _select_top_k(
+            score_uri, max_pixels_to_convert, score_weight=score_weight)
+    else:
+        sorted_score_iterator = _sort_to_disk(
+            score_uri, score_weight=score_weight)
+    try:
+        for _, flat_index_batch in sorted_score_iterator:
+            if pixels_converted >= max_pixels_to_convert:
+                break
+            flat_index_batch = flat_index_batch[
+                :max_pixels_to_convert - pixels_converted]
+
+            batch_offset = 0
+            while batch_offset < flat_index_batch.size:
+                # copy as much of the batch as will fit in the cache
+                n_to_cache = min(
+                    _BLOCK_SIZE - next_index,
+                    flat_index_batch.size - batch_offset)
+                flat_index_array[next_index:next_index+n_to_cache] = (
+                    flat_index_batch[batch_offset:batch_offset+n_to_cache])
+                next_index += n_to_cache
+                batch_offset += n_to_cache
+                pixels_converted += n_to_cache
+
+                if next_index == _BLOCK_SIZE:
+                    # next_index points beyond the end of the cache, flush
+                    # and reset
+                    converted_index_list.append(flat_index_array.copy())
+                    _flush_cache_to_band(
+                        flat_index_array, next_index, out_band, stats_cache)
+                    next_index = 0
+
+            if time.time() - last_time > 5.0:
+                LOGGER.info(
+                    "converted %d of %d pixels", pixels_converted,
+                    max_pixels_to_convert)
+                last_time = time.time()
+    finally:
+        # removes the sorted runs from disk even if we stopped early
+        sorted_score_iterator.close()
 
     # flush any remaining cache
-    _flush_cache_to_band(
-        data_array, row_array, col_array, next_index, dirty_blocks, out_band,
-        stats_cache)
+    converted_index_list.append(flat_index_array[:next_index].copy())
+    _flush_cache_to_band(flat_index_array, next_index, out_band, stats_cache)
+    out_band.FlushCache()
+    out_band = None
+    out_ds = None
+    return numpy.concatenate(converted_index_list)
 
 
-def _make_gaussian_kernel_uri(sigma, kernel_uri):
-    """Create a 2D Gaussian kernel.
+def _gaussian_kernel_1d(sigma):
+    """Create a normalized 1D Gaussian kernel.
+
+    A 2D Gaussian is separable so smoothing with this kernel along the rows
+    and then the columns is the same as a 2D Gaussian convolution.  Kernels
+    are cached by sigma.
 
     Parameters:
         sigma (float): the sigma as in the classic Gaussian function
-        kernel_uri (string): path to raster on disk to write the gaussian
-            kernel.
+
+    Returns:
+        1D numpy.array of length 2 * round(sigma * _GAUSSIAN_TRUNCATE) + 1
+        that sums to 1.0.
+    """
+    if sigma not in _GAUSSIAN_KERNEL_CACHE:
+        radius = int(round(sigma * _GAUSSIAN_TRUNCATE))
+        offsets = numpy.arange(-radius, radius + 1, dtype=numpy.float64)
+        kernel = numpy.exp(-offsets**2 / (2.0 * sigma**2))
+        _GAUSSIAN_KERNEL_CACHE[sigma] = kernel / kernel.sum()
+    return _GAUSSIAN_KERNEL_CACHE[sigma]
+
+
+def _smooth_array(array, kernel):
+    """Smooth a 2D array with a separable kernel.
+
+    Parameters:
+        array (numpy.array): 2D array to smooth, values outside of it are
+            treated as 0.
+        kernel (numpy.array): 1D symmetric kernel applied along both axes
+
+    Returns:
+        2D float64 numpy.array the same shape as `array`.
+    """
+    result = scipy.ndimage.correlate1d(
+        array.astype(numpy.float64), kernel, axis=0, mode='constant',
+        cval=0.0)
+    return scipy.ndimage.correlate1d(
+        result, kernel, axis=1, mode='constant', cval=0.0)
+
+
+def _smooth_raster_uri(signal_uri, kernel, out_uri):
+    """Smooth a raster with a separable kernel in strips of rows.
+
+    Each strip is read with a halo of the kernel's radius so the result is
+    the same as smoothing the whole raster at once.  Nodata pixels and the
+    area outside of the raster are treated as 0.
+
+    Parameters:
+        signal_uri (string): path to the raster to smooth
+        kernel (numpy.array): 1D symmetric kernel applied along both axes
+        out_uri (string): path to the output Float32 raster with nodata
+            `_SMOOTH_DISTANCE_NODATA`.
 
     Returns:
         None.
     """
-    # going 3.0 times out from the sigma gives you over 99% of area under
-    # the guassian curve
-    max_distance = sigma * 3.0
-    kernel_size = int(numpy.round(max_distance * 2 + 1))
-
-    driver = gdal.GetDriverByName('GTiff')
-    kernel_dataset = driver.Create(
-        kernel_uri.encode('utf-8'), kernel_size, kernel_size, 1,
-        gdal.GDT_Float32, options=['BIGTIFF=IF_SAFER'])
-
-    # Make some kind of geotransform, it doesn't matter what but
-    # will make GIS libraries behave better if it's all defined
-    kernel_dataset.SetGeoTransform([444720, 30, 0, 3751320, 0, -30])
-    srs = osr.SpatialReference()
-    srs.SetUTM(11, 1)
-    srs.SetWellKnownGeogCS('NAD27')
-    kernel_dataset.SetProjection(srs.ExportToWkt())
-
-    kernel_band = kernel_dataset.GetRasterBand(1)
-    kernel_band.SetNoDataValue(-9999)
-
-    col_index = numpy.array(xrange(kernel_size))
-    integration = 0.0
-    for row_index in xrange(kernel_size):
-        distance_kernel_row = numpy.sqrt(
-            (row_index - max_distance) ** 2 +
-            (col_index - max_distance) ** 2).reshape(1, kernel_size)
-        kernel = numpy.where(
-            distance_kernel_row > max_distance, 0.0,
-            (1 / (2.0 * numpy.pi * sigma ** 2) *
-             numpy.exp(-distance_kernel_row**2 / (2 * sigma ** 2))))
-        integration += numpy.sum(kernel)
-        kernel_band.WriteArray(kernel, xoff=0, yoff=row_index)
-
-    kernel_dataset.FlushCache()
-    for kernel_data, kernel_block in pygeoprocessing.iterblocks(kernel_uri):
-        kernel_block /= integration
-        kernel_band.WriteArray(
-            kernel_block, xoff=kernel_data['xoff'], yoff=kernel_data['yoff'])
+    pygeoprocessing.new_raster_from_base_uri(
+        signal_uri, out_uri, 'GTiff', _SMOOTH_DISTANCE_NODATA,
+        gdal.GDT_Float32,
+        dataset_options=utils.SCRATCH_GTIFF_OPTIONS)
+    signal_ds = gdal.Open(signal_uri)
+    signal_band = signal_ds.GetRasterBand(1)
+    signal_nodata = signal_band.GetNoDataValue()
+    out_ds = gdal.Open(out_uri, gdal.GA_Update)
+    out_band = out_ds.GetRasterBand(1)
+    n_rows = signal_band.YSize
+    n_cols = signal_band.XSize
+
+    halo = kernel.size // 2
+    strip_rows = max(_BLOCK_SIZE // n_cols, 1)
+    for row_start in xrange(0, n_rows, strip_rows):
+        row_end = min(row_start + strip_rows, n_rows)
+        halo_row_start = max(row_start - halo, 0)
+        halo_row_end = min(row_end + halo, n_rows)
+        signal_array = signal_band.ReadAsArray(
+            xoff=0, yoff=halo_row_start, win_xsize=n_cols,
+            win_ysize=halo_row_end-halo_row_start)
+        if signal_nodata is not None:
+            signal_array[signal_array == signal_nodata] = 0
+        smooth_array = _smooth_array(signal_array, kernel)
+        out_band.WriteArray(
+            smooth_array[row_start-halo_row_start:row_end-halo_row_start],
+            xoff=0, yoff=row_start)
+
+    out_band.FlushCache()
+    out_band = None
+    out_ds = None
+    signal_band = None
+    signal_ds = None
@@ -7,6 +7,39 @@ from osgeo import gdal
 from osgeo import osr
 import pygeoprocessing
 
+# GeoTIFF creation options of the model's rasters.  Rasters that are
+# rewritten in place stay uncompressed, GDAL appends every rewritten block of
+# a compressed GeoTIFF so those files would keep growing, and are compressed
+# once with `compress_raster` when they are final.
+SCRATCH_GTIFF_OPTIONS = [
+    'BIGTIFF=IF_SAFER', 'TILED=YES', 'BLOCKXSIZE=256', 'BLOCKYSIZE=256']
+COMPRESSED_GTIFF_OPTIONS = SCRATCH_GTIFF_OPTIONS + [
+    'COMPRESS=LZW', 'NUM_THREADS=ALL_CPUS']
+
+
+def compress_raster(raster_path):
+    """Rewrite a finished raster once with `COMPRESSED_GTIFF_OPTIONS`.
+
+    Parameters:
+        raster_path (string): path to a GeoTIFF, replaced by its compressed
+            copy.
+
+    Returns:
+        None
+    """
+    compressed_path = os.path.splitext(raster_path)[0] + '_compressed.tif'
+    base_dataset = gdal.Open(raster_path)
+    predictor = 3 if base_dataset.GetRasterBand(1).DataType in (
+        gdal.GDT_Float32, gdal.GDT_Float64) else 2
+    driver = gdal.GetDriverByName('GTiff')
+    compressed_dataset = driver.CreateCopy(
+        compressed_path, base_dataset, 0,
+        COMPRESSED_GTIFF_OPTIONS + ['PREDICTOR=%d' % predictor])
+    compressed_dataset = None
+    base_dataset = None
+    os.remove(raster_path)
+    os.rename(compressed_path, raster_path)
+
 
 def make_suffix_string(args, suffix_key):
     """Make an InVEST appropriate suffix string.
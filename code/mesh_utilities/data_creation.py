@@ -173,7 +173,8 @@ def reproject_dataset_uri(
     output_dataset = gdal_driver.Create(
         output_uri, x_size_new,
         y_size_new, 1, output_type,
-        options=['BIGTIFF=IF_SAFER'])
+        options=utilities.gtiff_creation_options(
+            'intermediate', output_type, x_size_new, y_size_new))
 
     print(lrx, ulx, pixel_spacing,
         int((lrx - ulx)/pixel_spacing),
@@ -283,30 +284,17 @@ def resize_and_resample_dataset_uri(
             "clamping to 1.")
         new_y_size = 1
 
-    # create the new x and y size
-    block_size = original_band.GetBlockSize()
-    # If the original band is tiled, then its x blocksize will be different
-    # than the number of columns
-    if original_band.XSize > 256 and original_band.YSize > 256:
-        # it makes sense for many functions to have 256x256 blocks
-        block_size[0] = 256
-        block_size[1] = 256
-        gtiff_creation_options = [
-            'TILED=YES', 'BIGTIFF=IF_SAFER', 'BLOCKXSIZE=%d' % block_size[0],
-                                             'BLOCKYSIZE=%d' % block_size[1]]
-
-        metadata = original_band.GetMetadata('IMAGE_STRUCTURE')
-        if 'PIXELTYPE' in metadata:
-            gtiff_creation_options.append('PIXELTYPE=' + metadata['PIXELTYPE'])
-    else:
-        # it is so small or strangely aligned, use the default creation options
-        gtiff_creation_options = []
+    creation_options = utilities.gtiff_creation_options(
+        'intermediate', original_band.DataType, new_x_size, new_y_size)
+    metadata = original_band.GetMetadata('IMAGE_STRUCTURE')
+    if 'PIXELTYPE' in metadata:
+        creation_options.append('PIXELTYPE=' + metadata['PIXELTYPE'])
 
     create_directories([os.path.dirname(output_uri)])
     gdal_driver = gdal.GetDriverByName('GTiff')
     output_dataset = gdal_driver.Create(
         output_uri, new_x_size, new_y_size, 1, original_band.DataType,
-        options=gtiff_creation_options)
+        options=creation_options)
     output_band = output_dataset.GetRasterBand(1)
 
     output_band.SetNoDataValue(original_nodata)
@@ -811,6 +799,7 @@ def vectorize_datasets(
         dataset_options: this is an argument list that will be
             passed to the GTiff driver.  Useful for blocksizes, compression,
             etc.
+            Defaults to the 'intermediate' GeoTIFF creation profile.
         all_touched (boolean): if true the clip uses the option
             ALL_TOUCHED=TRUE when calling RasterizeLayer for AOI masking.
 
@@ -874,6 +863,9 @@ def vectorize_datasets(
     n_rows = aligned_datasets[0].RasterYSize
     n_cols = aligned_datasets[0].RasterXSize
 
+    if dataset_options is None:
+        dataset_options = utilities.gtiff_creation_options(
+            'intermediate', datatype_out, n_cols, n_rows)
     output_dataset = pg.new_raster_from_base(
         aligned_datasets[0], dataset_out_uri, 'GTiff', nodata_out,
         datatype_out, dataset_options=dataset_options)
@@ -895,7 +887,8 @@ def vectorize_datasets(
         mask_uri = temporary_filename(suffix='.tif')
         mask_dataset = pg.new_raster_from_base(
             aligned_datasets[0], mask_uri, 'GTiff', 255, gdal.GDT_Byte,
-            fill_value=0, dataset_options=dataset_options)
+            fill_value=0, dataset_options=utilities.gtiff_creation_options(
+                'scratch', gdal.GDT_Byte, n_cols, n_rows))
         mask_band = mask_dataset.GetRasterBand(1)
         aoi_datasource = ogr.Open(aoi_uri)
         aoi_layer = aoi_datasource.GetLayer()
@@ -1543,21 +1536,16 @@ def new_raster_from_base(
     driver = gdal.GetDriverByName(gdal_format)
 
     base_band = base.GetRasterBand(1)
-    block_size = base_band.GetBlockSize()
     metadata = base_band.GetMetadata('IMAGE_STRUCTURE')
     base_band = None
 
     if dataset_options == None:
         #make a new list to make sure we aren't ailiasing one passed in
         dataset_options = []
-        #first, should it be tiled?  yes if it's not striped
-        if block_size[0] != n_cols:
-            #just do 256x256 blocks
-            dataset_options = [
-                'TILED=YES',
-                'BLOCKXSIZE=256',
-                'BLOCKYSIZE=256',
-                'BIGTIFF=IF_SAFER']
+        #tiling and compression come from the shared GTiff profile
+        if gdal_format == 'GTiff':
+            dataset_options = utilities.gtiff_creation_options(
+                'intermediate', datatype, n_cols, n_rows)
         if 'PIXELTYPE' in metadata:
             dataset_options.append('PIXELTYPE=' + metadata['PIXELTYPE'])
 
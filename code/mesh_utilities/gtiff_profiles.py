@@ -0,0 +1,108 @@
+"""GeoTIFF creation profiles shared by the MESH raster writers.
+
+Only depends on GDAL so the models can use it without loading the rest of
+mesh_utilities.
+"""
+import os
+import shutil
+
+from osgeo import gdal
+
+
+# GeoTIFF creation profiles shared by every MESH raster writer.  "scratch" is
+# for files that are read back once and deleted, or that are rewritten in
+# place (GDAL appends each rewritten block of a compressed GeoTIFF, so those
+# files would keep growing), so it skips compression and favors write speed;
+# "intermediate" is for workspace rasters that are re-read by later steps;
+# "deliverable" is for the rasters handed to the user.
+GTIFF_CREATION_PROFILES = {
+    'scratch': {
+        'block_size': 256,
+        'compress': None,
+        'num_threads': None,
+    },
+    'intermediate': {
+        'block_size': 256,
+        'compress': 'LZW',
+        'num_threads': 'ALL_CPUS',
+    },
+    'deliverable': {
+        'block_size': 512,
+        'compress': 'DEFLATE',
+        'zlevel': 6,
+        'num_threads': 'ALL_CPUS',
+    },
+}
+
+_GDAL_FLOAT_TYPES = set([gdal.GDT_Float32, gdal.GDT_Float64])
+
+
+def gtiff_creation_options(
+        profile='intermediate', datatype=None, n_cols=None, n_rows=None):
+    """Build the GTiff creation option list for a named profile.
+
+    Args:
+        profile (string): a key of GTIFF_CREATION_PROFILES.
+        datatype (int): the GDAL datatype of the raster to be written.  Used
+            to pick the compression predictor (2 for integer, 3 for floating
+            point data); no predictor is set if None.
+        n_cols (int): raster width, if known.
+        n_rows (int): raster height, if known.  If both dimensions are
+            smaller than the profile block size the raster is written in
+            strips instead of tiles.
+
+    Returns:
+        list of 'KEY=VALUE' strings to pass as GDAL creation options.
+
+    Raises:
+        ValueError if `profile` is not a known profile name.
+    """
+    if profile not in GTIFF_CREATION_PROFILES:
+        raise ValueError(
+            "Unknown GeoTIFF creation profile '%s', expected one of %s" % (
+                profile, sorted(GTIFF_CREATION_PROFILES)))
+    settings = GTIFF_CREATION_PROFILES[profile]
+
+    options = ['BIGTIFF=IF_SAFER']
+    block_size = settings['block_size']
+    if (n_cols is None or n_rows is None or
+            n_cols > block_size or n_rows > block_size):
+        options.extend([
+            'TILED=YES', 'BLOCKXSIZE=%d' % block_size,
+            'BLOCKYSIZE=%d' % block_size])
+    if settings['compress']:
+        options.append('COMPRESS=%s' % settings['compress'])
+        if 'zlevel' in settings:
+            options.append('ZLEVEL=%d' % settings['zlevel'])
+        if datatype is not None:
+            options.append('PREDICTOR=%d' % (
+                3 if datatype in _GDAL_FLOAT_TYPES else 2))
+        if settings['num_threads']:
+            options.append('NUM_THREADS=%s' % settings['num_threads'])
+    return options
+
+
+def compress_gtiff_uri(uri, profile='deliverable'):
+    """Rewrite a finished GeoTIFF once with the options of `profile`.
+
+    Rasters that are updated in place are built with the "scratch" profile
+    and compressed with this once they hold their final values.
+
+    Args:
+        uri (string): path to the GeoTIFF, replaced by the rewritten copy.
+        profile (string): a key of GTIFF_CREATION_PROFILES.
+
+    Returns:
+        None
+    """
+    compressed_uri = os.path.splitext(uri)[0] + '_compressed.tif'
+    src_ds = gdal.Open(uri)
+    driver = gdal.GetDriverByName('GTiff')
+    dst_ds = driver.CreateCopy(
+        compressed_uri, src_ds, 0, gtiff_creation_options(
+            profile, src_ds.GetRasterBand(1).DataType, src_ds.RasterXSize,
+            src_ds.RasterYSize))
+    dst_ds = None
+    src_ds = None
+    os.remove(uri)
+    shutil.move(compressed_uri, uri)
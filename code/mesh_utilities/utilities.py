@@ -1,6 +1,6 @@
 # coding=utf-8
 
-from collections import OrderedDict
+from collections import OrderedDict, deque
 import os
 import datetime
 import json
@@ -15,7 +15,12 @@ import atexit
 import time
 import functools
 import errno
+import hashlib
 import math
+import multiprocessing
+import multiprocessing.pool
+import threading
+from xml.sax import saxutils
 
 from osgeo import gdal, ogr, osr
 from PyQt4.QtGui import *
@@ -25,6 +30,8 @@ import pygeoprocessing.geoprocessing as pg
 
 import numpy
 import config
+from gtiff_profiles import (
+    GTIFF_CREATION_PROFILES, gtiff_creation_options, compress_gtiff_uri)
 import numpy as np
 
 initial_temp_env_var = None
@@ -376,23 +383,229 @@ def resample_preserve_sum(input_uri, output_uri, match_uri, resolution=None, **k
 
     kwargs['resample_method'] = 'average'
 
-    input_array = as_array(input_uri)
-
-    initial_sum = np.nansum(input_array)
+    with RasterArray(input_uri) as input_raster:
+        initial_sum = input_raster.nansum()
     temp_uri = ruri('temp.tif')
     resample_simple(input_uri, data_type=7, match_uri=match_uri, resolution=resolution, output_uri=temp_uri, **kwargs)
-    temp_array = as_array(temp_uri)
-    temp_sum = np.nansum(temp_array)
+    with RasterArray(temp_uri) as temp_raster:
+        temp_sum = temp_raster.nansum()
 
-    # TODO, Here, I had to float() it because the type was np.float64, which failed in the apply_op's logic for determining what type of calculation it was,
-    adjustment_factor = float(initial_sum / temp_sum)
+        # TODO, Here, I had to float() it because the type was np.float64, which failed in the apply_op's logic for determining what type of calculation it was,
+        adjustment_factor = float(initial_sum / temp_sum)
 
-    # new_af = temp_af * adjustment_factor
-    adjusted_sum_array = temp_array * adjustment_factor #nd.multiply(temp_af, adjustment_factor, calculation_data_type=7, data_type=7, output_uri=output_uri)
-    save_array_as_geotiff(adjusted_sum_array, output_uri, match_uri)
+        # Scale the resampled raster window by window onto the grid of match_uri, as Float32 with nodata -9999 like
+        # save_array_as_geotiff(temp_array * adjustment_factor, output_uri, match_uri) wrote the whole array.
+        output_nodata = -9999
+        with RasterArray.create_like(match_uri, output_uri, gdal.GDT_Float32, output_nodata) as output_raster:
+            for window, temp_block in temp_raster.iterblocks():
+                adjusted_sum_block = temp_block * adjustment_factor
+                adjusted_sum_block[np.isinf(adjusted_sum_block)] = output_nodata
+                output_raster.write(adjusted_sum_block, window['xoff'], window['yoff'])
 
     return
 
+
+def _overlap_weights(src_origin, src_step, n_src, dst_origin, dst_step, n_dst):
+    """Overlap of each destination pixel with the source pixels along one axis.
+
+    Both grids run in the direction of increasing coordinate; flip the sign
+    of the origins for an axis that decreases (like y in a north-up raster).
+
+    Args:
+        src_origin (float): coordinate of the first source pixel edge.
+        src_step (float): positive source pixel size.
+        n_src (int): number of source pixels.
+        dst_origin (float): coordinate of the first destination pixel edge.
+        dst_step (float): positive destination pixel size.
+        n_dst (int): number of destination pixels.
+
+    Returns:
+        (index, weight), both of shape (n_dst, k): destination pixel i
+        covers source pixels index[i] by the lengths weight[i].  Source
+        pixels a destination pixel does not reach have zero weight.
+    """
+    n_overlapping = int(math.ceil(dst_step / src_step)) + 1
+    dst_start = dst_origin + dst_step * numpy.arange(n_dst)
+    first_src = numpy.floor((dst_start - src_origin) / src_step).astype(
+        numpy.int64)
+    index = first_src[:, numpy.newaxis] + numpy.arange(n_overlapping)
+    src_start = src_origin + src_step * index
+    weight = (
+        numpy.minimum(dst_start[:, numpy.newaxis] + dst_step,
+                      src_start + src_step) -
+        numpy.maximum(dst_start[:, numpy.newaxis], src_start))
+    # slivers from floating point error in the grid edges are not overlaps
+    weight[(weight <= 1e-9 * src_step) | (index < 0) | (index >= n_src)] = 0
+    return numpy.clip(index, 0, max(n_src - 1, 0)), weight
+
+
+def resample_preserve_sum_stack(
+        input_uri_list, output_uri, match_uri, datatype=gdal.GDT_Float32,
+        nodata=-9999):
+    """Resample co-registered rasters to the match grid, preserving sums.
+
+    The batched form of resample_preserve_sum: each input is averaged onto
+    the grid of `match_uri`, ignoring nodata, and scaled so its total is
+    the same as the input's.  The area weights that map the input grid to
+    the match grid are computed once and shared by every layer, and the
+    inputs are streamed a strip at a time, once to total them and once to
+    write the output, instead of going through a temporary raster each.
+    The inputs must be in the same projection as `match_uri`; nothing is
+    reprojected.
+
+    Args:
+        input_uri_list (list): rasters with the same size and geotransform.
+        output_uri (string or list): either one path, for a multi-band
+            GeoTIFF whose band i is input i, or a list of paths, one
+            single-band raster per input.
+        match_uri (string): raster whose grid and projection the outputs
+            take.
+        datatype (int): GDAL datatype of the outputs, Float32 by default as
+            resample_preserve_sum writes.
+        nodata: nodata value of the outputs.
+
+    Returns:
+        None
+
+    Raises:
+        ValueError: if the inputs are not on one grid or are in a different
+            projection than `match_uri`.
+    """
+    if isinstance(output_uri, basestring):
+        output_uri_list = None
+    else:
+        output_uri_list = list(output_uri)
+        if len(output_uri_list) != len(input_uri_list):
+            raise ValueError(
+                'Got %d output paths for %d inputs.' % (
+                    len(output_uri_list), len(input_uri_list)))
+
+    input_rasters = [RasterArray(uri) for uri in input_uri_list]
+    try:
+        input_geotransform = input_rasters[0].geotransform
+        for uri, raster in zip(input_uri_list, input_rasters):
+            if (raster.shape != input_rasters[0].shape or
+                    raster.geotransform != input_geotransform):
+                raise ValueError(
+                    '%s is not on the same grid as %s.' % (
+                        uri, input_uri_list[0]))
+        n_src_rows, n_src_cols = input_rasters[0].shape
+
+        match_dataset = gdal.Open(match_uri)
+        match_geotransform = match_dataset.GetGeoTransform()
+        n_rows = match_dataset.RasterYSize
+        n_cols = match_dataset.RasterXSize
+        match_projection = match_dataset.GetProjection()
+        gdal.Dataset.__swig_destroy__(match_dataset)
+        match_dataset = None
+
+        # The area weights below are only right between grids in the same
+        # projection.
+        input_srs = osr.SpatialReference()
+        input_srs.ImportFromWkt(get_dataset_projection_wkt_uri(
+            input_uri_list[0]))
+        match_srs = osr.SpatialReference()
+        match_srs.ImportFromWkt(match_projection)
+        if not input_srs.IsSame(match_srs):
+            raise ValueError(
+                '%s is not in the same projection as %s.' % (
+                    input_uri_list[0], match_uri))
+
+        x_index, x_weight = _overlap_weights(
+            input_geotransform[0], input_geotransform[1], n_src_cols,
+            match_geotransform[0], match_geotransform[1], n_cols)
+        y_index, y_weight = _overlap_weights(
+            -input_geotransform[3], -input_geotransform[5], n_src_rows,
+            -match_geotransform[3], -match_geotransform[5], n_rows)
+
+        # output rows per strip, so the per-layer temporaries hold about
+        # _RASTER_ARRAY_WINDOW_PIXELS values
+        strip_values = max(
+            n_src_cols * y_weight.shape[1], n_cols * x_weight.shape[1], 1)
+        rows_per_strip = max(_RASTER_ARRAY_WINDOW_PIXELS // strip_values, 1)
+
+        def resampled_strips(raster):
+            """Yield (row, averaged strip, valid mask) down the match grid."""
+            for row in xrange(0, n_rows, rows_per_strip):
+                strip_index = y_index[row:row + rows_per_strip]
+                strip_weight = y_weight[row:row + rows_per_strip]
+                src_row = int(strip_index.min())
+                src_block = raster.read(
+                    0, src_row, n_src_cols,
+                    int(strip_index.max()) - src_row + 1).astype(
+                        numpy.float64)
+                valid = numpy.isfinite(src_block)
+                if raster.nodata is not None:
+                    valid &= src_block != raster.nodata
+                src_block[~valid] = 0
+
+                # weighted sums down the columns, then along the rows
+                sums = []
+                for values in [src_block, valid.astype(numpy.float64)]:
+                    column_sums = numpy.einsum(
+                        'rkc,rk->rc', values[strip_index - src_row],
+                        strip_weight)
+                    sums.append(numpy.einsum(
+                        'rck,ck->rc', column_sums[:, x_index], x_weight))
+                value_sum, weight_sum = sums
+                covered = weight_sum > 0
+                averaged = numpy.zeros(value_sum.shape)
+                averaged[covered] = value_sum[covered] / weight_sum[covered]
+                yield row, averaged, covered
+
+        # Totals of each input and of its average on the match grid.
+        adjustment_factors = []
+        for raster in input_rasters:
+            resampled_sum = 0.0
+            for _, averaged, _ in resampled_strips(raster):
+                resampled_sum += numpy.sum(averaged)
+            adjustment_factors.append(float(raster.nansum() / resampled_sum))
+
+        if output_uri_list is None:
+            create_directories([os.path.dirname(output_uri)])
+            driver = gdal.GetDriverByName('GTiff')
+            output_dataset = driver.Create(
+                output_uri, n_cols, n_rows, len(input_rasters), datatype,
+                options=gtiff_creation_options(
+                    'intermediate', datatype, n_cols, n_rows) +
+                ['INTERLEAVE=BAND'])
+            output_dataset.SetGeoTransform(match_geotransform)
+            output_dataset.SetProjection(match_projection)
+            output_bands = []
+            for band_index in xrange(len(input_rasters)):
+                band = output_dataset.GetRasterBand(band_index + 1)
+                if nodata is not None:
+                    band.SetNoDataValue(float(nodata))
+                output_bands.append(band)
+        else:
+            output_rasters = [
+                RasterArray.create_like(
+                    match_uri, uri, datatype, nodata)
+                for uri in output_uri_list]
+            output_bands = [raster._band for raster in output_rasters]
+
+        for raster, adjustment_factor, output_band in zip(
+                input_rasters, adjustment_factors, output_bands):
+            for row, averaged, covered in resampled_strips(raster):
+                adjusted_sum_block = averaged * adjustment_factor
+                if nodata is not None:
+                    adjusted_sum_block[~covered] = nodata
+                    adjusted_sum_block[
+                        numpy.isinf(adjusted_sum_block)] = nodata
+                output_band.WriteArray(adjusted_sum_block, xoff=0, yoff=row)
+
+        output_bands = None
+        if output_uri_list is None:
+            output_dataset.FlushCache()
+            gdal.Dataset.__swig_destroy__(output_dataset)
+            output_dataset = None
+        else:
+            for raster in output_rasters:
+                raster.close()
+    finally:
+        for raster in input_rasters:
+            raster.close()
+
 def resample_simple(src_uri, output_uri, match_uri=None, resolution=None, **kwargs):
 
     # Must have either match_af or resolution set
@@ -815,13 +1028,10 @@ def get_cell_size_from_uri(dataset_uri):
 
 def as_array(uri, return_all_parts = False, verbose = False): #use GDAL to laod uri. By default only returns the array"
     # Simplest function for loading a geotiff as an array. returns only the array by defauls, ignoring the DS and BAND unless return_all_parts = True.
+    # Loads the whole band at once and raises if it can't; use RasterArray for windowed reads of large rasters.
     ds = gdal.Open(uri)
     band = ds.GetRasterBand(1)
-    try:
-        array = band.ReadAsArray()
-    except:
-        warnings.warn('Failed to load all of the array. It may be too big for memory.')
-        array = None
+    array = band.ReadAsArray()
 
     # Close and clean up dataset
     if return_all_parts:
@@ -832,14 +1042,297 @@ def as_array(uri, return_all_parts = False, verbose = False): #use GDAL to laod
         ds = None
         return array
 
+
+# Approximate number of pixels in each window RasterArray.iterblocks reads
+_RASTER_ARRAY_WINDOW_PIXELS = 2**20
+
+
+class RasterArray(object):
+    """Lazy, windowed access to the first band of a GDAL raster.
+
+    Unlike as_array nothing is read when the raster is opened.  Windows are
+    read on demand with `read` or by slicing (`raster[100:200, 0:50]`), and
+    `iterwindows`/`iterblocks` walk the raster in strips of whole blocks so
+    only one strip is in memory at a time.  `numpy.asarray(raster)` still
+    reads the whole band for code that needs it.
+
+    Uncompressed GeoTIFFs whose blocks are stored one after the other are
+    read through a numpy.memmap of the file rather than through GDAL, so
+    reads come straight from the page cache.
+
+    Example:
+        with RasterArray(uri) as raster:
+            total = 0.0
+            for window, block in raster.iterblocks():
+                total += block.sum()
+    """
+
+    def __init__(self, uri, update=False):
+        """Open the raster at `uri`.
+
+        Args:
+            uri (string): path to a GDAL raster.
+            update (boolean): if True the raster is opened for `write`.
+
+        Raises:
+            IOError: if GDAL can't open `uri`.
+        """
+        self.uri = uri
+        self._dataset = gdal.Open(
+            uri, gdal.GA_Update if update else gdal.GA_ReadOnly)
+        if self._dataset is None:
+            raise IOError("Unable to open raster %s" % uri)
+        self._band = self._dataset.GetRasterBand(1)
+        self.shape = (self._dataset.RasterYSize, self._dataset.RasterXSize)
+        self.geotransform = self._dataset.GetGeoTransform()
+        self.dtype = numpy.dtype(_gdal_to_numpy_type(self._band))
+        self.nodata = self._band.GetNoDataValue()
+        self.block_size = tuple(self._band.GetBlockSize())
+        self._memmap = None
+        self._memmap_block_size = None
+        if not update:
+            self._map_blocks()
+
+    @classmethod
+    def create_like(
+            cls, base_uri, uri, datatype, nodata,
+            creation_profile='intermediate'):
+        """Make a new GeoTIFF on the grid of `base_uri` and open it to write.
+
+        Args:
+            base_uri (string): raster whose size, geotransform and
+                projection the new raster takes.
+            uri (string): path of the new raster.
+            datatype (int): GDAL datatype of the new raster.
+            nodata: nodata value of the new raster, or None for none.
+            creation_profile (string): a GTIFF_CREATION_PROFILES key.
+
+        Returns:
+            a RasterArray opened for update.
+        """
+        base_dataset = gdal.Open(base_uri)
+        n_rows = base_dataset.RasterYSize
+        n_cols = base_dataset.RasterXSize
+        driver = gdal.GetDriverByName('GTiff')
+        dataset = driver.Create(
+            uri, n_cols, n_rows, 1, datatype,
+            options=gtiff_creation_options(
+                creation_profile, datatype, n_cols, n_rows))
+        dataset.SetGeoTransform(base_dataset.GetGeoTransform())
+        dataset.SetProjection(base_dataset.GetProjection())
+        if nodata is not None:
+            dataset.GetRasterBand(1).SetNoDataValue(float(nodata))
+        gdal.Dataset.__swig_destroy__(dataset)
+        dataset = None
+        gdal.Dataset.__swig_destroy__(base_dataset)
+        base_dataset = None
+        return cls(uri, update=True)
+
+    def _map_blocks(self):
+        """Memory map the file if it is an uncompressed, contiguous GeoTIFF.
+
+        Leaves `self._memmap` as None if the raster can't be mapped; reads
+        then go through GDAL.  The map has shape (block rows, block cols,
+        rows per block, cols per block).  Stripped files are mapped as a
+        single block since strips are only ever full width.  GDAL writes
+        blocks in the order they leave its cache, so the offset and size of
+        every block are checked to be in row major order and contiguous.
+        """
+        image_structure = self._dataset.GetMetadata('IMAGE_STRUCTURE')
+        band_structure = self._band.GetMetadata('IMAGE_STRUCTURE')
+        if (self._dataset.GetDriver().ShortName != 'GTiff' or
+                self._dataset.RasterCount != 1 or
+                'COMPRESSION' in image_structure or
+                'NBITS' in band_structure):
+            return
+        n_rows, n_cols = self.shape
+        block_cols, block_rows = self.block_size
+        n_block_rows = int(math.ceil(n_rows / float(block_rows)))
+        n_block_cols = int(math.ceil(n_cols / float(block_cols)))
+        block_bytes = block_cols * block_rows * self.dtype.itemsize
+        n_blocks = n_block_rows * n_block_cols
+        first_offset = None
+        for block_index in xrange(n_blocks):
+            block_row, block_col = divmod(block_index, n_block_cols)
+            offset = self._band.GetMetadataItem(
+                'BLOCK_OFFSET_%d_%d' % (block_col, block_row), 'TIFF')
+            size = self._band.GetMetadataItem(
+                'BLOCK_SIZE_%d_%d' % (block_col, block_row), 'TIFF')
+            if not offset or not size:
+                return
+            if first_offset is None:
+                first_offset = int(offset)
+            if int(offset) != first_offset + block_index * block_bytes:
+                return
+            if block_cols == n_cols and block_index == n_blocks - 1:
+                # the last strip may only hold the remaining rows
+                expected_bytes = (
+                    (n_rows - block_row * block_rows) * n_cols *
+                    self.dtype.itemsize)
+                if int(size) < expected_bytes:
+                    return
+            elif int(size) != block_bytes:
+                return
+
+        if block_cols == n_cols:
+            map_shape = (1, 1, n_rows, n_cols)
+        else:
+            map_shape = (n_block_rows, n_block_cols, block_rows, block_cols)
+        map_bytes = numpy.prod(map_shape) * self.dtype.itemsize
+        if os.path.getsize(self.uri) < first_offset + map_bytes:
+            return
+        with open(self.uri, 'rb') as tiff_file:
+            byte_order = '>' if tiff_file.read(2) == b'MM' else '<'
+        self._memmap = numpy.memmap(
+            self.uri, dtype=self.dtype.newbyteorder(byte_order), mode='r',
+            offset=first_offset, shape=map_shape)
+        self._memmap_block_size = (map_shape[3], map_shape[2])
+
+    def read(self, xoff=0, yoff=0, win_xsize=None, win_ysize=None):
+        """Read a window of the raster.
+
+        Args:
+            xoff (int): column of the window's upper left pixel.
+            yoff (int): row of the window's upper left pixel.
+            win_xsize (int): window width, to the right edge if None.
+            win_ysize (int): window height, to the bottom edge if None.
+
+        Returns:
+            numpy array of `self.dtype` with shape (win_ysize, win_xsize).
+        """
+        if win_xsize is None:
+            win_xsize = self.shape[1] - xoff
+        if win_ysize is None:
+            win_ysize = self.shape[0] - yoff
+        if win_xsize <= 0 or win_ysize <= 0:
+            return numpy.empty((max(win_ysize, 0), max(win_xsize, 0)),
+                               dtype=self.dtype)
+        if self._memmap is None:
+            array = numpy.empty((win_ysize, win_xsize), dtype=self.dtype)
+            self._band.ReadAsArray(
+                xoff=xoff, yoff=yoff, win_xsize=win_xsize,
+                win_ysize=win_ysize, buf_obj=array)
+            return array
+
+        block_cols, block_rows = self._memmap_block_size
+        row_block_start = yoff // block_rows
+        row_block_end = (yoff + win_ysize - 1) // block_rows + 1
+        col_block_start = xoff // block_cols
+        col_block_end = (xoff + win_xsize - 1) // block_cols + 1
+        blocks = self._memmap[
+            row_block_start:row_block_end, col_block_start:col_block_end]
+        blocks = blocks.transpose(0, 2, 1, 3).reshape(
+            blocks.shape[0] * block_rows, blocks.shape[1] * block_cols)
+        row_start = yoff - row_block_start * block_rows
+        col_start = xoff - col_block_start * block_cols
+        return blocks[
+            row_start:row_start + win_ysize,
+            col_start:col_start + win_xsize].astype(self.dtype)
+
+    def read_decimated(self, max_pixels):
+        """Read the whole raster, subsampled to at most `max_pixels` pixels.
+
+        GDAL picks the pixels (or an overview, if the file has one), so only
+        the decimated array is held in memory.  Rasters that already fit are
+        read at full resolution.
+        """
+        n_rows, n_cols = self.shape
+        if n_rows * n_cols <= max_pixels:
+            return self.read()
+        scale_factor = math.sqrt(float(max_pixels) / (n_rows * n_cols))
+        buf_xsize = max(int(n_cols * scale_factor), 1)
+        buf_ysize = max(int(n_rows * scale_factor), 1)
+        return self._band.ReadAsArray(
+            0, 0, n_cols, n_rows, buf_xsize, buf_ysize).astype(self.dtype)
+
+    def write(self, array, xoff=0, yoff=0):
+        """Write `array` to the raster with its upper left at xoff, yoff."""
+        self._band.WriteArray(array, xoff=xoff, yoff=yoff)
+
+    def iterwindows(self, max_pixels=_RASTER_ARRAY_WINDOW_PIXELS):
+        """Yield windows covering the raster in full-width strips.
+
+        Each strip holds a whole number of block rows and about
+        `max_pixels` pixels, at least one row of blocks.
+
+        Yields:
+            dicts with 'xoff', 'yoff', 'win_xsize' and 'win_ysize' keys, the
+            same as pygeoprocessing.iterblocks, usable as `read(**window)`.
+        """
+        n_rows, n_cols = self.shape
+        block_rows = self.block_size[1]
+        rows_per_window = block_rows * max(
+            max_pixels // (n_cols * block_rows), 1)
+        for yoff in xrange(0, n_rows, rows_per_window):
+            yield {
+                'xoff': 0,
+                'yoff': yoff,
+                'win_xsize': n_cols,
+                'win_ysize': min(rows_per_window, n_rows - yoff),
+            }
+
+    def iterblocks(self, max_pixels=_RASTER_ARRAY_WINDOW_PIXELS):
+        """Yield (window, array) for each window of `iterwindows`."""
+        for window in self.iterwindows(max_pixels):
+            yield window, self.read(**window)
+
+    def nansum(self):
+        """Sum of the raster's non-NaN values, accumulated block by block."""
+        total = 0.0
+        for _, block in self.iterblocks():
+            total += numpy.nansum(block, dtype=numpy.float64)
+        return total
+
+    def __getitem__(self, key):
+        """Read the window selected by a pair of contiguous slices."""
+        if not isinstance(key, tuple):
+            key = (key, slice(None))
+        if (len(key) != 2 or
+                not all(isinstance(index, slice) for index in key)):
+            raise IndexError(
+                "RasterArray only supports [rows, cols] slices, got %s" %
+                str(key))
+        row_start, row_stop, row_step = key[0].indices(self.shape[0])
+        col_start, col_stop, col_step = key[1].indices(self.shape[1])
+        if row_step != 1 or col_step != 1:
+            raise IndexError("RasterArray slices can't have a step")
+        return self.read(
+            col_start, row_start, col_stop - col_start, row_stop - row_start)
+
+    def __array__(self, dtype=None):
+        """Read the whole band, for numpy.asarray and friends."""
+        array = self.read()
+        if dtype is not None:
+            array = array.astype(dtype)
+        return array
+
+    def close(self):
+        """Flush any writes and release the GDAL handles and file map."""
+        self._memmap = None
+        if self._dataset is not None:
+            self._band.FlushCache()
+            self._band = None
+            self._dataset.FlushCache()
+            gdal.Dataset.__swig_destroy__(self._dataset)
+            self._dataset = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
 def save_array_as_geotiff(array, out_uri, geotiff_uri_to_match=None, ds_to_match=None, band_to_match=None,
                           optimize_data_type=True, data_type_override=None, no_data_value_override=None,
                           geotransform_override=None, projection_override=None, n_cols_override=None,
-                          n_rows_override=None, compression_method=None, verbose=None, set_inf_to_no_data_value=True):
+                          n_rows_override=None, compression_method=None, verbose=None, set_inf_to_no_data_value=True,
+                          creation_profile='intermediate'):
     '''
     Saves an array as a geotiff at uri_out. Attempts to correctly deal with many possible data flaws, such as
     assigning a datatype to the geotiff that matches the required pixel depth. Also determines the best (according to me)
-    no_data_value to use based on the dtype and range of the data
+    no_data_value to use based on the dtype and range of the data. Tiling and compression come from the
+    GTIFF_CREATION_PROFILES entry named by creation_profile; compression_method, if given, overrides its compression.
     '''
     execute_in_python = True
 
@@ -959,8 +1452,10 @@ def save_array_as_geotiff(array, out_uri, geotiff_uri_to_match=None, ds_to_match
 
     processed_out_uri = os.path.join(folder_uri, basename + file_extension)
 
-    dst_options = ['BIGTIFF=IF_SAFER', 'TILED=YES']
+    dst_options = gtiff_creation_options(creation_profile, data_type, n_cols, n_rows)
     if compression_method:
+        dst_options = [option for option in dst_options
+                       if option.split('=')[0] not in ('COMPRESS', 'PREDICTOR', 'ZLEVEL')]
         dst_options.append('COMPRESS=' + compression_method)
         if compression_method == 'lzw':
             dst_options.append('PREDICTOR=2')
@@ -1051,6 +1546,10 @@ def clip_by_shape_with_buffered_intermediate_uri(src_uri, shp_uri, output_uri, m
         3. use 2 to clip src_uri
         4. resample and reproject to match desired resolution
         5. clip with shp_uri
+
+    The intermediates are written next to shp_uri unless a scratch_dir keyword is given, which lets several clips against
+    the same shapefile run at once as long as each has its own scratch_dir. A process_pool keyword is passed on to the
+    clips, see vectorize_datasets.
     
     """
     src_ds = gdal.Open(src_uri)
@@ -1062,7 +1561,12 @@ def clip_by_shape_with_buffered_intermediate_uri(src_uri, shp_uri, output_uri, m
     resampling_method = kwargs.get('resampling_method', 'nearest')
 
     # Step 1, reproject shapefile to match src_uri
-    aoi_reprojected_uri = shp_uri.replace('.shp', '_reprojected.shp')
+    scratch_dir = kwargs.get('scratch_dir')
+    if scratch_dir:
+        create_directories([scratch_dir])
+        aoi_reprojected_uri = os.path.join(scratch_dir, os.path.basename(shp_uri).replace('.shp', '_reprojected.shp'))
+    else:
+        aoi_reprojected_uri = shp_uri.replace('.shp', '_reprojected.shp')
     reproject_datasource_uri(shp_uri, input_wkt, aoi_reprojected_uri)
 
     # Step 2, create a buffered version of the polygon.
@@ -1075,7 +1579,7 @@ def clip_by_shape_with_buffered_intermediate_uri(src_uri, shp_uri, output_uri, m
 
     # Step 3, Clip src using buffered shapefile
     buffered_clip_uri = os.path.join(os.path.split(aoi_reprojected_uri)[0], 'raster_buffered_clipped.tif')
-    clip_dataset_uri(src_uri, buffered_polygon_uri, buffered_clip_uri, assert_projections=False, all_touched=True) # , assert_projections=False
+    clip_dataset_uri(src_uri, buffered_polygon_uri, buffered_clip_uri, assert_projections=False, all_touched=True, process_pool=kwargs.get('process_pool')) # , assert_projections=False
 
     # Step 4: Reproject to projection of original shape file
     penultimate_uri = os.path.join(os.path.split(aoi_reprojected_uri)[0], 'raster_penultimate.tif')
@@ -1089,7 +1593,7 @@ def clip_by_shape_with_buffered_intermediate_uri(src_uri, shp_uri, output_uri, m
 
     # Step 5: Clip final product with original shapefile
     # TODO FLAW, clip will shrink the final output raster if the aoi here bounds it further when applied at this higher resolution. need to come up with a preserve-bb option for clip with intermediate. Probably fully replace pgp clip.
-    clip_dataset_uri(penultimate_uri, shp_uri, output_uri, match_uri, all_touched=True)
+    clip_dataset_uri(penultimate_uri, shp_uri, output_uri, match_uri, all_touched=True, process_pool=kwargs.get('process_pool'))
 
     # Cleanup
     os.remove(buffered_polygon_uri)
@@ -1295,10 +1799,12 @@ def reproject_dataset_uri(
 
     # Create the output dataset to receive the projected output, with the
     # proper resampled arrangement.
+    n_cols = int((lrx - ulx)/pixel_spacing)
+    n_rows = int((uly - lry)/pixel_spacing)
     output_dataset = gdal_driver.Create(
-        output_uri, int((lrx - ulx)/pixel_spacing),
-        int((uly - lry)/pixel_spacing), 1, output_type,
-        options=['BIGTIFF=IF_SAFER'])
+        output_uri, n_cols, n_rows, 1, output_type,
+        options=gtiff_creation_options(
+            'intermediate', output_type, n_cols, n_rows))
 
     # Set the nodata value for the output dataset
     output_dataset.GetRasterBand(1).SetNoDataValue(float(out_nodata))
@@ -1338,6 +1844,147 @@ def reproject_dataset_uri(
     output_dataset = None
     calculate_raster_stats_uri(output_uri)
 
+
+_FILE_HASH_CACHE = {}
+
+
+def file_content_hash(uri, chunk_size=2**20):
+    """Hash the bytes of a file.
+
+    The hash is remembered for the life of the process against the file's
+    path, size and modification time, so asking again for an unchanged file
+    does not re-read it.
+
+    Args:
+        uri (string): path to the file
+        chunk_size (int): bytes read at a time
+
+    Returns:
+        the SHA-1 hex digest of the file contents
+    """
+    file_stat = os.stat(uri)
+    memo_key = (os.path.abspath(uri), file_stat.st_size, file_stat.st_mtime)
+    if memo_key not in _FILE_HASH_CACHE:
+        digest = hashlib.sha1()
+        with open(uri, 'rb') as hashed_file:
+            for chunk in iter(lambda: hashed_file.read(chunk_size), b''):
+                digest.update(chunk)
+        _FILE_HASH_CACHE[memo_key] = digest.hexdigest()
+    return _FILE_HASH_CACHE[memo_key]
+
+
+def cached_reproject_window_uri(
+        original_dataset_uri, pixel_spacing, output_wkt, resampling_method,
+        aoi_uri, cache_dir, margin_cells=4):
+    """Reproject the part of a large dataset that covers an AOI, cached.
+
+    Gives the same pixels as reproject_dataset_uri over the AOI's bounding
+    box plus `margin_cells` pixels on each side, on the same grid the full
+    reprojection would have, but only that window is warped.  The result is
+    kept in `cache_dir` under a name keyed by the dataset's content hash,
+    the output projection, the AOI bounds, the pixel size, the resampling
+    method and the margin, and is reused by any later call with the same
+    key.  Older GDALs without gdal.Warp reproject the whole dataset instead.
+
+    Args:
+        original_dataset_uri (string): the GDAL dataset to reproject
+        pixel_spacing: output pixel size in projected linear units
+        output_wkt (string): output projection in Well Known Text; the AOI
+            must already be in this projection
+        resampling_method (string): one of
+            "nearest|bilinear|cubic|cubic_spline|lanczos|average"
+        aoi_uri (string): the vector whose bounding box sets the window
+        cache_dir (string): directory holding the cached rasters, created if
+            needed
+        margin_cells (int): pixels added around the AOI bounding box
+
+    Returns:
+        the path of the cached reprojected raster
+    """
+    resample_dict = {
+        "nearest": gdal.GRA_NearestNeighbour,
+        "nearest_neighbor": gdal.GRA_NearestNeighbour,
+        "bilinear": gdal.GRA_Bilinear,
+        "cubic": gdal.GRA_Cubic,
+        "cubic_spline": gdal.GRA_CubicSpline,
+        "lanczos": gdal.GRA_Lanczos,
+        "average": gdal.GRA_Average,
+    }
+
+    aoi_bounding_box = [
+        float(value) for value in get_datasource_bounding_box(aoi_uri)]
+    cache_key = hashlib.sha1(json.dumps([
+        file_content_hash(original_dataset_uri), output_wkt,
+        aoi_bounding_box, float(pixel_spacing), resampling_method,
+        margin_cells])).hexdigest()
+    cached_uri = os.path.join(cache_dir, '%s_%s.tif' % (
+        os.path.splitext(os.path.basename(original_dataset_uri))[0],
+        cache_key[:16]))
+    if os.path.exists(cached_uri):
+        return cached_uri
+
+    create_directories([cache_dir])
+    # Written under a temporary name and renamed so an interrupted run
+    # never leaves a partial raster under the cached name.
+    temporary_uri = '%s.%d.tmp.tif' % (
+        os.path.splitext(cached_uri)[0], os.getpid())
+    if hasattr(gdal, 'Warp'):
+        original_dataset = gdal.Open(original_dataset_uri)
+        output_type = original_dataset.GetRasterBand(1).DataType
+
+        # The grid reproject_dataset_uri would give the whole dataset.
+        vrt = gdal.AutoCreateWarpedVRT(
+            original_dataset, None, output_wkt, gdal.GRA_Bilinear)
+        geo_t = vrt.GetGeoTransform()
+        ulx, uly = geo_t[0], geo_t[3]
+        n_cols = int(geo_t[1] * vrt.RasterXSize / pixel_spacing)
+        n_rows = int(-geo_t[5] * vrt.RasterYSize / pixel_spacing)
+        vrt = None
+
+        margin = margin_cells * pixel_spacing
+        col_start = max(int(math.floor(
+            (aoi_bounding_box[0] - margin - ulx) / pixel_spacing)), 0)
+        col_end = min(int(math.ceil(
+            (aoi_bounding_box[2] + margin - ulx) / pixel_spacing)), n_cols)
+        row_start = max(int(math.floor(
+            (uly - aoi_bounding_box[1] - margin) / pixel_spacing)), 0)
+        row_end = min(int(math.ceil(
+            (uly - aoi_bounding_box[3] + margin) / pixel_spacing)), n_rows)
+        if col_end <= col_start or row_end <= row_start:
+            raise ValueError(
+                'The AOI %s does not overlap %s.' % (
+                    aoi_uri, original_dataset_uri))
+
+        gdal.Warp(
+            temporary_uri, original_dataset, format='GTiff',
+            dstSRS=output_wkt,
+            outputBounds=(
+                ulx + col_start * pixel_spacing,
+                uly - row_end * pixel_spacing,
+                ulx + col_end * pixel_spacing,
+                uly - row_start * pixel_spacing),
+            width=col_end - col_start, height=row_end - row_start,
+            resampleAlg=resample_dict[resampling_method],
+            dstNodata=get_nodata_from_uri(original_dataset_uri),
+            creationOptions=gtiff_creation_options(
+                'intermediate', output_type, col_end - col_start,
+                row_end - row_start))
+        gdal.Dataset.__swig_destroy__(original_dataset)
+        original_dataset = None
+    else:
+        reproject_dataset_uri(
+            original_dataset_uri, pixel_spacing, output_wkt,
+            resampling_method, temporary_uri)
+
+    try:
+        os.rename(temporary_uri, cached_uri)
+    except OSError:
+        # Another run cached the same key first.
+        if not os.path.exists(cached_uri):
+            raise
+        os.remove(temporary_uri)
+    return cached_uri
+
 def _gdal_to_numpy_type(band):
     """Calculate the equivalent numpy datatype from a GDAL raster band type.
 
@@ -1462,7 +2109,8 @@ def clip_dataset_uri(
     Keyword Args:
         assert_projections (boolean): a boolean value for whether the dataset
             needs to be projected
-        process_pool: a process pool for multiprocessing
+        process_pool: a multiprocessing.pool.ThreadPool or a number of
+            threads, see vectorize_datasets
         all_touched (boolean): if true the clip uses the option ALL_TOUCHED=TRUE
             when calling RasterizeLayer for AOI masking.
 
@@ -1489,6 +2137,210 @@ def clip_dataset_uri(
         process_pool=process_pool, vectorize_op=False, all_touched=all_touched)
 
 
+def _block_statistics(block, numpy_type, nodata):
+    """Summarize the valid pixels of a block as they will be stored.
+
+    Floating point values written to an integer band are rounded half away
+    from zero and clamped to the range of the band type, as GDAL does when
+    it writes them, so the statistics match what a later ComputeStatistics
+    would find.  NaN and nodata pixels are skipped.
+
+    Args:
+        block (numpy.ndarray): block about to be written to the band.
+        numpy_type (numpy.dtype): numpy equivalent of the band type.
+        nodata: nodata value of the band, or None.
+
+    Returns:
+        (count, mean, sum of squared deviations from the mean, min, max)
+        of the valid pixels, or None if there are none.
+    """
+    values = numpy.asarray(block).ravel()
+    if numpy.issubdtype(numpy_type, numpy.integer):
+        if not numpy.issubdtype(values.dtype, numpy.integer):
+            values = values[~numpy.isnan(values)]
+            values = numpy.where(
+                values >= 0, numpy.floor(values + 0.5),
+                numpy.ceil(values - 0.5))
+        type_info = numpy.iinfo(numpy_type)
+        values = numpy.clip(values, type_info.min, type_info.max)
+    else:
+        values = values[~numpy.isnan(values)]
+    values = values.astype(numpy_type)
+    if nodata is not None:
+        values = values[values != nodata]
+    if values.size == 0:
+        return None
+    values = values.astype(numpy.float64)
+    mean = values.mean()
+    return (
+        values.size, mean, ((values - mean) ** 2).sum(), values.min(),
+        values.max())
+
+
+def _merge_statistics(statistics_a, statistics_b):
+    """Combine two results of _block_statistics into one.
+
+    Uses the pairwise update of Chan et al. so the variance doesn't lose
+    precision the way a running sum of squares does on large rasters.
+    """
+    if statistics_a is None:
+        return statistics_b
+    if statistics_b is None:
+        return statistics_a
+    count_a, mean_a, m2_a, min_a, max_a = statistics_a
+    count_b, mean_b, m2_b, min_b, max_b = statistics_b
+    count = count_a + count_b
+    delta = mean_b - mean_a
+    return (
+        count, mean_a + delta * count_b / float(count),
+        m2_a + m2_b + delta ** 2 * count_a * count_b / float(count),
+        min(min_a, min_b), max(max_a, max_b))
+
+
+# Number of blocks per thread that may be read and computed ahead of the
+# writer when vectorize_datasets runs on a thread pool
+_BLOCKS_IN_FLIGHT_PER_THREAD = 2
+
+
+def _threaded_vectorize_blocks(
+        aligned_uri_list, mask_uri, dataset_pixel_op, output_band,
+        nodata_out, block_size, process_pool, calculate_stats):
+    """Apply dataset_pixel_op block by block on a pool of threads.
+
+    GDAL reads and numpy operations release the GIL, so blocks are read and
+    computed on the threads of `process_pool`, each of which opens its own
+    handles to the inputs since GDAL datasets can't be shared between
+    threads.  At most `_BLOCKS_IN_FLIGHT_PER_THREAD` blocks per thread are
+    queued ahead of the calling thread, which is the only writer and writes
+    the blocks in the same order as the serial loop in vectorize_datasets so
+    the output is byte-identical.
+
+    Args:
+        aligned_uri_list (list): uris of the aligned input rasters.
+        mask_uri (string): uri of the AOI mask raster, or None if there is no
+            AOI.  Pixels where the mask is 0 are set to nodata_out.
+        dataset_pixel_op (function): operation applied to the input blocks.
+        output_band (gdal.Band): band the result is written to.
+        nodata_out: nodata value of output_band.
+        block_size (list): [cols_per_block, rows_per_block].
+        process_pool: a multiprocessing.pool.ThreadPool, or the number of
+            threads to run in a pool made for this call.
+        calculate_stats (boolean): if True the statistics of the written
+            blocks are accumulated by the threads.
+
+    Returns:
+        the merged _block_statistics of the output, or None if
+        calculate_stats is False or there are no valid pixels.
+
+    Raises:
+        ValueError: if process_pool is neither a thread pool nor a number of
+            threads.
+    """
+    if isinstance(process_pool, (int, long)):
+        thread_pool = multiprocessing.pool.ThreadPool(process_pool)
+        n_threads = process_pool
+    elif isinstance(process_pool, multiprocessing.pool.ThreadPool):
+        thread_pool = process_pool
+        n_threads = process_pool._processes
+    else:
+        raise ValueError(
+            "process_pool must be a multiprocessing.pool.ThreadPool or a "
+            "number of threads, got %s" % str(process_pool))
+    max_blocks_in_flight = _BLOCKS_IN_FLIGHT_PER_THREAD * n_threads
+
+    n_rows = output_band.YSize
+    n_cols = output_band.XSize
+    cols_per_block, rows_per_block = block_size[0], block_size[1]
+    n_blocks = (
+        int(math.ceil(n_rows / float(rows_per_block))) *
+        int(math.ceil(n_cols / float(cols_per_block))))
+    output_numpy_type = _gdal_to_numpy_type(output_band)
+    band_statistics = None
+    thread_state = threading.local()
+
+    def _read_and_compute(row_offset, col_offset, row_block_width,
+                          col_block_width):
+        """Read one block of every input and apply dataset_pixel_op."""
+        if not hasattr(thread_state, 'bands'):
+            thread_state.datasets = [
+                gdal.Open(uri, gdal.GA_ReadOnly) for uri in aligned_uri_list]
+            thread_state.bands = [
+                dataset.GetRasterBand(1) for dataset in thread_state.datasets]
+            if mask_uri is not None:
+                thread_state.mask_dataset = gdal.Open(mask_uri)
+                thread_state.mask_band = (
+                    thread_state.mask_dataset.GetRasterBand(1))
+
+        dataset_blocks = []
+        for band in thread_state.bands:
+            dataset_block = numpy.empty(
+                (row_block_width, col_block_width),
+                dtype=_gdal_to_numpy_type(band))
+            band.ReadAsArray(
+                xoff=col_offset, yoff=row_offset, win_xsize=col_block_width,
+                win_ysize=row_block_width, buf_obj=dataset_block)
+            dataset_blocks.append(dataset_block)
+
+        out_block = dataset_pixel_op(*dataset_blocks)
+
+        if mask_uri is not None:
+            mask_array = numpy.empty(
+                (row_block_width, col_block_width), dtype=numpy.int8)
+            thread_state.mask_band.ReadAsArray(
+                xoff=col_offset, yoff=row_offset, win_xsize=col_block_width,
+                win_ysize=row_block_width, buf_obj=mask_array)
+            out_block[mask_array == 0] = nodata_out
+        out_block = out_block[0:row_block_width, 0:col_block_width]
+        if calculate_stats:
+            return out_block, _block_statistics(
+                out_block, output_numpy_type, nodata_out)
+        return out_block, None
+
+    def _write_block(block_result):
+        """Write the next finished block in order."""
+        (row_offset, col_offset), async_result = block_result
+        out_block, block_statistics = async_result.get()
+        output_band.WriteArray(out_block, xoff=col_offset, yoff=row_offset)
+        return block_statistics
+
+    pending_blocks = deque()
+    last_time = time.time()
+    n_blocks_written = 0
+    try:
+        for row_offset in xrange(0, n_rows, rows_per_block):
+            row_block_width = min(rows_per_block, n_rows - row_offset)
+            for col_offset in xrange(0, n_cols, cols_per_block):
+                col_block_width = min(cols_per_block, n_cols - col_offset)
+                pending_blocks.append(
+                    ((row_offset, col_offset), thread_pool.apply_async(
+                        _read_and_compute, (
+                            row_offset, col_offset, row_block_width,
+                            col_block_width))))
+                if len(pending_blocks) < max_blocks_in_flight:
+                    continue
+                band_statistics = _merge_statistics(
+                    band_statistics, _write_block(pending_blocks.popleft()))
+                n_blocks_written += 1
+
+                current_time = time.time()
+                if current_time - last_time > 5.0:
+                    print(
+                        'raster stack calculation approx. %.2f%% complete' %
+                        (n_blocks_written / float(n_blocks) * 100.0))
+                    last_time = current_time
+        while pending_blocks:
+            band_statistics = _merge_statistics(
+                band_statistics, _write_block(pending_blocks.popleft()))
+    finally:
+        # don't leave reads running against files the caller may delete
+        for _, async_result in pending_blocks:
+            async_result.wait()
+        if thread_pool is not process_pool:
+            thread_pool.close()
+            thread_pool.join()
+    return band_statistics
+
+
 def vectorize_datasets(
         dataset_uri_list, dataset_pixel_op, dataset_out_uri, datatype_out,
         nodata_out, pixel_size_out, bounding_box_mode,
@@ -1496,7 +2348,7 @@ def vectorize_datasets(
         dataset_to_bound_index=None, aoi_uri=None,
         assert_datasets_projected=True, process_pool=None, vectorize_op=True,
         datasets_are_pre_aligned=False, dataset_options=None,
-        all_touched=False):
+        all_touched=False, calculate_stats=True, lazy_alignment=False):
     """Apply local raster operation on stack of datasets.
 
     This function applies a user defined function across a stack of
@@ -1555,7 +2407,12 @@ def vectorize_datasets(
         assert_datasets_projected (boolean): if True this operation will
             test if any datasets are not projected and raise an exception
             if so.
-        process_pool: a process pool for multiprocessing
+        process_pool: a multiprocessing.pool.ThreadPool, or a number of
+            threads, to read and compute blocks in parallel.  Blocks are still
+            written in order by the calling thread so the output is the same
+            as the serial calculation.  If None, or a process pool since the
+            op and the GDAL handles can't be sent to other processes, blocks
+            are processed serially.
         vectorize_op (boolean): if true the model will try to numpy.vectorize
             dataset_pixel_op.  If dataset_pixel_op is designed to use maximize
             array broadcasting, set this parameter to False, else it may
@@ -1569,8 +2426,20 @@ def vectorize_datasets(
         dataset_options: this is an argument list that will be
             passed to the GTiff driver.  Useful for blocksizes, compression,
             etc.
+            Defaults to the 'intermediate' GeoTIFF creation profile.
         all_touched (boolean): if true the clip uses the option
             ALL_TOUCHED=TRUE when calling RasterizeLayer for AOI masking.
+        calculate_stats (boolean): if True the band statistics (min, max,
+            mean and stdev of the valid pixels) are accumulated from the
+            blocks as they are written and saved with the output.  Set to
+            False for scratch outputs that are read once and deleted.
+        lazy_alignment (boolean): if True and the datasets aren't
+            pre-aligned they are aligned with VRTs, so inputs already on the
+            output grid are read in place and the others are resampled block
+            by block as they are read, rather than first copied to
+            resampled GeoTIFFs.  The aligned inputs are then not masked by
+            the AOI, only the output is.  Off by default; callers opt in
+            when their op doesn't depend on the masked inputs.
 
     Returns:
         None
@@ -1609,7 +2478,8 @@ def vectorize_datasets(
         if dataset_to_align_index is None:
             dataset_to_align_index = -1
         dataset_out_uri_list = [
-            temporary_filename(suffix='.tif') for _ in dataset_uri_list]
+            temporary_filename(suffix='.vrt' if lazy_alignment else '.tif')
+            for _ in dataset_uri_list]
         # Align and resample the datasets, then load datasets into a list
         align_dataset_list(
             dataset_uri_list, dataset_out_uri_list, resample_method_list,
@@ -1617,7 +2487,8 @@ def vectorize_datasets(
             dataset_to_bound_index=dataset_to_bound_index,
             aoi_uri=aoi_uri,
             assert_datasets_projected=assert_datasets_projected,
-            all_touched=all_touched)
+            all_touched=all_touched, use_vrt=lazy_alignment,
+            calculate_stats=False)
         aligned_datasets = [
             gdal.Open(filename, gdal.GA_ReadOnly) for filename in
             dataset_out_uri_list]
@@ -1632,6 +2503,9 @@ def vectorize_datasets(
     n_rows = aligned_datasets[0].RasterYSize
     n_cols = aligned_datasets[0].RasterXSize
 
+    if dataset_options is None:
+        dataset_options = gtiff_creation_options(
+            'intermediate', datatype_out, n_cols, n_rows)
     output_dataset = pg.new_raster_from_base(
         aligned_datasets[0], dataset_out_uri, 'GTiff', nodata_out,
         datatype_out, dataset_options=dataset_options)
@@ -1653,7 +2527,8 @@ def vectorize_datasets(
         mask_uri = temporary_filename(suffix='.tif')
         mask_dataset = pg.new_raster_from_base(
             aligned_datasets[0], mask_uri, 'GTiff', 255, gdal.GDT_Byte,
-            fill_value=0, dataset_options=dataset_options)
+            fill_value=0, dataset_options=gtiff_creation_options(
+                'scratch', gdal.GDT_Byte, n_cols, n_rows))
         mask_band = mask_dataset.GetRasterBand(1)
         aoi_datasource = ogr.Open(aoi_uri)
         aoi_layer = aoi_datasource.GetLayer()
@@ -1673,69 +2548,102 @@ def vectorize_datasets(
         dataset_pixel_op = numpy.vectorize(
             dataset_pixel_op, otypes=[_gdal_to_numpy_type(output_band)])
 
-    last_time = time.time()
-
-    last_row_block_width = None
-    last_col_block_width = None
-    for row_block_index in xrange(n_row_blocks):
-        row_offset = row_block_index * rows_per_block
-        row_block_width = n_rows - row_offset
-        if row_block_width > rows_per_block:
-            row_block_width = rows_per_block
-
-        for col_block_index in xrange(n_col_blocks):
-            col_offset = col_block_index * cols_per_block
-            col_block_width = n_cols - col_offset
-            if col_block_width > cols_per_block:
-                col_block_width = cols_per_block
-
-            current_time = time.time()
-            if current_time - last_time > 5.0:
-                print(
-                    'raster stack calculation approx. %.2f%% complete',
-                    ((row_block_index * n_col_blocks + col_block_index) /
-                     float(n_row_blocks * n_col_blocks) * 100.0))
-                last_time = current_time
-
-            #This is true at least once since last_* initialized with None
-            if (last_row_block_width != row_block_width or
-                        last_col_block_width != col_block_width):
-                dataset_blocks = [
-                    numpy.zeros(
-                        (row_block_width, col_block_width),
-                        dtype=_gdal_to_numpy_type(band)) for band in aligned_bands]
-
-                if aoi_uri != None:
-                    mask_array = numpy.zeros(
-                        (row_block_width, col_block_width), dtype=numpy.int8)
-
-                last_row_block_width = row_block_width
-                last_col_block_width = col_block_width
-
-            for dataset_index in xrange(len(aligned_bands)):
-                aligned_bands[dataset_index].ReadAsArray(
-                    xoff=col_offset, yoff=row_offset,
-                    win_xsize=col_block_width,
-                    win_ysize=row_block_width,
-                    buf_obj=dataset_blocks[dataset_index])
-
-            out_block = dataset_pixel_op(*dataset_blocks)
-
-            # Mask out the row if there is a mask
-            if aoi_uri is not None:
-                mask_band.ReadAsArray(
-                    xoff=col_offset, yoff=row_offset,
-                    win_xsize=col_block_width,
-                    win_ysize=row_block_width,
-                    buf_obj=mask_array)
-                out_block[mask_array == 0] = nodata_out
-
-            output_band.WriteArray(
-                out_block[0:row_block_width, 0:col_block_width],
-                xoff=col_offset, yoff=row_offset)
+    if (isinstance(process_pool, multiprocessing.pool.Pool) and
+            not isinstance(process_pool, multiprocessing.pool.ThreadPool)):
+        # the op and the GDAL handles can't be sent to other processes
+        process_pool = None
+    if process_pool is not None:
+        if aoi_uri is not None:
+            # the worker threads open their own handles to the mask
+            mask_band.FlushCache()
+            mask_dataset.FlushCache()
+        if datasets_are_pre_aligned:
+            aligned_uri_list = dataset_uri_list
+        else:
+            aligned_uri_list = dataset_out_uri_list
+        band_statistics = _threaded_vectorize_blocks(
+            aligned_uri_list, mask_uri if aoi_uri is not None else None,
+            dataset_pixel_op, output_band, nodata_out, block_size,
+            process_pool, calculate_stats)
+    else:
+        output_numpy_type = _gdal_to_numpy_type(output_band)
+        band_statistics = None
+        last_time = time.time()
+
+        last_row_block_width = None
+        last_col_block_width = None
+        for row_block_index in xrange(n_row_blocks):
+            row_offset = row_block_index * rows_per_block
+            row_block_width = n_rows - row_offset
+            if row_block_width > rows_per_block:
+                row_block_width = rows_per_block
+
+            for col_block_index in xrange(n_col_blocks):
+                col_offset = col_block_index * cols_per_block
+                col_block_width = n_cols - col_offset
+                if col_block_width > cols_per_block:
+                    col_block_width = cols_per_block
+
+                current_time = time.time()
+                if current_time - last_time > 5.0:
+                    print(
+                        'raster stack calculation approx. %.2f%% complete',
+                        ((row_block_index * n_col_blocks + col_block_index) /
+                         float(n_row_blocks * n_col_blocks) * 100.0))
+                    last_time = current_time
+
+                #This is true at least once since last_* initialized with None
+                if (last_row_block_width != row_block_width or
+                            last_col_block_width != col_block_width):
+                    dataset_blocks = [
+                        numpy.zeros(
+                            (row_block_width, col_block_width),
+                            dtype=_gdal_to_numpy_type(band))
+                        for band in aligned_bands]
+
+                    if aoi_uri != None:
+                        mask_array = numpy.zeros(
+                            (row_block_width, col_block_width),
+                            dtype=numpy.int8)
+
+                    last_row_block_width = row_block_width
+                    last_col_block_width = col_block_width
+
+                for dataset_index in xrange(len(aligned_bands)):
+                    aligned_bands[dataset_index].ReadAsArray(
+                        xoff=col_offset, yoff=row_offset,
+                        win_xsize=col_block_width,
+                        win_ysize=row_block_width,
+                        buf_obj=dataset_blocks[dataset_index])
+
+                out_block = dataset_pixel_op(*dataset_blocks)
+
+                # Mask out the row if there is a mask
+                if aoi_uri is not None:
+                    mask_band.ReadAsArray(
+                        xoff=col_offset, yoff=row_offset,
+                        win_xsize=col_block_width,
+                        win_ysize=row_block_width,
+                        buf_obj=mask_array)
+                    out_block[mask_array == 0] = nodata_out
+
+                output_band.WriteArray(
+                    out_block[0:row_block_width, 0:col_block_width],
+                    xoff=col_offset, yoff=row_offset)
+                if calculate_stats:
+                    band_statistics = _merge_statistics(
+                        band_statistics, _block_statistics(
+                            out_block[0:row_block_width, 0:col_block_width],
+                            output_numpy_type, nodata_out))
+
+    if band_statistics is not None:
+        count, mean, m2, minimum, maximum = band_statistics
+        output_band.SetStatistics(
+            float(minimum), float(maximum), float(mean),
+            math.sqrt(m2 / count))
 
     # Making sure the band and dataset is flushed and not in memory before
-    # adding stats
+    # cleaning up
     output_band.FlushCache()
     output_band = None
     output_dataset.FlushCache()
@@ -1761,8 +2669,6 @@ def vectorize_datasets(
                 os.remove(temp_dataset_uri)
             except OSError:
                 print("couldn't delete file %s", temp_dataset_uri)
-    calculate_raster_stats_uri(dataset_out_uri
-                               )
 
 
 
@@ -1939,7 +2845,8 @@ def align_dataset_list(
         dataset_uri_list, dataset_out_uri_list, resample_method_list,
         out_pixel_size, mode, dataset_to_align_index,
         dataset_to_bound_index=None, aoi_uri=None,
-        assert_datasets_projected=True, all_touched=False):
+        assert_datasets_projected=True, all_touched=False, use_vrt=False,
+        calculate_stats=True):
     """Create a new list of datasets that are aligned based on a list of
         inputted datasets.
 
@@ -1975,6 +2882,13 @@ def align_dataset_list(
         aoi_uri (string): a URI to an OGR datasource to be used for the
             aoi.  Irrespective of the `mode` input, the aoi will be used
             to intersect the final bounding box.
+        use_vrt (boolean): if True the outputs are VRTs made by
+            build_aligned_vrt_uri that read the inputs lazily instead of
+            resampled copies.  VRTs can't be masked in place, so the aoi
+            then only bounds the outputs and pixels outside of its polygons
+            keep their values.
+        calculate_stats (boolean): if False the band statistics of the
+            resampled copies aren't computed.
 
     Returns:
         None
@@ -2069,12 +2983,18 @@ def align_dataset_list(
                 "align_dataset_list aligning dataset %d of %d",
                 index, len(dataset_uri_list))
 
-        resize_and_resample_dataset_uri(
-            original_dataset_uri, bounding_box, out_pixel_size,
-            out_dataset_uri, resample_method)
+        if use_vrt:
+            build_aligned_vrt_uri(
+                original_dataset_uri, bounding_box, out_pixel_size,
+                out_dataset_uri, resample_method)
+        else:
+            resize_and_resample_dataset_uri(
+                original_dataset_uri, bounding_box, out_pixel_size,
+                out_dataset_uri, resample_method,
+                calculate_stats=calculate_stats)
 
     # If there's an AOI, mask it out
-    if aoi_uri is not None:
+    if aoi_uri is not None and not use_vrt:
         first_dataset = gdal.Open(dataset_out_uri_list[0])
         n_rows = first_dataset.RasterYSize
         n_cols = first_dataset.RasterXSize
@@ -2135,7 +3055,7 @@ def align_dataset_list(
 
 def resize_and_resample_dataset_uri(
         original_dataset_uri, bounding_box, out_pixel_size, output_uri,
-        resample_method):
+        resample_method, calculate_stats=True):
     """Resize and resample the given dataset.
 
     Args:
@@ -2146,6 +3066,8 @@ def resize_and_resample_dataset_uri(
         output_uri (string): the location of the new resampled GDAL dataset
         resample_method (string): the resampling technique, one of
             "nearest|bilinear|cubic|cubic_spline|lanczos"
+        calculate_stats (boolean): if False the band statistics of the
+            output aren't computed, for scratch outputs that are read once.
 
     Returns:
         None
@@ -2189,30 +3111,17 @@ def resize_and_resample_dataset_uri(
             "clamping to 1.")
         new_y_size = 1
 
-    # create the new x and y size
-    block_size = original_band.GetBlockSize()
-    # If the original band is tiled, then its x blocksize will be different
-    # than the number of columns
-    if original_band.XSize > 256 and original_band.YSize > 256:
-        # it makes sense for many functions to have 256x256 blocks
-        block_size[0] = 256
-        block_size[1] = 256
-        gtiff_creation_options = [
-            'TILED=YES', 'BIGTIFF=IF_SAFER', 'BLOCKXSIZE=%d' % block_size[0],
-                                             'BLOCKYSIZE=%d' % block_size[1]]
-
-        metadata = original_band.GetMetadata('IMAGE_STRUCTURE')
-        if 'PIXELTYPE' in metadata:
-            gtiff_creation_options.append('PIXELTYPE=' + metadata['PIXELTYPE'])
-    else:
-        # it is so small or strangely aligned, use the default creation options
-        gtiff_creation_options = []
+    creation_options = gtiff_creation_options(
+        'intermediate', original_band.DataType, new_x_size, new_y_size)
+    metadata = original_band.GetMetadata('IMAGE_STRUCTURE')
+    if 'PIXELTYPE' in metadata:
+        creation_options.append('PIXELTYPE=' + metadata['PIXELTYPE'])
 
     create_directories([os.path.dirname(output_uri)])
     gdal_driver = gdal.GetDriverByName('GTiff')
     output_dataset = gdal_driver.Create(
         output_uri, new_x_size, new_y_size, 1, original_band.DataType,
-        options=gtiff_creation_options)
+        options=creation_options)
     output_band = output_dataset.GetRasterBand(1)
 
     output_band.SetNoDataValue(original_nodata)
@@ -2252,7 +3161,134 @@ def resize_and_resample_dataset_uri(
     output_dataset.FlushCache()
     gdal.Dataset.__swig_destroy__(output_dataset)
     output_dataset = None
-    calculate_raster_stats_uri(output_uri)
+    if calculate_stats:
+        calculate_raster_stats_uri(output_uri)
+
+
+def build_aligned_vrt_uri(
+        original_dataset_uri, bounding_box, out_pixel_size, output_uri,
+        resample_method):
+    """Make a VRT that reads the given dataset on a new grid on demand.
+
+    The lazy counterpart of resize_and_resample_dataset_uri: the output has
+    the same grid, datatype and nodata value, but no pixels are copied.  If
+    the dataset is already on the output grid (same pixel size and origin
+    offset by a whole number of pixels) the VRT is a window onto it that is
+    read in place; otherwise it is a warped VRT that resamples each block as
+    it is read.  Older GDALs without gdal.Warp fall back to writing a
+    resampled GeoTIFF at output_uri.
+
+    Args:
+        original_dataset_uri (string): a GDAL dataset
+        bounding_box (list): [upper_left_x, upper_left_y, lower_right_x,
+            lower_right_y]
+        out_pixel_size: the pixel size in projected linear units
+        output_uri (string): the location of the new VRT
+        resample_method (string): the resampling technique, one of
+            "nearest|bilinear|cubic|cubic_spline|lanczos|average"
+
+    Returns:
+        None
+    """
+    resample_dict = {
+        "nearest": gdal.GRA_NearestNeighbour,
+        "nearest_neighbor": gdal.GRA_NearestNeighbour,
+        "bilinear": gdal.GRA_Bilinear,
+        "cubic": gdal.GRA_Cubic,
+        "cubic_spline": gdal.GRA_CubicSpline,
+        "lanczos": gdal.GRA_Lanczos,
+        "average": gdal.GRA_Average,
+    }
+
+    original_dataset = gdal.Open(original_dataset_uri)
+    original_band = original_dataset.GetRasterBand(1)
+    original_nodata = original_band.GetNoDataValue()
+    if original_nodata is None:
+        original_nodata = -9999
+    datatype = original_band.DataType
+    metadata = original_band.GetMetadata('IMAGE_STRUCTURE')
+    original_geo_transform = original_dataset.GetGeoTransform()
+    original_n_cols = original_dataset.RasterXSize
+    original_n_rows = original_dataset.RasterYSize
+    projection = original_dataset.GetProjection()
+    original_band = None
+    gdal.Dataset.__swig_destroy__(original_dataset)
+    original_dataset = None
+
+    new_x_size = max(abs(int(numpy.round(
+        (bounding_box[2] - bounding_box[0]) / out_pixel_size))), 1)
+    new_y_size = max(abs(int(numpy.round(
+        (bounding_box[3] - bounding_box[1]) / out_pixel_size))), 1)
+
+    # offset of the output origin in original pixels, whole if on the grid
+    col_offset = (bounding_box[0] - original_geo_transform[0]) / out_pixel_size
+    row_offset = (original_geo_transform[3] - bounding_box[1]) / out_pixel_size
+    tolerance = 1e-6
+    on_grid = (
+        abs(original_geo_transform[1] - out_pixel_size) <=
+        tolerance * out_pixel_size and
+        abs(original_geo_transform[5] + out_pixel_size) <=
+        tolerance * out_pixel_size and
+        original_geo_transform[2] == 0 and original_geo_transform[4] == 0 and
+        abs(col_offset - round(col_offset)) <= tolerance and
+        abs(row_offset - round(row_offset)) <= tolerance)
+
+    create_directories([os.path.dirname(output_uri)])
+    if on_grid:
+        col_offset = int(round(col_offset))
+        row_offset = int(round(row_offset))
+        # window of the original that falls inside the output
+        src_col_start = max(col_offset, 0)
+        src_row_start = max(row_offset, 0)
+        src_col_end = min(col_offset + new_x_size, original_n_cols)
+        src_row_end = min(row_offset + new_y_size, original_n_rows)
+
+        vrt_xml = [
+            '<VRTDataset rasterXSize="%d" rasterYSize="%d">' % (
+                new_x_size, new_y_size),
+            '  <SRS>%s</SRS>' % saxutils.escape(projection),
+            '  <GeoTransform>%s</GeoTransform>' % ', '.join(
+                repr(float(value)) for value in [
+                    bounding_box[0], out_pixel_size, 0.0, bounding_box[1],
+                    0.0, -out_pixel_size]),
+            '  <VRTRasterBand dataType="%s" band="1">' % (
+                gdal.GetDataTypeName(datatype)),
+            '    <NoDataValue>%s</NoDataValue>' % repr(original_nodata)]
+        if 'PIXELTYPE' in metadata:
+            vrt_xml.extend([
+                '    <Metadata domain="IMAGE_STRUCTURE">',
+                '      <MDI key="PIXELTYPE">%s</MDI>' % metadata['PIXELTYPE'],
+                '    </Metadata>'])
+        if src_col_start < src_col_end and src_row_start < src_row_end:
+            window = (
+                src_col_end - src_col_start, src_row_end - src_row_start)
+            vrt_xml.extend([
+                '    <SimpleSource>',
+                '      <SourceFilename relativeToVRT="0">%s</SourceFilename>' %
+                saxutils.escape(os.path.abspath(original_dataset_uri)),
+                '      <SourceBand>1</SourceBand>',
+                '      <SrcRect xOff="%d" yOff="%d" xSize="%d" ySize="%d"/>' %
+                ((src_col_start, src_row_start) + window),
+                '      <DstRect xOff="%d" yOff="%d" xSize="%d" ySize="%d"/>' %
+                ((src_col_start - col_offset, src_row_start - row_offset) +
+                 window),
+                '    </SimpleSource>'])
+        vrt_xml.extend(['  </VRTRasterBand>', '</VRTDataset>'])
+        with open(output_uri, 'w') as vrt_file:
+            vrt_file.write('\n'.join(vrt_xml) + '\n')
+    elif hasattr(gdal, 'Warp'):
+        gdal.Warp(
+            output_uri, original_dataset_uri, format='VRT',
+            outputBounds=(
+                bounding_box[0], bounding_box[3], bounding_box[2],
+                bounding_box[1]),
+            width=new_x_size, height=new_y_size,
+            resampleAlg=resample_dict[resample_method],
+            dstNodata=original_nodata)
+    else:
+        resize_and_resample_dataset_uri(
+            original_dataset_uri, bounding_box, out_pixel_size, output_uri,
+            resample_method)
 
 
 def calculate_raster_stats_uri(dataset_uri):
@@ -0,0 +1,139 @@
+"""Benchmark the scenario generator pixel ops, scalar versus array kernels.
+
+Usage:
+    python benchmark_scenario_generator_ops.py [reference_lulc.tif]
+
+The suitability, constraint and proximity inputs are derived from the
+reference landcover so they have realistic sizes and nodata patterns.  If no
+landcover is given a random 1000 x 1000 landscape is used.  Each op is
+applied with numpy.vectorize to a scalar reference of the original pixel op,
+as vectorize_datasets does with vectorize_op=True, and as the array kernel
+imported from mesh_scenario_generator, and the results are checked to be
+equal.
+"""
+
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'code'))
+from mesh_models import mesh_scenario_generator as msg
+
+# same constants as mesh_scenario_generator.execute
+transition_nodata = -1
+suitability_nodata = 0
+distance_scale = 100
+distance = 1000.0
+physical_suitability_weight = 0.5
+proximity_weight = 0.3
+
+
+def load_lulc():
+    if len(sys.argv) > 1:
+        from osgeo import gdal
+        ds = gdal.Open(sys.argv[1])
+        band = ds.GetRasterBand(1)
+        return band.ReadAsArray(), band.GetNoDataValue()
+    return np.random.randint(0, 20, (1000, 1000)), -1
+
+
+def scalar_ops(landcover_nodata, minimum, maximum):
+    def rasterize_prep_op(x):
+        return 0 if x != landcover_nodata else -1
+
+    def distance_score_op(value):
+        # threshold followed by normalize_op
+        if value == transition_nodata or value > distance:
+            return suitability_nodata
+        else:
+            return ((distance_scale - 1) -
+                    (((value - minimum) /
+                     float(maximum - minimum)) *
+                    (distance_scale - 1))) + 1
+
+    def suitability_op(trans, suit):
+        if trans == 0:
+            return 0
+        return round(((1 - physical_suitability_weight) * trans) +
+                     (physical_suitability_weight * suit))
+
+    def constraint_op(suit, cons):
+        return suit * cons
+
+    def proximity_op(suit, prox):
+        v = suit + (prox * proximity_weight)
+        if v > 100:
+            return 100
+        else:
+            return v
+
+    def constraint_proximity_op(suit, cons, prox):
+        v = (cons * suit) + (prox * proximity_weight)
+        if v > 100:
+            return 100
+        else:
+            return v
+
+    return [
+        rasterize_prep_op, distance_score_op, suitability_op,
+        constraint_op, proximity_op, constraint_proximity_op]
+
+
+def array_ops(landcover_nodata, minimum, maximum):
+    def distance_score_op(value):
+        valid_mask = (value != transition_nodata) & (value <= distance)
+        return msg._distance_score(
+            value, valid_mask, minimum, maximum, distance_scale,
+            suitability_nodata)
+
+    return [
+        msg._landcover_mask_op(landcover_nodata),
+        distance_score_op,
+        msg._suitability_op(physical_suitability_weight),
+        msg._constraint_op,
+        msg._proximity_op(proximity_weight),
+        msg._constraint_proximity_op(proximity_weight)]
+
+
+def main():
+    lulc, landcover_nodata = load_lulc()
+    lulc = lulc.astype(np.float64)
+    n_classes = max(int(np.unique(lulc).size), 1)
+    trans = (lulc % 11).astype(np.float64)
+    suit = (lulc * 37 % 101).astype(np.float64)
+    cons = (lulc % 2).astype(np.float64)
+    prox = (lulc * 13 % 101).astype(np.float64)
+    raw_distance = (lulc * 97 % 1500).astype(np.float64)
+    raw_distance[lulc == landcover_nodata] = transition_nodata
+    minimum, maximum = 0.0, distance
+
+    op_inputs = [
+        (lulc,), (raw_distance,), (trans, suit), (suit, cons), (suit, prox),
+        (suit, cons, prox)]
+
+    print('%d x %d pixels, %d landcover classes' % (
+        lulc.shape[0], lulc.shape[1], n_classes))
+    print('%-24s %10s %10s %8s' % ('op', 'scalar (s)', 'array (s)', 'speedup'))
+    for scalar_op, array_op, inputs in zip(
+            scalar_ops(landcover_nodata, minimum, maximum),
+            array_ops(landcover_nodata, minimum, maximum),
+            op_inputs):
+        start = time.time()
+        scalar_result = np.vectorize(scalar_op, otypes=[np.float64])(*inputs)
+        scalar_time = time.time() - start
+
+        start = time.time()
+        array_result = array_op(*inputs)
+        array_time = max(time.time() - start, 1e-9)
+
+        assert np.allclose(scalar_result, array_result), scalar_op.__name__
+        print('%-24s %10.3f %10.3f %7.0fx' % (
+            scalar_op.__name__, scalar_time, array_time,
+            scalar_time / array_time))
+
+
+if __name__ == '__main__':
+    main()